@@ -0,0 +1,61 @@
+"""Feeds a simulated print into the event coalescer and reports the events in versus the messages and bytes out,
+and the cost of recording one sample.
+
+Per simulated second the printer reports temperatures of a hotend and a bed twice and its position five times,
+the layer changes every 30 seconds. Without coalescing each of these would be a message to OctoFarm.
+
+Run from the repository root: python -m benchmarks.coalescer [simulated minutes] [window seconds]
+"""
+import json
+import random
+import sys
+import time
+
+from octofarm_companion.coalescer import EventCoalescer
+
+
+def main():
+    minutes = int(sys.argv[1]) if len(sys.argv) > 1 else 60
+    window = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    rng = random.Random(42)
+    messages = []
+    coalescer = EventCoalescer(messages.append)
+    record = coalescer.record
+
+    raw_bytes = 0
+    recording = 0.0
+    z = 0.2
+    for second in range(minutes * 60):
+        samples = []
+        for i in range(2):
+            samples.append(("temperature.T0.actual", round(210.0 + rng.uniform(-0.5, 0.5), 1)))
+            samples.append(("temperature.T0.target", 210.0))
+            samples.append(("temperature.B.actual", round(60.0 + rng.uniform(-0.2, 0.2), 1)))
+            samples.append(("temperature.B.target", 60.0))
+        for i in range(5):
+            samples.extend((("position.x", round(rng.uniform(0, 220), 2)), ("position.y", round(rng.uniform(0, 220), 2)),
+                            ("position.z", z), ("position.e", round(rng.uniform(0, 5), 3)), ("position.f", 1800)))
+        if second % 30 == 29:
+            z = round(z + 0.2, 2)
+            samples.append(("z", z))
+
+        raw_bytes += sum(len(json.dumps({key: value})) for key, value in samples)
+        start = time.perf_counter()
+        for key, value in samples:
+            record(key, value)
+        recording += time.perf_counter() - start
+        if second % window == window - 1:
+            coalescer.flush()
+
+    stats = coalescer.stats()
+    delta_bytes = sum(len(json.dumps(message, separators=(",", ":"))) for message in messages)
+    print(f"{minutes} simulated minutes, {window}s window")
+    print(f"events in:    {stats['events']} ({stats['events'] / (minutes * 60):.1f}/s), {raw_bytes / 1024:.0f} KB as "
+          f"individual JSON messages")
+    print(f"messages out: {stats['messages']} ({stats['events'] / max(1, stats['messages']):.0f} events per message), "
+          f"{delta_bytes / 1024:.0f} KB")
+    print(f"tracked keys: {stats['keys']}, record: {recording * 1e9 / stats['events']:.0f} ns/event")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""Measures the G-code download cache against the stub OctoFarm: the first fetch of a file in Range requests, a fetch
+of the same file for the next print, which transfers nothing, and resuming a download interrupted half way.
+
+Run from the repository root: python -m benchmarks.file_cache [megabytes] [chunk_megabytes]
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import requests
+
+from octofarm_companion.file_cache import FileCache
+from tests.stub_octofarm import StubOctoFarmServer
+
+
+def main():
+    size = int(float(sys.argv[1] if len(sys.argv) > 1 else 64) * 1024 * 1024)
+    chunk_size = int(float(sys.argv[2] if len(sys.argv) > 2 else 4) * 1024 * 1024)
+    line = b"G1 X120.512 Y98.004 E0.03417\n"
+    data = line * (size // len(line))
+    server = StubOctoFarmServer().start()
+    sha256 = server.add_file(data)
+    token = server.issue_token()["access_token"]
+    session = requests.Session()
+    folder = tempfile.mkdtemp()
+
+    def get_range(start, end):
+        return session.get(f"{server.base_url}/octoprint/files/{sha256}", stream=True,
+                           headers={"Authorization": "Bearer " + token, "Range": f"bytes={start}-{end}"})
+
+    try:
+        cache = FileCache(folder, max_size=4 * size, chunk_size=chunk_size)
+        started = time.perf_counter()
+        cache.fetch(sha256, get_range)
+        first = time.perf_counter() - started
+        first_bytes = server.file_bytes
+
+        started = time.perf_counter()
+        cache.fetch(sha256, get_range)
+        again = time.perf_counter() - started
+        again_bytes = server.file_bytes - first_bytes
+
+        # An interruption after half of the chunks, then a restart
+        os.remove(cache.path(sha256))
+        cache = FileCache(folder, max_size=4 * size, chunk_size=chunk_size)
+        calls = []
+
+        def interrupted_range(start, end):
+            if len(calls) * 2 >= -(-len(data) // chunk_size):
+                raise ConnectionError()
+            calls.append(start)
+            return get_range(start, end)
+
+        try:
+            cache.fetch(sha256, interrupted_range)
+        except ConnectionError:
+            pass
+        before = server.file_bytes
+        started = time.perf_counter()
+        cache.fetch(sha256, get_range)
+        resumed = time.perf_counter() - started
+        resumed_bytes = server.file_bytes - before
+    finally:
+        server.stop()
+        shutil.rmtree(folder)
+
+    megabytes = len(data) / 1024 / 1024
+    print(f"first fetch:  {first:.3f} s for {megabytes:.1f} MB ({megabytes / first:.1f} MB/s), "
+          f"{first_bytes} bytes transferred")
+    print(f"next print:   {again * 1e3:.3f} ms, {again_bytes} bytes transferred")
+    print(f"resumed:      {resumed:.3f} s, {resumed_bytes} bytes transferred "
+          f"({100 * (1 - resumed_bytes / len(data)):.0f}% saved)")
+    print(cache.stats())
+
+
+if __name__ == "__main__":
+    main()
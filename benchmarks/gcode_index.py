@@ -0,0 +1,83 @@
+"""Measures indexing an uploaded G-code file: throughput in MB/s of the single pass over the mapped file, the size of
+the stored index and the memory used while indexing, which does not grow with the file.
+
+A sliced print is generated first: perimeters and infill of a square part in 0.2 mm layers, with retractions, Z hops,
+comments and a tool change every 50 layers.
+
+Run from the repository root: python -m benchmarks.gcode_index [size MB] [folder]
+"""
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from octofarm_companion.constants import Config
+from octofarm_companion.gcode_index import GcodeIndexStore, index_file
+
+
+def generate(path, size):
+    rng = random.Random(42)
+    # One layer of short moves, repeated with growing extrusion
+    moves = []
+    x, y = 100.0, 100.0
+    for move in range(2000):
+        x = min(190.0, max(10.0, x + rng.uniform(-5, 5)))
+        y = min(190.0, max(10.0, y + rng.uniform(-5, 5)))
+        moves.append((f"X{x:.3f} Y{y:.3f}", rng.uniform(0.01, 0.2), rng.choice((1800, 2400, 3600))))
+    e = 0.0
+    layer = 0
+    with open(path, "w") as f:
+        f.write("; generated by benchmarks.gcode_index\nG90\nM82\nM104 S210\nG28\nG92 E0\n")
+        while f.tell() < size:
+            layer += 1
+            if layer % 50 == 0:
+                f.write(f"T{layer // 50 % 2}\nG92 E0\n")
+                e = 0.0
+            lines = [f";LAYER:{layer}\nG1 Z{layer * 0.2 + 0.4:.2f} F9000\nG1 Z{layer * 0.2:.2f}\n"]
+            for move, (xy, extruded, feedrate) in enumerate(moves):
+                e += extruded
+                if move % 200 == 0:
+                    lines.append(f"G1 E{e - 0.8:.5f} F2400 ; retract\nG0 {xy} F9000\nG1 E{e:.5f} F2400\n")
+                lines.append(f"G1 {xy} E{e:.5f} F{feedrate}\n")
+            f.write("".join(lines))
+    return layer
+
+
+def main():
+    size = int(float(sys.argv[1]) * 1024 * 1024) if len(sys.argv) > 1 else 20 * 1024 * 1024
+    folder = tempfile.mkdtemp(dir=sys.argv[2] if len(sys.argv) > 2 else None)
+    try:
+        path = os.path.join(folder, "part.gcode")
+        layers = generate(path, size)
+        size = os.path.getsize(path)
+
+        started = time.perf_counter()
+        index = index_file(path)
+        elapsed = time.perf_counter() - started
+
+        # Python allocations only, the mapped file is paged in by the kernel and shared with the page cache
+        tracemalloc.start()
+        index_file(path)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        store = GcodeIndexStore(os.path.join(folder, Config.gcode_index_folder))
+        store.put("part.gcode", index)
+        stored = os.path.getsize(os.path.join(store.folder, index["sha256"] + ".json"))
+
+        print(f"{size / 1024 / 1024:.1f} MB, {index['lines']} lines, {layers} layers generated, "
+              f"{len(index['layers']['z'])} indexed")
+        print(f"index:  {size / 1024 / 1024 / elapsed:.1f} MB/s ({elapsed:.2f} s, "
+              f"slices of {Config.gcode_index_chunk_bytes // 1024} KB)")
+        print(f"memory: {peak / 1024 / 1024:.1f} MB peak")
+        print(f"stored: {stored / 1024:.1f} KB, estimated print time {index['estimatedTime'] / 3600:.1f} h, "
+              f"extruded {index['tools']}")
+    finally:
+        shutil.rmtree(folder)
+
+
+if __name__ == "__main__":
+    main()
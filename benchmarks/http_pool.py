@@ -0,0 +1,44 @@
+"""Compares TCP connections (TLS handshakes on HTTPS) per ping between bare requests calls and the pooled client.
+
+Run from the repository root: python -m benchmarks.http_pool [pings]
+"""
+import sys
+import time
+
+import requests
+
+from octofarm_companion.http_client import OctoFarmHttpClient
+from tests.stub_octofarm import StubOctoFarmServer
+
+
+def ping(post, base_url):
+    response = post(base_url + "/oidc/token", data={"grant_type": "client_credentials"}, auth=("id", "secret"))
+    headers = {"Authorization": "Bearer " + response.json()["access_token"]}
+    post(base_url + "/octoprint/announce", json={"deviceUuid": "bench"}, headers=headers)
+
+
+def run(name, pings, ping_once):
+    server = StubOctoFarmServer().start()
+    try:
+        start = time.perf_counter()
+        for i in range(pings):
+            ping_once(server.base_url)
+        elapsed = time.perf_counter() - start
+        print(f"{name:>7}: {pings} pings, {server.connections} connections, "
+              f"{server.connections / pings:.2f} handshakes/ping, {elapsed * 1000 / pings:.2f} ms/ping")
+    finally:
+        server.stop()
+
+
+def main():
+    pings = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    run("bare", pings, lambda base_url: ping(requests.post, base_url))
+    client = OctoFarmHttpClient()
+    try:
+        run("pooled", pings, lambda base_url: ping(client.post, base_url))
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    main()
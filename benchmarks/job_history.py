@@ -0,0 +1,79 @@
+"""Measures the job history: recording jobs, a first full export in cursor pages, an incremental sync after a few
+new jobs and the conditional request of an unchanged page, as OctoFarm would sync a printer.
+
+Run from the repository root: python -m benchmarks.job_history [jobs] [folder]
+"""
+import hashlib
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import uuid
+
+from octofarm_companion.constants import Config
+from octofarm_companion.job_history import JobHistory, DONE, FAILED
+
+
+def sync(history, cursor):
+    """Pages from 'cursor' until no more, returns the new cursor, the amount of jobs, pages and bytes"""
+    jobs = pages = size = 0
+    more = True
+    while more:
+        page = history.export(cursor, Config.job_history_max_page_size)
+        size += len(json.dumps(page))
+        cursor, more = page["cursor"], page["more"]
+        jobs += len(page["jobs"])
+        pages += 1
+    return cursor, jobs, pages, size
+
+
+def record(history, rng, files, count):
+    for i in range(count):
+        job_id = str(uuid.uuid4())
+        name = rng.choice(files)
+        history.start(job_id, name=name, path=name, origin="local", sha256=hashlib.sha256(name.encode()).hexdigest())
+        history.finish(job_id, DONE if rng.random() < 0.9 else FAILED, print_time=rng.uniform(600, 36000),
+                       extruded_mm=rng.uniform(500, 50000))
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    folder = tempfile.mkdtemp(dir=sys.argv[2] if len(sys.argv) > 2 else None)
+    rng = random.Random(42)
+    files = [f"parts/part-{i}.gcode" for i in range(200)]
+    try:
+        history = JobHistory(os.path.join(folder, Config.job_history_file))
+        started = time.perf_counter()
+        record(history, rng, files, count)
+        recording = time.perf_counter() - started
+
+        started = time.perf_counter()
+        cursor, jobs, pages, full_size = sync(history, 0)
+        full = time.perf_counter() - started
+
+        record(history, rng, files, 10)
+        started = time.perf_counter()
+        cursor, new_jobs, new_pages, new_size = sync(history, cursor)
+        incremental = time.perf_counter() - started
+
+        started = time.perf_counter()
+        for i in range(1000):
+            history.etag()
+        etag = (time.perf_counter() - started) / 1000
+        history.close()
+        database = sum(os.path.getsize(os.path.join(folder, name)) for name in os.listdir(folder))
+
+        print(f"record:      {count / recording:.0f} jobs/s (start and finish, WAL, synchronous=NORMAL)")
+        print(f"full sync:   {jobs} jobs in {pages} pages, {full * 1000:.1f} ms, {full_size / 1024:.0f} KB")
+        print(f"incremental: {new_jobs} jobs in {new_pages} page, {incremental * 1000:.2f} ms, {new_size} bytes")
+        print(f"unchanged:   {etag * 1e6:.0f} us for the ETag of a 304")
+        print(f"on disk:     {database / 1024:.0f} KB")
+    finally:
+        shutil.rmtree(folder)
+
+
+if __name__ == "__main__":
+    main()
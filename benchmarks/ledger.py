@@ -0,0 +1,66 @@
+"""Measures the filament usage ledger: append rate with its fsync, bytes on disk per record, compaction time and the
+size of a bulk sync payload compared to the same records as JSON.
+
+A simulated farm printer reports usage for two spools every minute of 8 hour prints, one job per print.
+
+Run from the repository root: python -m benchmarks.ledger [records] [folder]
+"""
+import base64
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import uuid
+
+from octofarm_companion.constants import Config
+from octofarm_companion.ledger import UsageLedger, record_format, record_size
+from octofarm_companion.telemetry import compress_batch
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    # Defaults to the temp folder, pass a folder on the SD card to measure its fsync
+    folder = tempfile.mkdtemp(dir=sys.argv[2] if len(sys.argv) > 2 else None)
+    rng = random.Random(42)
+    try:
+        ledger = UsageLedger(os.path.join(folder, "usage"), max_size=count * record_size * 2)
+        job_id = None
+        started = time.perf_counter()
+        for i in range(count // 2):
+            if i % 480 == 0:
+                job_id = str(uuid.uuid4())
+            ledger.append({"pla-red": rng.uniform(20, 60), "petg-blue": rng.uniform(0, 5)}, job_id)
+        elapsed = time.perf_counter() - started
+        stats = ledger.stats()
+
+        data, start, end = ledger.pending(limit=count)
+        document = {"from": start, "to": end, "recordFormat": record_format, "spools": ledger.spools(),
+                    "records": base64.b64encode(data).decode("ascii"), "compactedTotals": ledger.compacted_totals()}
+        as_json = {"from": start, "to": end, "records": ledger.decode(data)}
+        payload = len(compress_batch(document))
+        plain_json = len(json.dumps(as_json, separators=(",", ":")))
+        gzip_json = len(compress_batch(as_json))
+
+        ledger.ack(end)
+        started = time.perf_counter()
+        ledger.compact(min_records=0)
+        compaction = time.perf_counter() - started
+        ledger.close()
+
+        print(f"{stats['appended']} records in {count // 2} appends, {record_size} bytes per record")
+        print(f"append:     {count // 2 / elapsed:.0f} appends/s ({elapsed * 1e6 / (count // 2):.0f} us each, "
+              f"one fsync per append)")
+        print(f"on disk:    {stats['bytes'] / 1024:.1f} KB")
+        print(f"sync:       {payload / 1024:.1f} KB for {end - start} records "
+              f"(JSON {plain_json / 1024:.1f} KB, gzip JSON {gzip_json / 1024:.1f} KB), "
+              f"in batches of {Config.usage_sync_max_records} records")
+        print(f"compaction: {compaction * 1000:.1f} ms for {end - start} records")
+    finally:
+        shutil.rmtree(folder)
+
+
+if __name__ == "__main__":
+    main()
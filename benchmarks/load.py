@@ -0,0 +1,170 @@
+"""Runs N simulated companion plugins against a stub OctoFarm and reports the announce latency (p50/p99) per
+route, requests per second and the TCP connections the server accepted, to size OctoFarm for a large farm.
+
+Every round all instances run their periodic check at once, the worst case of a farm pinging in lockstep.
+Latency, errors and token expiry of the stub can be injected, see --help.
+
+Run from the repository root: python -m benchmarks.load [instances] [rounds]
+"""
+import argparse
+import logging
+import math
+import os
+import shutil
+import tempfile
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from octofarm_companion import OctoFarmCompanionPlugin
+from tests.stub_octofarm import StubOctoFarmServer
+
+
+class SimulatedSettings:
+    """The part of OctoPrint's PluginSettings the companion uses, backed by a dict"""
+
+    def __init__(self, values, server_port):
+        self._values = values
+        self._server_port = server_port
+
+    def get(self, path):
+        return self._values.get(path[0])
+
+    def get_int(self, path):
+        value = self.get(path)
+        return int(value) if value is not None else None
+
+    def get_float(self, path):
+        value = self.get(path)
+        return float(value) if value is not None else None
+
+    def global_get(self, path):
+        if path == ["server", "host"]:
+            return "127.0.0.1"
+        if path == ["server", "port"]:
+            return self._server_port
+        return None
+
+    def set(self, path, value):
+        self._values[path[0]] = value
+
+    def save(self):
+        pass
+
+
+def percentile(sorted_samples, percent):
+    if not sorted_samples:
+        return None
+    index = max(0, math.ceil(percent / 100 * len(sorted_samples)) - 1)
+    return sorted_samples[index]
+
+
+def create_plugin(index, base_url, data_folder, max_silence, logger):
+    host, port = base_url.rsplit(":", 1)
+    plugin = OctoFarmCompanionPlugin()
+    plugin._settings = SimulatedSettings(dict(
+        octofarm_host=host,
+        octofarm_port=int(port),
+        oidc_client_id=f"printer{index}",
+        oidc_client_secret="secret",
+        device_uuid=str(uuid.uuid4()),
+        announce_max_silence=max_silence,
+        ping=120,
+    ), server_port=5000 + index)
+    plugin._logger = logger
+    plugin._data_folder = os.path.join(data_folder, f"printer{index}")
+    plugin.initialize()
+    return plugin
+
+
+def record_latency(plugin, samples):
+    http_post = plugin._http_post
+
+    def timed_post(url, **kwargs):
+        started_at = time.perf_counter()
+        try:
+            return http_post(url, **kwargs)
+        finally:
+            # list.append is atomic, no lock needed across the check threads
+            samples.append((urlsplit(url).path.strip("/"), time.perf_counter() - started_at))
+
+    plugin._http_post = timed_post
+
+
+def run_load(instances=100, rounds=5, concurrency=64, latency=0.0, error_rate=0.0, token_expires_in=3600,
+             max_silence=0):
+    """Returns a report dict. A 'max_silence' of 0 makes every round after the first send a heartbeat."""
+    logger = logging.getLogger("octofarm_companion.load")
+    logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+
+    server = StubOctoFarmServer(latency=latency, error_rate=error_rate, token_expires_in=token_expires_in,
+                                seed=0).start()
+    data_folder = tempfile.mkdtemp()
+    samples = []
+    plugins = []
+    try:
+        for index in range(instances):
+            plugin = create_plugin(index, server.base_url, data_folder, max_silence, logger)
+            record_latency(plugin, samples)
+            plugins.append(plugin)
+
+        failed_checks = 0
+        started_at = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for round_number in range(rounds):
+                results = list(executor.map(lambda p: p._run_periodic_check(), plugins))
+                failed_checks += results.count(False)
+        duration = time.perf_counter() - started_at
+
+        routes = dict()
+        for route, seconds in samples:
+            routes.setdefault(route, []).append(seconds)
+        requests = server.total_requests()
+        return dict(
+            instances=instances,
+            rounds=rounds,
+            checks=instances * rounds,
+            failed_checks=failed_checks,
+            duration=duration,
+            requests=requests,
+            requests_per_second=requests / duration if duration else None,
+            connections=server.connections,
+            latency={route: dict(count=len(values), p50=percentile(sorted(values), 50),
+                                 p99=percentile(sorted(values), 99))
+                     for route, values in sorted(routes.items())}
+        )
+    finally:
+        for plugin in plugins:
+            plugin.on_shutdown()
+        server.stop()
+        shutil.rmtree(data_folder, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("instances", type=int, nargs="?", default=100)
+    parser.add_argument("rounds", type=int, nargs="?", default=5)
+    parser.add_argument("--concurrency", type=int, default=64, help="checks running at the same time")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds the stub delays each response")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests answered with a 503")
+    parser.add_argument("--token-expires-in", type=int, default=3600, help="token lifetime issued by the stub")
+    parser.add_argument("--max-silence", type=int, default=0,
+                        help="announce_max_silence of the instances, 0 sends a heartbeat every round")
+    args = parser.parse_args()
+
+    report = run_load(args.instances, args.rounds, concurrency=args.concurrency, latency=args.latency,
+                      error_rate=args.error_rate, token_expires_in=args.token_expires_in,
+                      max_silence=args.max_silence)
+    print(f"{report['instances']} instances, {report['rounds']} rounds: {report['checks']} checks "
+          f"({report['failed_checks']} failed) in {report['duration']:.2f}s")
+    print(f"{report['requests']} requests, {report['requests_per_second']:.1f} requests/s, "
+          f"{report['connections']} connections")
+    for route, stats in report["latency"].items():
+        print(f"{route:>20}: {stats['count']:>6} calls, p50 {stats['p50'] * 1000:.2f} ms, "
+              f"p99 {stats['p99'] * 1000:.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+"""Measures the cost of recording one latency sample in the metrics registry, in nanoseconds.
+
+Run from the repository root: python -m benchmarks.metrics [samples]
+"""
+import sys
+import time
+
+from octofarm_companion.metrics import MetricsRegistry
+
+
+def empty_call(operation, outcome, seconds):
+    pass
+
+
+def main():
+    samples = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    metrics = MetricsRegistry()
+    values = [(i % 1000) / 100.0 for i in range(1000)] * (samples // 1000 + 1)
+    values = values[:samples]
+    observe = metrics.observe
+
+    # A Python function call of the same shape, to compare the numbers across machines
+    start = time.perf_counter()
+    for value in values:
+        empty_call("announce", "success", value)
+    baseline = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for value in values:
+        observe("announce", "success", value)
+    elapsed = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for i in range(samples // 10):
+        with metrics.time("announce"):
+            pass
+    timed = time.perf_counter() - start
+
+    print(f"  empty: {baseline * 1e9 / samples:.0f} ns/call")
+    print(f"observe: {samples} samples, {elapsed * 1e9 / samples:.0f} ns/sample")
+    print(f"   time: {samples // 10} blocks, {timed * 1e9 / (samples // 10):.0f} ns/block (incl. two clock reads)")
+
+
+if __name__ == "__main__":
+    main()
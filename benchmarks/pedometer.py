@@ -0,0 +1,44 @@
+"""Measures the filament pedometer G-code hook throughput in lines per second.
+
+Run from the repository root: python -m benchmarks.pedometer [lines]
+"""
+import sys
+import time
+
+from octoprint.util.comm import gcode_command_for_cmd
+
+from octofarm_companion.pedometer import FilamentPedometer
+
+
+def generate_lines(count):
+    # Typical slicer output: mostly extruding moves, some travels, retractions and layer changes
+    pattern = []
+    e = 0.0
+    for i in range(100):
+        e += 0.03
+        pattern.append(f"G1 X{100 + i * 0.1:.3f} Y{100 - i * 0.1:.3f} E{e:.5f}")
+    pattern += ["G1 E{:.5f} F2400".format(e - 0.8), "G0 F9000 X120.5 Y80.2", "G1 E{:.5f} F2400".format(e),
+                "G1 Z0.4 F600", "M106 S255", "G92 E0", "M204 S1000"]
+    lines = (pattern * (count // len(pattern) + 1))[:count]
+    # OctoPrint parses the command name once before calling the hook
+    return [(gcode_command_for_cmd(line), line) for line in lines]
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    lines = generate_lines(count)
+    pedometer = FilamentPedometer()
+    pedometer.start_job("benchmark")
+    on_gcode_sent = pedometer.on_gcode_sent
+
+    start = time.perf_counter()
+    for gcode, cmd in lines:
+        on_gcode_sent(gcode, cmd)
+    elapsed = time.perf_counter() - start
+
+    print(f"{count} lines in {elapsed:.3f}s: {count / elapsed:,.0f} lines/s, "
+          f"{elapsed * 1e9 / count:.0f} ns/line, job extruded {pedometer.job_extruded:.1f}mm")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""Measures handing one G-code file to a farm of companions on localhost: every companion downloading it from the stub
+OctoFarm, against one companion downloading it and the others fetching it from that companion with OctoFarm's seed
+list, signed as a peer grant. OctoFarm's uplink is limited to 'uplink' MB/s shared by all downloads, the LAN between
+companions is not.
+
+Run from the repository root: python -m benchmarks.peer_distribution [companions] [megabytes] [uplink MB/s]
+"""
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest.mock as mock
+
+import flask
+from werkzeug.serving import make_server
+
+import octofarm_companion
+from tests.stub_octofarm import StubOctoFarmServer
+from tests.utils import create_rsa_key, mock_plugin
+
+
+class Companion:
+    def __init__(self, server):
+        self.folder = tempfile.mkdtemp()
+        settings = dict(octofarm_host="http://127.0.0.1", octofarm_port=server.server_address[1],
+                        oidc_client_id="client", oidc_client_secret="secret")
+        self.plugin = mock_plugin(self.folder, lambda path: settings.get(path[0]))
+        self.plugin._identifier = "octofarm_companion"
+        self.plugin._basefolder = os.path.dirname(octofarm_companion.__file__)
+        self.plugin._file_manager = mock.MagicMock()
+        self.plugin.initialize()
+
+        self.app = flask.Flask(__name__)
+        self.app.register_blueprint(self.plugin.get_blueprint(), url_prefix="/plugin/octofarm_companion")
+        self.http_server = make_server("127.0.0.1", 0, self.app, threaded=True)
+        threading.Thread(target=self.http_server.serve_forever, args=(0.05,), daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.http_server.server_port}/plugin/octofarm_companion/"
+
+    def fetch(self, sha256, grant=None):
+        data = json.dumps(dict(sha256=sha256, path="farm/benchmark.gcode", grant=grant))
+        with self.app.test_request_context("/fetch_file", method="POST", data=data):
+            self.plugin.fetch_file()
+
+    def wait(self):
+        self.plugin._download_workers.shutdown(wait=True)
+        self.plugin._download_workers = None
+
+    def close(self):
+        self.http_server.shutdown()
+        self.plugin.on_shutdown()
+        shutil.rmtree(self.folder)
+
+
+def distribute(server, sha256, count, peer_to_peer):
+    companions = [Companion(server) for i in range(count)]
+    before = server.file_bytes
+    started = time.perf_counter()
+    try:
+        if peer_to_peer:
+            # OctoFarm hands the first companion no seeds, the others get it as their seed
+            companions[0].fetch(sha256)
+            companions[0].wait()
+            grant = server.issue_grant(sha256, [companions[0].url], audience=["client"])
+            for companion in companions[1:]:
+                companion.fetch(sha256, grant=grant)
+        else:
+            for companion in companions:
+                companion.fetch(sha256)
+        for companion in companions:
+            if companion.plugin._download_workers is not None:
+                companion.wait()
+        elapsed = time.perf_counter() - started
+        assert all(companion.plugin._file_cache.path(sha256) for companion in companions)
+    finally:
+        for companion in companions:
+            companion.close()
+    return elapsed, server.file_bytes - before
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    size = int(float(sys.argv[2] if len(sys.argv) > 2 else 16) * 1024 * 1024)
+    uplink = float(sys.argv[3]) if len(sys.argv) > 3 else 16
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    line = b"G1 X120.512 Y98.004 E0.03417\n"
+    data = line * (size // len(line))
+    server = StubOctoFarmServer(upload_rate=uplink * 1024 * 1024, signing_key=create_rsa_key()).start()
+    sha256 = server.add_file(data)
+    try:
+        direct = distribute(server, sha256, count, peer_to_peer=False)
+        peers = distribute(server, sha256, count, peer_to_peer=True)
+    finally:
+        server.stop()
+
+    megabytes = len(data) / 1024 / 1024
+    print(f"{count} companions, {megabytes:.1f} MB file, OctoFarm uplink {uplink:.0f} MB/s")
+    print(f"direct from OctoFarm: {direct[0]:.2f} s, {direct[1] / 1024 / 1024:.1f} MB from OctoFarm")
+    print(f"peer-to-peer:         {peers[0]:.2f} s, {peers[1] / 1024 / 1024:.1f} MB from OctoFarm "
+          f"({direct[0] / peers[0]:.1f}x faster)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""Measures what the plugin adds to OctoPrint's startup: importing it, 'initialize' and 'on_after_startup'.
+
+Every run is a fresh interpreter which first imports the OctoPrint server, like OctoPrint does before it loads
+plugins, so only the plugin's own imports are counted. The package is byte-compiled first, like pip does when it
+installs the plugin. The median total is checked against a budget, the exit code is 1 when it is exceeded or when
+OctoFarm is contacted or the environment probed on the startup path.
+
+Run from the repository root: python -m benchmarks.startup [runs] [budget milliseconds]
+"""
+import compileall
+import json
+import logging
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+default_budget_ms = 50
+
+
+class StartupSettings:
+    """The settings of a fresh install"""
+
+    def __init__(self, defaults):
+        self.values = dict(defaults)
+
+    def get(self, path):
+        return self.values.get(path[0])
+
+    def get_int(self, path):
+        value = self.get(path)
+        return int(value) if value is not None else None
+
+    def get_float(self, path):
+        value = self.get(path)
+        return float(value) if value is not None else None
+
+    def global_get(self, path):
+        return dict(host="0.0.0.0", port=5000).get(path[-1])
+
+    def set(self, path, value):
+        self.values[path[0]] = value
+
+    def save(self):
+        pass
+
+
+def measure():
+    import octoprint.server  # noqa: F401, loaded by OctoPrint before any plugin
+
+    started = time.perf_counter()
+    from octofarm_companion import OctoFarmCompanionPlugin
+    plugin = OctoFarmCompanionPlugin()
+    imported = time.perf_counter()
+
+    plugin._settings = StartupSettings(plugin.get_settings_defaults())
+    plugin._logger = logging.getLogger("octofarm_companion")
+    # Records whether the check ran on the thread starting OctoPrint, without contacting any OctoFarm
+    checks = []
+    plugin._run_periodic_check = lambda: checks.append(threading.current_thread() is threading.main_thread())
+    with tempfile.TemporaryDirectory() as data_folder:
+        plugin._data_folder = data_folder
+        plugin.initialize()
+        initialized = time.perf_counter()
+        plugin.on_after_startup()
+        after_startup = time.perf_counter()
+
+        checked = any(checks) or plugin._environment.stats()["probes"] > 0
+        plugin.on_shutdown()
+    return dict(import_ms=(imported - started) * 1000, initialize_ms=(initialized - imported) * 1000,
+                after_startup_ms=(after_startup - initialized) * 1000, total_ms=(after_startup - started) * 1000,
+                checked_on_startup=checked, modules=[name for name in ("websocket", "octofarm_companion.tunnel")
+                                                     if name in sys.modules])
+
+
+def main():
+    if sys.argv[1:] == ["--child"]:
+        print(json.dumps(measure()))
+        return
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    budget_ms = float(sys.argv[2]) if len(sys.argv) > 2 else default_budget_ms
+    compileall.compile_dir("octofarm_companion", quiet=1)
+
+    results = []
+    for run in range(runs):
+        output = subprocess.run([sys.executable, "-m", "benchmarks.startup", "--child"], check=True,
+                                capture_output=True, text=True).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+
+    print(f"{runs} runs, median of each phase")
+    for phase in ("import_ms", "initialize_ms", "after_startup_ms", "total_ms"):
+        print(f"{phase[:-3]:<14} {statistics.median(result[phase] for result in results):7.1f} ms")
+    print(f"network stack loaded at startup: {results[0]['modules'] or 'none'}")
+    print(f"OctoFarm checked on the startup path: {any(result['checked_on_startup'] for result in results)}")
+
+    total_ms = statistics.median(result["total_ms"] for result in results)
+    if total_ms > budget_ms or any(result["checked_on_startup"] for result in results):
+        print(f"over budget: {total_ms:.1f} ms, budget {budget_ms:.0f} ms, or work on the startup path")
+        sys.exit(1)
+    print(f"within budget: {total_ms:.1f} ms <= {budget_ms:.0f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+"""Measures verifying OctoFarm's tokens on inbound requests: the first request with a token, which checks its RSA
+signature, repeated requests with the same token answered from the memo, and the JWKS fetches for a farm of clients.
+
+Run from the repository root: python -m benchmarks.token_verifier [requests] [tokens]
+"""
+import sys
+import time
+
+from octofarm_companion.token_verifier import TokenVerifier
+from tests.utils import create_jwk, create_jwt, create_rsa_key
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    token_count = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    key = create_rsa_key(2048)
+    fetches = []
+
+    def fetch_jwks():
+        fetches.append(time.time())
+        return dict(keys=[create_jwk(key, "key-1")])
+
+    expires = int(time.time()) + 3600
+    tokens = [create_jwt(key, dict(sub=f"client-{i}", aud="octoprint", exp=expires), "key-1")
+              for i in range(token_count)]
+    verifier = TokenVerifier(fetch_jwks, audience="octoprint")
+
+    started = time.perf_counter()
+    for token in tokens:
+        verifier.verify(token)
+    first = (time.perf_counter() - started) / token_count
+
+    started = time.perf_counter()
+    for i in range(count):
+        verifier.verify(tokens[i % token_count])
+    memoized = (time.perf_counter() - started) / count
+
+    print(f"first request:  {first * 1e6:.0f} us per token (RS256, 2048 bit key)")
+    print(f"memoized:       {memoized * 1e6:.1f} us per request, {count} requests with {token_count} tokens")
+    print(f"JWKS fetches:   {len(fetches)}")
+    print(verifier.stats())
+
+
+if __name__ == "__main__":
+    main()
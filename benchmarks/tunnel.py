@@ -0,0 +1,100 @@
+"""Compares OctoFarm reaching a local OctoPrint stub through the tunnel with reaching it over direct HTTP: request
+latency (p50/p99) of a small API call, and download and upload throughput of a large body.
+
+Direct requests reuse one keep-alive connection, as OctoFarm would when it can reach the printer itself.
+
+Run from the repository root: python -m benchmarks.tunnel [requests] [megabytes]
+"""
+import sys
+import threading
+import time
+
+import requests
+
+from benchmarks.load import percentile
+from octofarm_companion.tunnel import TunnelClient
+from tests.stub_octoprint import StubOctoPrintServer
+from tests.stub_tunnel import StubTunnelServer
+
+
+def measure_latency(call, count):
+    samples = []
+    for i in range(count):
+        start = time.perf_counter()
+        call()
+        samples.append(time.perf_counter() - start)
+    samples.sort()
+    return percentile(samples, 50), percentile(samples, 99)
+
+
+def measure_throughput(call, size):
+    start = time.perf_counter()
+    call()
+    return size / (time.perf_counter() - start) / (1024 * 1024)
+
+
+def concurrently(call, workers=8):
+    threads = [threading.Thread(target=call) for i in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    size = (int(sys.argv[2]) if len(sys.argv) > 2 else 32) * 1024 * 1024
+
+    octoprint = StubOctoPrintServer().start()
+    farm = StubTunnelServer().start()
+    client = TunnelClient(lambda: (farm.url, {}), octoprint.base_url)
+    client.start()
+    http = requests.Session()
+    try:
+        if not farm.wait_connected():
+            raise Exception("The tunnel did not connect to the stub OctoFarm")
+        blob_path = f"/api/files/blob?size={size}"
+        upload = octoprint.blob(size)
+
+        def direct_version():
+            http.get(octoprint.base_url + "/api/version").content
+
+        def direct_download():
+            assert len(http.get(octoprint.base_url + blob_path).content) == size
+
+        def direct_upload():
+            assert len(http.post(octoprint.base_url + "/api/echo", data=upload).content) == size
+
+        def tunnel_version():
+            farm.request("GET", "/api/version")
+
+        def tunnel_download():
+            assert len(farm.request("GET", blob_path)[2]) == size
+
+        def tunnel_upload():
+            assert len(farm.request("POST", "/api/echo", body=upload)[2]) == size
+
+        print(f"{count} requests, {size // (1024 * 1024)} MB bodies")
+        for name, version, download, upload_call in (("direct", direct_version, direct_download, direct_upload),
+                                                     ("tunnel", tunnel_version, tunnel_download, tunnel_upload)):
+            # Warms connections and the blob cache of the stub
+            version()
+            download()
+            p50, p99 = measure_latency(version, count)
+            down = measure_throughput(download, size)
+            up = measure_throughput(upload_call, size * 2)
+            batch_p50, batch_p99 = measure_latency(lambda: concurrently(version), max(1, count // 8))
+            print(f"{name}: latency p50 {p50 * 1000:.2f} ms, p99 {p99 * 1000:.2f} ms, "
+                  f"download {down:.1f} MB/s, upload+echo {up:.1f} MB/s, "
+                  f"8 concurrent calls p50 {batch_p50 * 1000:.2f} ms, p99 {batch_p99 * 1000:.2f} ms")
+
+        print(f"tunnel session: {client.stats()}")
+    finally:
+        http.close()
+        client.stop()
+        farm.stop()
+        octoprint.stop()
+
+
+if __name__ == "__main__":
+    main()
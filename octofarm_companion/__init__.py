@@ -1,34 +1,85 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, unicode_literals
 
-import io
+import base64
+import concurrent.futures
 import json
 import os
-import uuid
-from datetime import datetime
+import time
+from threading import Lock
 from urllib.parse import urljoin
 
 import flask
 import octoprint.plugin
-import requests
+from octoprint.events import Events
+from octoprint.filemanager.destinations import FileDestinations
+from octoprint.filemanager.util import DiskFileWrapper
 from flask import request
-from octoprint.util import RepeatedTimer
 
+from octofarm_companion.announcement import AnnouncementTracker, fingerprint
+from octofarm_companion.coalescer import EventCoalescer
 from octofarm_companion.constants import Errors, State, Config, Keys
-
-
-def is_docker():
-    path = '/proc/self/cgroup'
-    return (
-            os.path.exists('/.dockerenv') or
-            os.path.isfile(path) and any('docker' in line for line in open(path))
-    )
+from octofarm_companion.diagnostics import ConnectionDiagnostics, TIMEOUT as DIAGNOSTICS_TIMEOUT
+from octofarm_companion.discovery import AddressDiscovery
+from octofarm_companion.environment import EnvironmentSnapshot
+from octofarm_companion.file_cache import FileCache, PeerRanges
+from octofarm_companion.gcode_index import GcodeIndexStore, index_buffer, is_sha256, map_file
+from octofarm_companion.job_history import JobHistory, DONE, FAILED
+from octofarm_companion.ledger import UsageLedger, record_format
+from octofarm_companion.metrics import MetricsRegistry, TIMEOUT, outcome_for_status
+from octofarm_companion.network import NetworkEngine, NetworkTimeoutError, NetworkStoppedError
+from octofarm_companion.outbox import DurableOutbox, RateLimiter
+from octofarm_companion.pedometer import FilamentPedometer
+from octofarm_companion.persistence import JsonFileStore
+from octofarm_companion.scheduler import BackoffScheduler
+from octofarm_companion.state_push import StatePublisher
+from octofarm_companion.targets import OctoFarmTarget
+from octofarm_companion.telemetry import TelemetryUplink, compress_batch
+from octofarm_companion.token_manager import utc_timestamp
+from octofarm_companion.token_verifier import TokenVerifier, TokenVerificationError, has_scope, is_jwt
 
 
 octofarm_announce_route = 'octoprint/announce'
+octofarm_heartbeat_route = 'octoprint/heartbeat'
+octofarm_telemetry_route = 'octoprint/telemetry'
+octofarm_tunnel_route = 'octoprint/tunnel'
+octofarm_usage_route = 'octoprint/usage'
+octofarm_files_route = 'octoprint/files/'
+peer_files_route = 'files/'
+# Job events pushed to OctoFarm as the 'job' state
+pushed_job_events = {
+    Events.PRINT_STARTED: "started",
+    Events.PRINT_PAUSED: "paused",
+    Events.PRINT_RESUMED: "resumed",
+    Events.PRINT_DONE: "done",
+    Events.PRINT_FAILED: "failed",
+    Events.PRINT_CANCELLED: "cancelled",
+}
+position_axes = ("x", "y", "z", "e", "f", "t")
 octofarm_access_token_route = 'oidc/token'
 octofarm_version_route = 'serverChecks/version'
+octofarm_jwks_route = 'oidc/jwks'
 requested_scopes = 'openid'
+# Make the plugin send the credentials of the request to the URL of the request, only for who may manage settings
+settings_routes = ("test_octofarm_connection", "test_octofarm_openid")
+# Scope an OctoFarm token needs per route, the read scope for other GET routes and the write scope for the rest
+token_read_scope = "companion:read"
+token_write_scope = "companion:write"
+token_peer_scope = "companion:peer"
+token_route_scopes = {"fetch_file": "companion:files", "get_cached_file": token_peer_scope}
+
+
+# The HTTP client (requests), the tunnel (websocket-client) and uuid are imported on first use, which is after
+# OctoPrint started: the first check is delayed, the tunnel is opt-in and the device UUID is created once.
+def _new_uuid():
+    import uuid
+    return str(uuid.uuid4())
+
+
+def _connection_errors():
+    """Errors after which OctoFarm is retried with backoff"""
+    from requests.exceptions import ConnectionError
+    return ConnectionError, NetworkTimeoutError, NetworkStoppedError
 
 
 class OctoFarmCompanionPlugin(
@@ -38,13 +89,53 @@ class OctoFarmCompanionPlugin(
     octoprint.plugin.BlueprintPlugin,
     octoprint.plugin.SettingsPlugin,
     octoprint.plugin.AssetPlugin,
+    octoprint.plugin.EventHandlerPlugin,
+    octoprint.plugin.ProgressPlugin,
 ):
     def __init__(self):
         self._ping_worker = None
+        self._http_client = None
+        self._network = NetworkEngine()
+        self._metrics = MetricsRegistry()
+        # OctoFarm servers with their own token and state, built from the settings on first use
+        self._targets = []
+        self._targets_lock = Lock()
+        self._fanout_pool = None
+        self._tunnel = None
+        # Printer state pushed over the tunnel, kept up to date before it connects
+        self._state_publisher = StatePublisher(self._push_state)
+        # Temperature, position and Z samples, summarized per window into telemetry
+        self._coalescer = EventCoalescer(self._emit_samples)
+        self._coalesce_worker = None
+        # Container runtime, announced host and port, probed at startup instead of on every ping
+        self._environment = EnvironmentSnapshot(self._read_environment_settings)
+        self._discovery = AddressDiscovery()
+        # Connection test of the settings page, repeated clicks are answered from its cache
+        self._diagnostics = ConnectionDiagnostics(self._fetch_version, self._fetch_test_token)
+        # OctoFarm's tokens on inbound requests, verified with its cached public keys
+        self._token_verifier = TokenVerifier(self._fetch_jwks)
+        self._pedometer = FilamentPedometer()
+        # Created at initialize, as it lives in the plugin data folder
+        self._ledger = None
+        # Created at initialize, uploads are indexed by a single background worker created on the first upload
+        self._gcode_index = None
+        self._index_worker = None
+        # Created at initialize, as it lives in the plugin data folder
+        self._job_history = None
+        # Created at initialize, files are downloaded by background workers created on the first fetch
+        self._file_cache = None
+        self._download_workers = None
+        self._telemetry = TelemetryUplink(self._send_telemetry_batch, spill=self._spill_to_outbox)
+        # Created at initialize, as it lives in the plugin data folder
+        self._outbox = None
+        self._replay_limiter = None
+        # Latest failed announcement per target, an older one is stale and not replayed
+        self._pending_announcements = dict()
         # device UUID and OIDC opaque access_token + metadata
         self._persisted_data = dict()
         self._excluded_persistence_datapath = None
-        self._state = State.BOOT
+        self._persistence_store = None
+        self._persistence_lock = Lock()
 
     def on_after_startup(self):
         if self._settings.get(["octofarm_host"]) is None:
@@ -52,7 +143,11 @@ class OctoFarmCompanionPlugin(
         if self._settings.get(["octofarm_port"]) is None:
             self._settings.set(["octofarm_port"], Config.default_octofarm_port)
         self._get_device_uuid()
+        # The environment is probed by the first check, resolving the hostname may block on a slow DNS server
         self._start_periodic_check()
+        self._telemetry.start()
+        self._start_coalescing()
+        self._start_tunnel()
 
     def get_excluded_persistence_datapath(self):
         self._excluded_persistence_datapath = os.path.join(self.get_plugin_data_folder(),
@@ -81,9 +176,359 @@ class OctoFarmCompanionPlugin(
             "device_uuid": None,  # Auto-generated and unique
             "oidc_client_id": None,  # Without adjustment this config value is ALWAYS useless
             "oidc_client_secret": None,  # Without adjustment this config value is ALWAYS useless
-            "ping": Config.default_ping_secs
+            # Replaces the single server above when set, entries with name, host, port, oidc_client_id and
+            # oidc_client_secret. The first entry also receives the telemetry.
+            "octofarm_targets": [],
+            "fanout_workers": Config.default_fanout_workers,
+            "ping": Config.default_ping_secs,
+            "backoff_base": Config.default_backoff_base_secs,
+            "backoff_max": Config.default_backoff_max_secs,
+            "initial_delay_max": Config.default_initial_delay_max_secs,
+            "token_refresh_margin": Config.default_token_refresh_margin_secs,
+            "announce_max_silence": Config.default_announce_max_silence_secs,
+            "http_pool_size": Config.default_http_pool_size,
+            "http_connect_timeout": Config.default_http_connect_timeout,
+            "http_read_timeout": Config.default_http_read_timeout,
+            "http_retries": Config.default_http_retries,
+            "request_deadline": Config.default_request_deadline_secs,
+            "spool_ids": [],  # Spool identifier per tool index, unset tools are reported as 'tool<index>'
+            "telemetry_capacity": Config.default_telemetry_capacity,
+            "telemetry_batch_size": Config.default_telemetry_batch_size,
+            "telemetry_max_age": Config.default_telemetry_max_age_secs,
+            "outbox_max_size_mb": Config.default_outbox_max_bytes // (1024 * 1024),
+            "outbox_replay_rate": Config.default_outbox_replay_rate,
+            "tunnel_enabled": False,  # Lets OctoFarm reach this OctoPrint through a connection opened from here
+            "tunnel_max_streams": Config.default_tunnel_max_streams,
+            "state_push_rate": Config.default_state_push_rate,
+            "state_progress_step": Config.default_state_progress_step,
+            "coalesce_window": Config.default_coalesce_window_secs,
+            "file_cache_max_size_mb": Config.default_file_cache_max_bytes // (1024 * 1024),
+            "oidc_issuer": None,  # The 'iss' of OctoFarm's tokens, checked when set
+            "oidc_audience": None  # The 'aud' OctoFarm's tokens for this OctoPrint carry, checked when set
         }
 
+    def on_settings_save(self, data):
+        diff = super().on_settings_save(data)
+        self._environment.invalidate()
+        self._discovery.invalidate()
+        self._close_http_client()
+        self._apply_spool_ids()
+        self._apply_token_settings()
+        self._token_verifier.invalidate()
+        return diff
+
+    def on_event(self, event, payload):
+        if event == Events.POSITION_UPDATE:
+            # Several per second while printing, only the window summary is sent
+            return self._coalescer.record_all("position", payload, position_axes)
+        if event == Events.Z_CHANGE:
+            return self._coalescer.record("z", payload.get("new"))
+        if event in (Events.SETTINGS_UPDATED, Events.CONNECTIVITY_CHANGED):
+            # server:host or port may have changed through the API, or the machine got another address
+            self._environment.invalidate()
+            self._discovery.invalidate()
+        self._publish_state(event, payload)
+        if event == Events.PRINT_STARTED:
+            # Extruded before the job, f.e. by a purge from the terminal, is not attributed to it
+            self._record_usage()
+            self._pedometer.start_job(_new_uuid())
+            self._emit_job_event(event, payload, self._pedometer.job_id)
+            self._record_job_start(self._pedometer.job_id, payload)
+        elif event in (Events.PRINT_DONE, Events.PRINT_FAILED):
+            self._record_usage()
+            job_usage = self._pedometer.finish_job()
+            if job_usage is not None:
+                self._logger.info(f"Filament used by job {job_usage['job_id']}: {job_usage['extruded_mm']}mm")
+                if self._job_history is not None:
+                    self._job_history.finish(job_usage["job_id"], DONE if event == Events.PRINT_DONE else FAILED,
+                                             print_time=payload.get("time"), reason=payload.get("reason"),
+                                             extruded_mm=job_usage["extruded_mm"])
+                self._emit_job_event(event, payload, job_usage["job_id"])
+                self._telemetry.emit("filament", {
+                    "jobId": job_usage["job_id"],
+                    "extrudedMm": job_usage["extruded_mm"],
+                    "spools": self._pedometer.spool_usage()
+                })
+        elif event == Events.PRINTER_STATE_CHANGED:
+            # Only the latest state matters, pending state changes are coalesced
+            self._telemetry.emit("printerState", {"state": payload.get("state_id")}, key="printerState")
+        elif event == Events.FILE_REMOVED and self._gcode_index is not None:
+            if payload.get("storage") == "local":
+                self._gcode_index.remove(payload.get("path"))
+        elif event == Events.FILE_MOVED and self._gcode_index is not None:
+            if payload.get("storage") == "local" and payload.get("destination_storage") == "local":
+                self._gcode_index.move(payload.get("source_path"), payload.get("destination_path"))
+
+    def _record_job_start(self, job_id, payload):
+        if self._job_history is None:
+            return
+        path = payload.get("path")
+        sha256 = None
+        if payload.get("origin") == "local" and self._gcode_index is not None:
+            # Uploaded files are indexed by content, OctoFarm recognizes the same file under other names
+            sha256 = self._gcode_index.sha256_of(path)
+        self._job_history.start(job_id, name=payload.get("name"), path=path, origin=payload.get("origin"),
+                                sha256=sha256)
+
+    def _publish_state(self, event, payload):
+        payload = payload or {}
+        if event in (Events.CONNECTED, Events.DISCONNECTED):
+            self._state_publisher.update("connection", "connected" if event == Events.CONNECTED else "disconnected")
+        elif event == Events.PRINTER_STATE_CHANGED:
+            self._state_publisher.update("state", payload.get("state_id"))
+        elif event == Events.ERROR:
+            self._state_publisher.update("error", payload.get("error"))
+        elif event in pushed_job_events:
+            self._state_publisher.update("job", dict(event=pushed_job_events[event], name=payload.get("name"),
+                                                     origin=payload.get("origin")))
+            if event == Events.PRINT_STARTED:
+                self._state_publisher.update("progress", 0)
+                self._state_publisher.update("error", None)
+
+    def on_print_progress(self, storage, path, progress):
+        # Coarse steps, OctoFarm does not need every percent of every printer
+        step = self._settings.get_int(["state_progress_step"]) or Config.default_state_progress_step
+        self._state_publisher.update("progress", progress - progress % step)
+
+    def _push_state(self, message):
+        return self._tunnel is not None and self._tunnel.push_state(message)
+
+    def temperatures_received_hook(self, comm_instance, parsed_temperatures, *args, **kwargs):
+        for heater, (actual, target) in parsed_temperatures.items():
+            if actual is not None:
+                self._coalescer.record(f"temperature.{heater}.actual", actual)
+            if target is not None:
+                self._coalescer.record(f"temperature.{heater}.target", target)
+        return parsed_temperatures
+
+    def _start_coalescing(self):
+        if self._coalesce_worker is None:
+            window = self._settings.get_int(["coalesce_window"])
+            self._coalesce_worker = BackoffScheduler(self._coalescer.flush,
+                                                     window or Config.default_coalesce_window_secs,
+                                                     initial_delay_max=0)
+            self._coalesce_worker.start()
+
+    def _emit_samples(self, delta):
+        self._telemetry.emit("samples", delta)
+
+    def _emit_job_event(self, event, payload, job_id):
+        self._telemetry.emit("job", {
+            "event": event,
+            "jobId": job_id,
+            "name": payload.get("name"),
+            "origin": payload.get("origin"),
+            "time": payload.get("time"),
+            "reason": payload.get("reason")
+        })
+
+    def gcode_sent_hook(self, comm_instance, phase, cmd, cmd_type, gcode, *args, **kwargs):
+        self._pedometer.on_gcode_sent(gcode, cmd)
+
+    def gcode_preprocessor_hook(self, path, file_object, *args, **kwargs):
+        # Only uploads buffered to disk are indexed, streamed ones like slicer output would have to be read twice
+        if self._gcode_index is None or not getattr(file_object, "path", None) \
+                or not path.lower().endswith(Config.gcode_extensions):
+            return file_object
+        try:
+            # Mapped before OctoPrint moves the upload into the storage, the mapping follows the file
+            mapping = map_file(file_object.path)
+        except (OSError, ValueError) as e:
+            self._logger.warning(f"Could not map upload {path} for indexing: {e}")
+            return file_object
+        self._get_index_worker().submit(self._index_gcode, path, mapping)
+        return file_object
+
+    def _get_index_worker(self):
+        if self._index_worker is None:
+            self._index_worker = concurrent.futures.ThreadPoolExecutor(max_workers=1,
+                                                                       thread_name_prefix="OctoFarmCompanionIndex")
+        return self._index_worker
+
+    def _index_gcode(self, path, mapping):
+        try:
+            with self._metrics.time("gcode_index"):
+                index = index_buffer(mapping)
+            self._gcode_index.put(path, index)
+        except Exception as e:
+            self._gcode_index.failed()
+            self._logger.error(f"Indexing {path} failed: {e}")
+            return
+        finally:
+            if not isinstance(mapping, bytes):
+                mapping.close()
+        self._logger.info(f"Indexed {path}: {index['size']} bytes, {len(index['layers']['z'])} layers")
+        self._telemetry.emit("gcodeIndex", {
+            "path": path,
+            "sha256": index["sha256"],
+            "size": index["size"],
+            "estimatedTime": index["estimatedTime"],
+            "tools": index["tools"]
+        })
+
+    def _get_download_workers(self):
+        if self._download_workers is None:
+            self._download_workers = concurrent.futures.ThreadPoolExecutor(
+                max_workers=Config.file_cache_download_workers, thread_name_prefix="OctoFarmCompanionDownload")
+        return self._download_workers
+
+    def _fetch_file(self, sha256, path, peers=(), grant=None):
+        """Gets the file with 'sha256' from the cache, the 'peers' or OctoFarm and adds it to OctoPrint's local
+        storage. The peers are asked with OctoFarm's 'grant' for this file"""
+        started = time.monotonic()
+        downloaded = self._file_cache.stats()["downloaded_bytes"]
+        ranges = PeerRanges(peers, lambda peer, start, end: self._get_peer_range(peer, sha256, grant, start, end),
+                            lambda start, end: self._get_file_range(sha256, start, end))
+        try:
+            try:
+                cache_path = self._file_cache.fetch(sha256, ranges)
+            except Exception as e:
+                if not peers:
+                    raise
+                # A peer sent something else or broke off while streaming, OctoFarm's copy is the reference. The
+                # part file of a broken off download is kept, only the rest comes from OctoFarm.
+                self._logger.warning(f"Fetching file {sha256} from peers failed, downloading it from OctoFarm: {e}")
+                ranges.peers = []
+                cache_path = self._file_cache.fetch(sha256, ranges)
+            # Copied, the cached file stays for the next print
+            self._file_manager.add_file(FileDestinations.LOCAL, path,
+                                        DiskFileWrapper(os.path.basename(path), cache_path, move=False),
+                                        allow_overwrite=True)
+        except Exception as e:
+            self._logger.error(f"Fetching file {sha256} to {path} failed: {e}")
+            self._telemetry.emit("fileFetch", {"sha256": sha256, "path": path, "error": str(e)})
+            return False
+        self._telemetry.emit("fileFetch", {
+            "sha256": sha256,
+            "path": path,
+            "downloadedBytes": self._file_cache.stats()["downloaded_bytes"] - downloaded,
+            "peerBytes": ranges.peer_bytes,
+            "serverBytes": ranges.server_bytes,
+            "seconds": round(time.monotonic() - started, 3)
+        })
+        return True
+
+    def _get_file_range(self, sha256, start, end):
+        target, headers = self._get_range_headers(start, end)
+        return self._http_get(urljoin(target.base_url, octofarm_files_route + sha256), operation="file_download",
+                              headers=headers, stream=True)
+
+    def _get_peer_range(self, peer, sha256, grant, start, end):
+        # Never the access token of this companion, the peer URLs come from the request
+        headers = {"Authorization": "Bearer " + grant, "Range": f"bytes={start}-{end}"}
+        return self._http_get(peer.rstrip("/") + "/" + peer_files_route + sha256, operation="peer_download",
+                              headers=headers, stream=True)
+
+    def _verify_peer_grant(self, grant, sha256):
+        """Returns the seed list of OctoFarm's peer grant for the file with 'sha256', None when it is not valid"""
+        if not isinstance(grant, str) or not is_jwt(grant):
+            return None
+        try:
+            # Meant for the seeds, which check it is addressed to them
+            claims = self._token_verifier.verify(grant, check_audience=False)
+        except TokenVerificationError as e:
+            self._logger.warning(f"Rejected peer grant for file {sha256}: {e}")
+            return None
+        peers = claims.get("peers")
+        if not has_scope(claims, token_peer_scope) or claims.get("sha256") != sha256 or \
+                not isinstance(peers, list) or len(peers) > Config.max_file_peers or \
+                not all(isinstance(peer, str) and peer.startswith(("http://", "https://")) for peer in peers):
+            return None
+        return peers
+
+    def _get_range_headers(self, start, end):
+        target = self._get_targets()[0]
+        access_token = target.token_manager.access_token
+        if access_token is None and self._query_access_token(target):
+            access_token = target.token_manager.access_token
+        if target.base_url is None or access_token is None:
+            raise Exception(Errors.openid_config_unset)
+        return target, {"Authorization": "Bearer " + access_token, "Range": f"bytes={start}-{end}"}
+
+    def _apply_token_settings(self):
+        self._token_verifier.issuer = self._settings.get(["oidc_issuer"]) or None
+        # Bound to this companion by default, tokens OctoFarm issued to other printers or clients do not pass
+        self._token_verifier.audience = self._settings.get(["oidc_audience"]) or \
+            self._get_target_configs()[0]["oidc_client_id"] or None
+
+    def _apply_spool_ids(self):
+        spool_ids = self._settings.get(["spool_ids"])
+        if isinstance(spool_ids, list):
+            self._pedometer.spool_ids = {tool: spool_id for tool, spool_id in enumerate(spool_ids) if spool_id}
+
+    def on_shutdown(self):
+        if self._ping_worker is not None:
+            self._ping_worker.stop()
+        if self._coalesce_worker is not None:
+            self._coalesce_worker.stop()
+        # The last partial window goes out with the drained telemetry below
+        self._coalescer.flush()
+        if self._ledger is not None:
+            self._record_usage()
+            self._ledger.close()
+        if self._job_history is not None:
+            self._job_history.close()
+        self._state_publisher.stop()
+        if self._tunnel is not None:
+            self._tunnel.stop()
+        with self._targets_lock:
+            for target in self._targets:
+                target.shutdown()
+        if self._fanout_pool is not None:
+            self._fanout_pool.shutdown(wait=False)
+        if self._download_workers is not None:
+            # Partial downloads are continued by the next fetch of the file
+            self._download_workers.shutdown(wait=False)
+        if self._index_worker is not None:
+            # Uploads waiting for the worker stay without index, they are not indexed at the next start
+            self._index_worker.shutdown(wait=False)
+        self._diagnostics.shutdown()
+        self._telemetry.stop()
+        if self._outbox is not None:
+            # Undelivered events survive the restart, close syncs them to disk
+            for event in list(self._pending_announcements.values()) + self._telemetry.drain():
+                self._outbox.append(event)
+            self._pending_announcements.clear()
+            self._outbox.close()
+        self._network.shutdown()
+        self._close_http_client()
+
+    def _get_http_client(self):
+        if self._http_client is None:
+            from octofarm_companion.http_client import OctoFarmHttpClient
+            pool_size = self._settings.get_int(["http_pool_size"])
+            connect_timeout = self._settings.get_float(["http_connect_timeout"])
+            read_timeout = self._settings.get_float(["http_read_timeout"])
+            retries = self._settings.get_int(["http_retries"])
+            self._http_client = OctoFarmHttpClient(
+                pool_size=pool_size or Config.default_http_pool_size,
+                connect_timeout=connect_timeout or Config.default_http_connect_timeout,
+                read_timeout=read_timeout or Config.default_http_read_timeout,
+                retries=retries if retries is not None else Config.default_http_retries
+            )
+        return self._http_client
+
+    def _http_get(self, url, operation="request", **kwargs):
+        return self._timed_call(operation, self._get_http_client().get, url, **kwargs)
+
+    def _http_post(self, url, operation="request", **kwargs):
+        return self._timed_call(operation, self._get_http_client().post, url, **kwargs)
+
+    def _timed_call(self, operation, method, url, **kwargs):
+        with self._metrics.time(operation) as timing:
+            try:
+                response = self._network.call(method, url, **kwargs)
+            except NetworkTimeoutError:
+                timing.outcome = TIMEOUT
+                raise
+            timing.outcome = outcome_for_status(response.status_code)
+            return response
+
+    def _close_http_client(self):
+        if self._http_client is not None:
+            self._http_client.close()
+            self._http_client = None
+
     def get_settings_version(self):
         return 1
 
@@ -97,48 +542,99 @@ class OctoFarmCompanionPlugin(
         )
 
     def initialize(self):
+        request_deadline = self._settings.get_float(["request_deadline"])
+        if request_deadline:
+            self._network.deadline = request_deadline
+        for setting, attribute in (("telemetry_capacity", "capacity"), ("telemetry_batch_size", "batch_size"),
+                                   ("telemetry_max_age", "max_age")):
+            value = self._settings.get_int([setting])
+            if value:
+                setattr(self._telemetry, attribute, value)
+        self._apply_spool_ids()
+        self._apply_token_settings()
+        state_push_rate = self._settings.get_float(["state_push_rate"])
+        if state_push_rate:
+            self._state_publisher.rate = state_push_rate
+        # Targets restore their persisted tokens when they are created
         self._fetch_persisted_data()
 
+        outbox_max_size_mb = self._settings.get_int(["outbox_max_size_mb"])
+        replay_rate = self._settings.get_float(["outbox_replay_rate"])
+        self._outbox = DurableOutbox(
+            os.path.join(self.get_plugin_data_folder(), Config.outbox_folder),
+            max_size=outbox_max_size_mb * 1024 * 1024 if outbox_max_size_mb else Config.default_outbox_max_bytes
+        )
+        self._replay_limiter = RateLimiter(replay_rate or Config.default_outbox_replay_rate)
+        self._ledger = UsageLedger(os.path.join(self.get_plugin_data_folder(), Config.usage_folder))
+        self._gcode_index = GcodeIndexStore(os.path.join(self.get_plugin_data_folder(), Config.gcode_index_folder))
+        self._job_history = JobHistory(os.path.join(self.get_plugin_data_folder(), Config.job_history_file))
+        file_cache_max_size_mb = self._settings.get_int(["file_cache_max_size_mb"])
+        self._file_cache = FileCache(
+            os.path.join(self.get_plugin_data_folder(), Config.file_cache_folder),
+            max_size=file_cache_max_size_mb * 1024 * 1024 if file_cache_max_size_mb else
+            Config.default_file_cache_max_bytes
+        )
+
+    def _get_persistence_store(self, filepath):
+        if self._persistence_store is None or self._persistence_store.path != filepath:
+            self._persistence_store = JsonFileStore(filepath)
+        return self._persistence_store
+
     def _fetch_persisted_data(self):
         filepath = self.get_excluded_persistence_datapath()
-        if os.path.exists(filepath):
-            try:
-                with io.open(filepath, "r", encoding="utf-8") as f:
-                    persistence_file = f.read()
-                    persistence_json = json.loads(persistence_file)
-                    self._persisted_data = persistence_json
-            except json.decoder.JSONDecodeError as e:
-                self._logger.warning(
-                    "OctoFarm persisted device Id file was of invalid format.")
-                self._write_new_device_uuid(filepath)
-        else:
+        try:
+            with self._metrics.time("persistence_read"):
+                # Only a stat when the file did not change since the last load or write
+                persistence_json = self._get_persistence_store(filepath).load()
+        except ValueError:
+            self._logger.warning(
+                "OctoFarm persisted device Id file was of invalid format and no previous version could be restored.")
+            persistence_json = None
+
+        if persistence_json is None or Keys.persistence_uuid_key not in persistence_json:
+            if persistence_json is not None:
+                self._persisted_data = persistence_json
             self._write_new_device_uuid(filepath)
-
-    def _write_new_access_token(self, filepath, at_data):
-        self._persisted_data["access_token"] = at_data["access_token"]
-        self._persisted_data["expires_in"] = at_data["expires_in"]
-        self._persisted_data["requested_at"] = int(datetime.utcnow().timestamp())
+        else:
+            self._persisted_data = persistence_json
+
+    def _token_entry(self, target=None):
+        # The default target keeps its token at the top level, like files written before multiple targets existed
+        if target is None or target.name == Config.default_target_name:
+            return self._persisted_data
+        return self._persisted_data.setdefault(Keys.targets_key, dict()).setdefault(target.name, dict())
+
+    def _write_new_access_token(self, filepath, at_data, target=None):
+        token_entry = self._token_entry(target)
+        token_entry["access_token"] = at_data["access_token"]
+        token_entry["expires_in"] = at_data["expires_in"]
+        token_entry["requested_at"] = int(utc_timestamp())
         if "token_type" in at_data.keys():
-            self._persisted_data["token_type"] = at_data["token_type"]
+            token_entry["token_type"] = at_data["token_type"]
         if "scope" in at_data.keys():
-            self._persisted_data["scope"] = at_data["scope"]
+            token_entry["scope"] = at_data["scope"]
         self._write_persisted_data(filepath)
         self._logger.info("OctoFarm persisted data file was updated (access_token)")
 
+    def _persist_access_token(self, target, at_data):
+        # Targets refresh their tokens concurrently
+        with self._persistence_lock:
+            self._write_new_access_token(self.get_excluded_persistence_datapath(), at_data, target)
+
     def _write_new_device_uuid(self, filepath):
-        persistence_uuid = str(uuid.uuid4())
+        persistence_uuid = _new_uuid()
         self._persisted_data[Keys.persistence_uuid_key] = persistence_uuid
         self._write_persisted_data(filepath)
         self._logger.info("OctoFarm persisted data file was updated (device_uuid).")
 
     def _write_persisted_data(self, filepath):
-        with io.open(filepath, "w", encoding="utf-8") as f:
-            f.write(json.dumps(self._persisted_data))
+        with self._metrics.time("persistence_write"):
+            self._get_persistence_store(filepath).save(self._persisted_data)
 
     def _get_device_uuid(self):
         device_uuid = self._settings.get([Keys.device_uuid_key])
         if device_uuid is None:
-            device_uuid = str(uuid.uuid4())
+            device_uuid = _new_uuid()
             self._settings.set([Keys.device_uuid_key], device_uuid)
             self._settings.save()
         return device_uuid
@@ -167,62 +663,281 @@ class OctoFarmCompanionPlugin(
         if self._ping_worker is None:
             ping_interval = self._settings.get_int(["ping"])
             if ping_interval:
-                self._ping_worker = RepeatedTimer(
-                    ping_interval, self._check_octofarm, run_first=True
+                base_delay = self._settings.get_int(["backoff_base"])
+                max_delay = self._settings.get_int(["backoff_max"])
+                initial_delay_max = self._settings.get_int(["initial_delay_max"])
+                self._ping_worker = BackoffScheduler(
+                    self._run_periodic_check, ping_interval,
+                    base_delay=base_delay or Config.default_backoff_base_secs,
+                    max_delay=max_delay or Config.default_backoff_max_secs,
+                    initial_delay_max=initial_delay_max if initial_delay_max is not None
+                    else Config.default_initial_delay_max_secs
                 )
                 self._ping_worker.start()
             else:
                 return self._logger.error(Errors.ping_setting_unset)
 
-    def _check_octofarm(self):
-        octofarm_host = self._settings.get(["octofarm_host"])
-        octofarm_port = self._settings.get(["octofarm_port"])
-
-        if octofarm_host is not None and octofarm_port is not None:
-            base_url = f"{octofarm_host}:{octofarm_port}"
+    def _start_tunnel(self):
+        if self._tunnel is not None or not self._settings.get(["tunnel_enabled"]):
+            return
+        from octofarm_companion.tunnel import TunnelClient
+        max_streams = self._settings.get_int(["tunnel_max_streams"])
+        # OctoPrint may listen on all interfaces, the tunnel always talks to it over loopback
+        octoprint_port = self._settings.global_get(["server", "port"])
+        identity = dict(deviceUuid=self._get_device_uuid(),
+                        persistenceUuid=self._persisted_data.get(Keys.persistence_uuid_key))
+        self._tunnel = TunnelClient(self._get_tunnel_connection, f"http://127.0.0.1:{octoprint_port}",
+                                    identity=identity, max_streams=max_streams or Config.default_tunnel_max_streams,
+                                    logger=self._logger, on_session=self._state_publisher.resync)
+        self._tunnel.start()
+        self._state_publisher.start()
+
+    def _get_tunnel_connection(self):
+        """WebSocket URL and headers of the primary OctoFarm server, None until the periodic check got a token"""
+        target = self._get_targets()[0]
+        access_token = target.token_manager.access_token
+        if target.base_url is None or access_token is None:
+            return None
+        url = urljoin(target.base_url, octofarm_tunnel_route)
+        if url.startswith("http"):
+            # http -> ws, https -> wss
+            url = "ws" + url[len("http"):]
+        return url, {"Authorization": "Bearer " + access_token}
+
+    def _run_periodic_check(self):
+        try:
+            self._record_usage()
+            self._check_octofarm()
+        except Exception as e:
+            self._logger.error("Periodic OctoFarm check failed. Exception: " + str(e))
+            return False
+        healthy = [target for target in self._targets if target.state in (State.SUCCESS, State.SLEEP)]
+        if not healthy:
+            # Back off only when no OctoFarm server is reachable, the others keep their ping interval
+            return False
+        if healthy[0].primary:
+            self._replay_outbox()
+            self._sync_usage()
+        return True
+
+    def _get_target_configs(self):
+        targets = self._settings.get(["octofarm_targets"])
+        if not isinstance(targets, list) or not targets:
+            return [dict(
+                name=Config.default_target_name,
+                base_url=self._get_octofarm_base_url(),
+                oidc_client_id=self._settings.get(["oidc_client_id"]),
+                oidc_client_secret=self._settings.get(["oidc_client_secret"])
+            )]
+
+        configs = []
+        for index, target in enumerate(targets):
+            name = target.get("name") or f"target{index}"
+            if any(config["name"] == name for config in configs):
+                self._logger.error(f"OctoFarm target name '{name}' is used twice, ignoring the second target")
+                continue
+            host = target.get("host")
+            port = target.get("port")
+            configs.append(dict(
+                name=name,
+                base_url=f"{host}:{port}" if host is not None and port is not None else None,
+                oidc_client_id=target.get("oidc_client_id"),
+                oidc_client_secret=target.get("oidc_client_secret")
+            ))
+        return configs
+
+    def _create_target(self, config):
+        refresh_margin = self._settings.get_int(["token_refresh_margin"])
+        max_silence = self._settings.get_int(["announce_max_silence"])
+        target = OctoFarmTarget(
+            config["name"], config["base_url"], config["oidc_client_id"], config["oidc_client_secret"],
+            refresh_token=self._refresh_access_token,
+            persist_token=self._persist_access_token,
+            refresh_margin=refresh_margin if refresh_margin is not None else Config.default_token_refresh_margin_secs,
+            max_silence=max_silence if max_silence is not None else Config.default_announce_max_silence_secs
+        )
+        target.token_manager.load(self._token_entry(target))
+        return target
+
+    def _get_targets(self):
+        """Returns the configured targets, the first one is the primary. Unchanged targets keep their token."""
+        with self._targets_lock:
+            current = {target.key: target for target in self._targets}
+            targets = []
+            for config in self._get_target_configs():
+                key = (config["name"], config["base_url"], config["oidc_client_id"], config["oidc_client_secret"])
+                target = current.pop(key, None)
+                targets.append(target if target is not None else self._create_target(config))
+            for removed_target in current.values():
+                removed_target.shutdown()
+            for index, target in enumerate(targets):
+                target.primary = index == 0
+            self._targets = targets
+            return targets
+
+    def _get_fanout_pool(self):
+        if self._fanout_pool is None:
+            workers = self._settings.get_int(["fanout_workers"])
+            self._fanout_pool = concurrent.futures.ThreadPoolExecutor(
+                max_workers=workers or Config.default_fanout_workers, thread_name_prefix="OctoFarmCompanionFanout")
+        return self._fanout_pool
+
+    def _spill_to_outbox(self, events):
+        if self._outbox is None:
+            raise Exception(Errors.outbox_unavailable)
+        for event in events:
+            self._outbox.append(event)
+        # The batch was dropped from memory, it is only safe once it reached the disk
+        self._outbox.flush()
+
+    def _replay_outbox(self):
+        """Sends events stored during an outage in order, paced so a farm coming back does not flood OctoFarm"""
+        if self._outbox is None:
+            return
+        if self._pending_announcements:
+            announcements = dict(self._pending_announcements)
+            if not self._send_telemetry_batch(list(announcements.values())):
+                return
+            for key, announcement in announcements.items():
+                # Kept when a newer one failed meanwhile
+                if self._pending_announcements.get(key) is announcement:
+                    del self._pending_announcements[key]
+        for batch in range(Config.outbox_replay_max_batches):
+            events, position = self._outbox.read(self._telemetry.batch_size)
+            if not events:
+                return
+            self._replay_limiter.acquire()
+            if not self._send_telemetry_batch(events):
+                return
+            self._outbox.ack(position)
+            self._logger.info(f"Replayed {len(events)} stored events to OctoFarm")
+
+    def _record_usage(self):
+        if self._ledger is None:
+            return
+        usage = self._pedometer.take_spool_usage()
+        if usage:
+            self._ledger.append(usage, self._pedometer.job_id)
+
+    def _sync_usage(self):
+        """Sends the usage records OctoFarm did not store yet in bulk, then compacts what it stored"""
+        if self._ledger is None:
+            return
+        for batch in range(Config.usage_sync_max_batches):
+            data, start, end = self._ledger.pending()
+            if not data:
+                break
+            if not self._send_usage(data, start, end):
+                return
+            self._ledger.ack(end)
+        self._ledger.compact()
+
+    def _send_usage(self, data, start, end):
+        target = self._get_targets()[0]
+        access_token = target.token_manager.access_token
+        if target.base_url is None or access_token is None:
+            return False
 
-            # OIDC client_credentials flow result
-            access_token = self._persisted_data.get("access_token", None)
-            requested_at = self._persisted_data.get("requested_at", None)
-            expires = self._persisted_data.get("expires", None)
+        body = compress_batch({
+            "deviceUuid": self._get_device_uuid(),
+            "persistenceUuid": self._persisted_data.get(Keys.persistence_uuid_key),
+            "from": start,
+            "to": end,
+            "recordFormat": record_format,
+            "spools": self._ledger.spools(),
+            "records": base64.b64encode(data).decode("ascii"),
+            "compactedTotals": self._ledger.compacted_totals()
+        })
+        headers = {
+            'Authorization': 'Bearer ' + access_token,
+            'Content-Type': 'application/json',
+            'Content-Encoding': 'gzip'
+        }
+        try:
+            response = self._http_post(urljoin(target.base_url, octofarm_usage_route), operation="usage",
+                                       headers=headers, data=body)
+        except _connection_errors() as e:
+            self._logger.error(f"{type(e).__name__}: error sending filament usage to OctoFarm")
+            return False
 
-            # Token expiry check - prone to time desync
-            is_expired = None
-            if requested_at is not None and expires is not None:
-                current_time = datetime.utcnow().timestamp()
-                is_expired = current_time > requested_at + expires
+        if response.status_code == 401:
+            target.token_manager.invalidate()
+        return 200 <= response.status_code < 300
 
-            token_invalid = not access_token or is_expired
+    def _check_octofarm(self):
+        targets = self._get_targets()
+        if len(targets) == 1:
+            return self._check_target(targets[0])
 
-            if token_invalid:
-                oidc_client_id = self._settings.get(["oidc_client_id"])
-                oidc_client_secret = self._settings.get(["oidc_client_secret"])
-                self._logger.info("Refreshing access_token as it was expired")
-                success = self._query_access_token(base_url, oidc_client_id, oidc_client_secret)
+        # Each server is checked on its own worker, a slow or unreachable one does not delay the others
+        futures = [(target, self._get_fanout_pool().submit(self._check_target, target)) for target in targets]
+        for target, future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                self._logger.error(f"OctoFarm check of target '{target.name}' failed. Exception: " + str(e))
+
+    def _check_target(self, target):
+        if target.base_url is not None:
+            # OIDC client_credentials flow result, normally kept fresh by the token manager in the background
+            access_token = target.token_manager.access_token
+
+            if access_token is None:
+                self._logger.info(f"Refreshing access_token of target '{target.name}' as it was expired")
+                success = self._query_access_token(target)
                 if not success:
-                    self._state = State.CRASHED
+                    target.state = State.CRASHED
                     return False
+
+                access_token = target.token_manager.access_token
+                if access_token is None:
+                    # Quite unlikely as we'd be crashed
+                    raise Exception(Errors.access_token_not_saved)
             else:
                 # We skip querying the token
-                self._state = State.SUCCESS
-
-            if "access_token" not in self._persisted_data.keys():
-                # Quite unlikely as we'd be crashed
-                raise Exception(Errors.access_token_not_saved)
-
-            at = self._persisted_data["access_token"]
+                target.state = State.SUCCESS
 
-            self._query_announcement(base_url, at)
+            self._query_announcement(target, access_token)
 
         else:
             self._logger.error(Errors.openid_config_unset)
-            self._state = State.CRASHED
+            target.state = State.CRASHED
             raise Exception(Errors.config_openid_missing)
 
-    def _query_access_token(self, base_url, oidc_client_id, oidc_client_secret):
+    def _read_environment_settings(self):
+        return dict(
+            host=self._settings.global_get(["server", "host"]),
+            port=self._settings.global_get(["server", "port"]),
+            # TODO maybe let OctoFarm decide instead of swapping ourselves?
+            port_override=self._settings.get(["port_override"]),
+            allow_cross_origin=self._settings.global_get(["api", "allowCrossOrigin"])
+        )
+
+    def _get_octofarm_base_url(self):
+        octofarm_host = self._settings.get(["octofarm_host"])
+        octofarm_port = self._settings.get(["octofarm_port"])
+        if octofarm_host is None or octofarm_port is None:
+            return None
+        return f"{octofarm_host}:{octofarm_port}"
+
+    def _refresh_access_token(self, target):
+        if target.base_url is None:
+            return False
+
+        self._logger.info(f"Refreshing access_token of target '{target.name}' ahead of expiry")
+        try:
+            return self._query_access_token(target)
+        except Exception as e:
+            self._logger.error("Background access_token refresh failed. Exception: " + str(e))
+            return False
+
+    def _query_access_token(self, target):
+        base_url = target.base_url
+        oidc_client_id = target.oidc_client_id
+        oidc_client_secret = target.oidc_client_secret
         if not oidc_client_id or not oidc_client_secret:
             self._logger.error("Configuration error: 'oidc_client_id' or 'oidc_client_secret' not set")
-            self._state = State.CRASHED
+            target.state = State.CRASHED
             return False
 
         at_data = None
@@ -230,16 +945,16 @@ class OctoFarmCompanionPlugin(
             data = {'grant_type': 'client_credentials', 'scope': requested_scopes}
             self._logger.info("Calling OctoFarm at URL: " + base_url)
             url = urljoin(base_url, octofarm_access_token_route)
-            response = requests.post(url, data=data,
-                                     verify=False, allow_redirects=False, auth=(oidc_client_id, oidc_client_secret))
-            self._logger.info(response.text)
-            self._logger.info(response.status_code)
+            response = self._http_post(url, operation="token", data=data, verify=False, allow_redirects=False,
+                                       auth=(oidc_client_id, oidc_client_secret))
+            # The body holds the access_token, it is never logged
+            self._logger.debug(f"Access token response status {response.status_code}")
             at_data = json.loads(response.text)
-        except requests.exceptions.ConnectionError:
-            self._state = State.RETRY  # TODO apply this with a backoff scheme
-            self._logger.error("ConnectionError: error sending access_token request to OctoFarm")
+        except _connection_errors() as e:
+            target.state = State.RETRY  # The scheduler backs off until OctoFarm is reachable again
+            self._logger.error(f"{type(e).__name__}: error sending access_token request to OctoFarm")
         except Exception as e:
-            self._state = State.CRASHED
+            target.state = State.CRASHED
             self._logger.error(
                 "Generic Exception: error requesting access_token request to OctoFarm. Exception: " + str(e))
 
@@ -247,72 +962,146 @@ class OctoFarmCompanionPlugin(
             if "access_token" not in at_data.keys():
                 raise Exception(
                     "Response error: 'access_token' not received. Check your OctoFarm server logs. Aborting")
-            if "expires_in" not in at_data.keys() is None:
+            if "expires_in" not in at_data:
                 raise Exception("Response error: 'expires_in' not received. Check your OctoFarm server logs. Aborting")
 
-            # Saves to file and to this plugin instance self._persistence_data accordingly
-            self._write_new_access_token(self.get_excluded_persistence_datapath(), at_data)
-            self._state = State.SUCCESS
+            # Keeps the token in memory, only saving to file and self._persisted_data when it or its expiry changed
+            target.token_manager.update(at_data)
+            target.state = State.SUCCESS
             return True
         else:
-            self._state = State.CRASHED
+            target.state = State.CRASHED
             self._logger.error("Response error: access_token data response was empty. Aborting")
 
-    def _query_announcement(self, base_url, access_token):
-        if self._state != State.SUCCESS and self._state != State.SLEEP:
+    def _query_announcement(self, target, access_token):
+        if target.state != State.SUCCESS and target.state != State.SLEEP:
             self._logger.error("State error: tried to announce when state was not 'success'")
 
+        base_url = target.base_url
         if base_url is None:
-            self._state = State.CRASHED
+            target.state = State.CRASHED
             raise Exception(Errors.base_url_not_provided)
 
         if len(access_token) < 43:
-            self._state = State.CRASHED
+            target.state = State.CRASHED
             raise Exception(Errors.access_token_too_short)
 
-        # Announced data
-        octoprint_port = self._settings.get(["port_override"])
-        octoprint_host = self._settings.global_get(["server", "host"])
-        # TODO maybe let OctoFarm decide instead of swapping ourselves?
-        if octoprint_port is None:
-            # Risk of failure when behind proxy (docker, vm, vpn, rev-proxy)
-            octoprint_port = self._settings.global_get(["server", "port"])
-
+        check_data = None
         try:
-            # Data folder based
-            self._fetch_persisted_data()
+            # Data folder based, loaded once at initialize
+            if Keys.persistence_uuid_key not in self._persisted_data:
+                self._fetch_persisted_data()
             # Config file based
             device_uuid = self._get_device_uuid()
 
+            # Announced data, cached until the settings or the network change
+            environment = self._environment.get()
             # TODO rectify CORS on the spot?
-            allow_cross_origin = self._settings.global_get(["api", "allowCrossOrigin"])
-
             check_data = {
                 "deviceUuid": device_uuid,
                 "persistenceUuid": self._persisted_data["persistence_uuid"],
-                "host": octoprint_host,
-                "port": int(octoprint_port),
-                "docker": bool(is_docker()),
-                "allowCrossOrigin": bool(allow_cross_origin)
+                "host": environment["host"],
+                "port": environment["port"],
+                "docker": environment["docker"],
+                "container": environment["runtime"],
+                "allowCrossOrigin": environment["allowCrossOrigin"],
+                # Ranked addresses to try when 'host' does not work, enumerated at most every few minutes
+                "candidates": self._discovery.candidates(environment["port"]),
+                # Advertised so OctoFarm can hand out this companion as a seed, sorted to keep the fingerprint stable
+                "cachedFiles": sorted(self._file_cache.hashes(Config.announced_cached_files))
+                if self._file_cache is not None else []
             }
 
+            current_fingerprint = fingerprint(check_data)
+            tracker = target.announcement_tracker
+            action = tracker.next_action(current_fingerprint)
+            self._metrics.increment("announcements", "Announcement decisions by action", (("action", action),))
+            if action == AnnouncementTracker.SKIP:
+                target.state = State.SLEEP
+                return
+
             headers = {'Authorization': 'Bearer ' + access_token}
-            url = urljoin(base_url, octofarm_announce_route)
-            response = requests.post(url, headers=headers, json=check_data)
+            if action == AnnouncementTracker.HEARTBEAT:
+                heartbeat_data = {
+                    "deviceUuid": device_uuid,
+                    "persistenceUuid": check_data["persistenceUuid"],
+                    "fingerprint": current_fingerprint
+                }
+                url = urljoin(base_url, octofarm_heartbeat_route)
+                response = self._http_post(url, operation="heartbeat", headers=headers, json=heartbeat_data)
+            else:
+                url = urljoin(base_url, octofarm_announce_route)
+                response = self._http_post(url, operation="announce", headers=headers, json=check_data)
+
+            if 200 <= response.status_code < 300:
+                if action == AnnouncementTracker.HEARTBEAT:
+                    tracker.mark_heartbeat()
+                else:
+                    tracker.mark_sent(current_fingerprint)
+            else:
+                # OctoFarm did not accept it (or does not know us anymore), announce fully on the next ping
+                tracker.reset()
+            if response.status_code == 401:
+                # Token was revoked or OctoFarm restarted, fetch a new one on the next ping
+                target.token_manager.invalidate()
+
+            if response.status_code >= 500 or response.status_code == 429:
+                # OctoFarm is restarting or overloaded, the scheduler backs off instead of pinging at a fixed interval
+                target.state = State.RETRY
+                if self._outbox is not None and target.primary:
+                    self._pending_announcements[target.key] = self._telemetry.make_event("announcement", check_data)
+                self._logger.warning(f"OctoFarm server '{target.name}' answered the announcement with "
+                                     f"{response.status_code}, backing off")
+                return
+            target.state = State.SLEEP
+            self._logger.info(f"Done announcing to OctoFarm server '{target.name}' ({action}, {response.status_code})")
+            self._logger.debug(response.text)
+        except _connection_errors() as e:
+            tracker.reset()
+            target.state = State.CRASHED
+            self._logger.error(f"{type(e).__name__}: error sending announcement to OctoFarm server '{target.name}'")
+            # The outbox is replayed to the primary target only
+            if check_data is not None and self._outbox is not None and target.primary:
+                self._pending_announcements[target.key] = self._telemetry.make_event("announcement", check_data)
+
+    def _send_telemetry_batch(self, events):
+        target = self._get_targets()[0]
+        base_url = target.base_url
+        access_token = target.token_manager.access_token
+        if base_url is None or access_token is None:
+            # Kept in the ring until the periodic check obtained a token
+            return False
+
+        body = compress_batch({
+            "deviceUuid": self._get_device_uuid(),
+            "persistenceUuid": self._persisted_data.get(Keys.persistence_uuid_key),
+            "events": events
+        })
+        headers = {
+            'Authorization': 'Bearer ' + access_token,
+            'Content-Type': 'application/json',
+            'Content-Encoding': 'gzip'
+        }
+        try:
+            response = self._http_post(urljoin(base_url, octofarm_telemetry_route), operation="telemetry",
+                                       headers=headers, data=body)
+        except _connection_errors() as e:
+            self._logger.error(f"{type(e).__name__}: error sending telemetry to OctoFarm")
+            return False
 
-            self._state = State.SLEEP
-            self._logger.info(f"Done announcing to OctoFarm server ({response.status_code})")
-            self._logger.info(response.text)
-        except requests.exceptions.ConnectionError:
-            self._state = State.CRASHED
-            self._logger.error("ConnectionError: error sending announcement to OctoFarm")
+        if response.status_code == 401:
+            target.token_manager.invalidate()
+        return 200 <= response.status_code < 300
 
     def _call_validator_abort(self, key):
         flask.abort(400, description=f"Expected '{key}' parameter")
 
     @staticmethod
     def additional_excludes_hook(excludes, *args, **kwargs):
-        return [Config.persisted_data_file]
+        # The previous generation kept for recovery contains the same device identity
+        # Cached files are downloaded again from OctoFarm when needed
+        return [Config.persisted_data_file, Config.persisted_data_file + ".bak", Config.outbox_folder,
+                Config.file_cache_folder]
 
     @octoprint.plugin.BlueprintPlugin.route("/test_octofarm_connection", methods=["POST"])
     def test_octofarm_connection(self):
@@ -325,13 +1114,198 @@ class OctoFarmCompanionPlugin(
         proposed_url = input["url"]
         self._logger.info("Testing OctoFarm URL " + proposed_url)
 
-        url = urljoin(proposed_url, octofarm_version_route)
-        response = requests.get(url)
-        version_data = json.loads(response.text)
-
-        self._logger.info("Version response from OctoFarm " + version_data["version"])
-
-        return version_data
+        report = self._diagnostics.run(proposed_url, input.get("client_id"), input.get("client_secret"))
+        if report["ok"]:
+            self._logger.info("Version response from OctoFarm " + report["version"])
+            return report
+        self._logger.info("OctoFarm connection test failed, stages: " +
+                          ", ".join(f"{name} {stage['status']}" for name, stage in report["stages"].items()))
+        status = 504 if report["stages"]["version"]["status"] == DIAGNOSTICS_TIMEOUT else 502
+        return report, status
+
+    def _fetch_jwks(self):
+        """The public keys of the primary OctoFarm server"""
+        base_url = self._get_targets()[0].base_url
+        response = self._http_get(urljoin(base_url, octofarm_jwks_route), operation="jwks")
+        if response.status_code != 200:
+            raise Exception(f"OctoFarm answered {response.status_code} for its JWKS")
+        return response.json()
+
+    def get_blueprint(self):
+        if hasattr(self, "_blueprint"):
+            return self._blueprint
+        blueprint = super().get_blueprint()
+        blueprint.before_request(self._authorize_request)
+        return blueprint
+
+    def is_blueprint_protected(self):
+        # OctoFarm's tokens are no OctoPrint login, '_authorize_request' checks both
+        return False
+
+    def _authorize_request(self):
+        endpoint = request.endpoint.rsplit(".", 1)[-1]
+        # CORS preflights carry no credentials, OctoPrint's CORS handler registered after this hook answers them
+        if endpoint == "static" or request.method == "OPTIONS":
+            return None
+        from octoprint.access.permissions import Permissions
+        if endpoint in settings_routes:
+            if not Permissions.SETTINGS.can():
+                return flask.abort(403, description=Errors.permission_denied)
+            return None
+
+        authorization = request.headers.get("Authorization", "")
+        token = authorization[len("Bearer "):] if authorization.startswith("Bearer ") else None
+        # OctoPrint API keys are sent the same way, they are checked by OctoPrint below
+        if token is not None and is_jwt(token):
+            if self._token_verifier.audience is None:
+                # Without an audience any token of the farm would pass
+                return flask.abort(401, description=Errors.token_audience_unset)
+            try:
+                claims = self._token_verifier.verify(token)
+            except TokenVerificationError as e:
+                self._logger.warning(f"Rejected OctoFarm token for {request.path}: {e}")
+                return flask.abort(401, description=str(e))
+            scope = token_route_scopes.get(endpoint, token_read_scope if request.method in ("GET", "HEAD") else
+                                           token_write_scope)
+            if not has_scope(claims, scope):
+                self._logger.warning(f"Rejected OctoFarm token for {request.path}: no '{scope}' scope")
+                return flask.abort(403, description=Errors.token_scope_missing)
+            flask.g.octofarm_claims = claims
+            return None
+        # Any OctoPrint login or API key, as before the routes accepted OctoFarm's tokens
+        from octoprint.server.util import requireLoginRequestHandler
+        return requireLoginRequestHandler()
+
+    def _diagnostics_deadline(self):
+        return min(self._network.deadline, Config.diagnostics_http_deadline_secs)
+
+    def _fetch_version(self, base_url):
+        return self._http_get(urljoin(base_url, octofarm_version_route), operation="test_connection",
+                              deadline=self._diagnostics_deadline())
+
+    def _fetch_test_token(self, base_url, client_id, client_secret):
+        data = {'grant_type': 'client_credentials', 'scope': requested_scopes}
+        return self._http_post(urljoin(base_url, octofarm_access_token_route), operation="test_connection",
+                               data=data, verify=False, allow_redirects=False, auth=(client_id, client_secret),
+                               deadline=self._diagnostics_deadline())
+
+    @octoprint.plugin.BlueprintPlugin.route("/metrics", methods=["GET"])
+    def get_metrics(self):
+        return flask.Response(self._metrics.render(), mimetype="text/plain; version=0.0.4")
+
+    @octoprint.plugin.BlueprintPlugin.route("/announcement_stats", methods=["GET"])
+    def get_announcement_stats(self):
+        return {target.name: target.stats() for target in self._get_targets()}
+
+    @octoprint.plugin.BlueprintPlugin.route("/telemetry_stats", methods=["GET"])
+    def get_telemetry_stats(self):
+        return self._telemetry.stats()
+
+    @octoprint.plugin.BlueprintPlugin.route("/tunnel_stats", methods=["GET"])
+    def get_tunnel_stats(self):
+        if self._tunnel is None:
+            return dict(enabled=False)
+        return dict(self._tunnel.stats(), state_push=self._state_publisher.stats())
+
+    @octoprint.plugin.BlueprintPlugin.route("/token_stats", methods=["GET"])
+    def get_token_stats(self):
+        return self._token_verifier.stats()
+
+    @octoprint.plugin.BlueprintPlugin.route("/environment", methods=["GET"])
+    def get_environment(self):
+        return dict(self._environment.get(), stats=self._environment.stats(), discovery=self._discovery.stats())
+
+    @octoprint.plugin.BlueprintPlugin.route("/filament_usage", methods=["GET"])
+    def get_filament_usage(self):
+        usage = self._pedometer.usage()
+        if self._ledger is not None:
+            usage["ledger"] = dict(self._ledger.stats(), totals=self._ledger.totals())
+        return usage
+
+    @octoprint.plugin.BlueprintPlugin.route("/jobs", methods=["GET"])
+    def get_jobs(self):
+        try:
+            after = int(request.args.get("after", 0))
+            limit = int(request.args.get("limit", Config.job_history_page_size))
+        except ValueError:
+            return flask.abort(400, description=Errors.invalid_job_cursor)
+        sha256 = request.args.get("sha256")
+        if after < 0 or limit < 1 or (sha256 is not None and not is_sha256(sha256)):
+            return flask.abort(400, description=Errors.invalid_job_cursor)
+        if self._job_history is None:
+            return dict(jobs=[], cursor=after, more=False)
+
+        # Unchanged pages cost OctoFarm a 304 without a query or a body
+        etag = self._job_history.etag()
+        if request.if_none_match.contains(etag):
+            response = flask.Response(status=304)
+        else:
+            page = self._job_history.export(after, min(limit, Config.job_history_max_page_size), sha256=sha256)
+            response = flask.Response(json.dumps(page), mimetype="application/json")
+        response.set_etag(etag)
+        response.headers["Cache-Control"] = "no-cache"
+        return response
+
+    @octoprint.plugin.BlueprintPlugin.route("/fetch_file", methods=["POST"])
+    def fetch_file(self):
+        input = json.loads(request.data)
+        for key in ("sha256", "path"):
+            if key not in input:
+                return self._call_validator_abort(key)
+        sha256, path = input["sha256"], input["path"]
+        if not is_sha256(sha256):
+            return flask.abort(400, description=Errors.invalid_sha256)
+        if "peers" in input:
+            return flask.abort(400, description=Errors.peers_unsigned)
+        # Seed list of companions which have the file, signed by OctoFarm for this file only
+        grant = input.get("grant")
+        peers = []
+        if grant is not None:
+            peers = self._verify_peer_grant(grant, sha256)
+            if peers is None:
+                return flask.abort(400, description=Errors.invalid_peer_grant)
+        if self._file_cache.path(sha256) is not None:
+            # Known file, no transfer
+            if not self._fetch_file(sha256, path):
+                return flask.abort(500, description=Errors.file_store_failed)
+            return dict(sha256=sha256, path=path, state="stored")
+        self._get_download_workers().submit(self._fetch_file, sha256, path, peers, grant)
+        return dict(sha256=sha256, path=path, state="downloading"), 202
+
+    @octoprint.plugin.BlueprintPlugin.route("/file_cache", methods=["GET"])
+    def get_file_cache(self):
+        return dict(self._file_cache.stats(), downloads=self._file_cache.downloads())
+
+    @octoprint.plugin.BlueprintPlugin.route("/files/<sha256>", methods=["GET"])
+    def get_cached_file(self, sha256):
+        """Serves a cached file to other companions, Range requests are answered with the requested chunk"""
+        if not is_sha256(sha256):
+            return flask.abort(400, description=Errors.invalid_sha256)
+        # An OctoFarm peer grant is good for its file only, OctoPrint logins for any
+        claims = flask.g.get("octofarm_claims")
+        if claims is not None and claims.get("sha256") != sha256:
+            return flask.abort(403, description=Errors.peer_grant_mismatch)
+        path = self._file_cache.path(sha256)
+        if path is None:
+            return flask.abort(404, description=Errors.file_not_cached)
+        self._metrics.increment("peer_file_requests", "File requests served to other companions")
+        return flask.send_file(path, mimetype="application/octet-stream", conditional=True, etag=sha256)
+
+    @octoprint.plugin.BlueprintPlugin.route("/gcode_index", methods=["GET"])
+    def get_gcode_indexes(self):
+        if self._gcode_index is None:
+            return dict(paths=dict())
+        return dict(paths=self._gcode_index.paths(), stats=self._gcode_index.stats())
+
+    @octoprint.plugin.BlueprintPlugin.route("/gcode_index/<sha256>", methods=["GET"])
+    def get_gcode_index(self, sha256):
+        if not is_sha256(sha256):
+            return flask.abort(400, description=Errors.invalid_sha256)
+        data = self._gcode_index.get(sha256) if self._gcode_index is not None else None
+        if data is None:
+            return flask.abort(404, description=Errors.gcode_index_not_found)
+        # Stored as the JSON served, it is not parsed again
+        return flask.Response(data, mimetype="application/json")
 
     @octoprint.plugin.BlueprintPlugin.route("/test_octofarm_openid", methods=["POST"])
     def test_octofarm_openid(self):
@@ -341,15 +1315,17 @@ class OctoFarmCompanionPlugin(
             if key not in input:
                 return self._call_validator_abort(key)
 
-        proposed_url = input["url"]
-        oidc_client_id = input["client_id"]
-        oidc_client_secret = input["client_secret"]
-        response = self._query_access_token(proposed_url, oidc_client_id, oidc_client_secret)
+        # Throwaway target, testing credentials leaves the configured targets and their tokens alone
+        target = OctoFarmTarget("test", input["url"], input["client_id"], input["client_secret"])
+        try:
+            self._query_access_token(target)
+        finally:
+            target.shutdown()
 
         self._logger.info("Queried access_token from Octofarm")
 
         return {
-            "state": self._state,
+            "state": target.state,
         }
 
 
@@ -366,5 +1342,8 @@ def __plugin_load__():
     global __plugin_hooks__
     __plugin_hooks__ = {
         "octoprint.plugin.softwareupdate.check_config": __plugin_implementation__.get_update_information,
-        "octoprint.plugin.backup.additional_excludes": __plugin_implementation__.additional_excludes_hook
+        "octoprint.plugin.backup.additional_excludes": __plugin_implementation__.additional_excludes_hook,
+        "octoprint.comm.protocol.gcode.sent": __plugin_implementation__.gcode_sent_hook,
+        "octoprint.filemanager.preprocessor": __plugin_implementation__.gcode_preprocessor_hook,
+        "octoprint.comm.protocol.temperatures.received": __plugin_implementation__.temperatures_received_hook
     }
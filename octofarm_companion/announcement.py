@@ -0,0 +1,60 @@
+import hashlib
+import json
+import time
+from threading import Lock
+
+from octofarm_companion.constants import Config
+
+
+def fingerprint(announcement_data):
+    canonical = json.dumps(announcement_data, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()[:Config.announce_fingerprint_length]
+
+
+class AnnouncementTracker:
+    """Decides per ping whether OctoFarm needs the full announcement, a small heartbeat or nothing at all.
+
+    The full announcement is only sent when its fingerprint changed since the last accepted one. Unchanged pings
+    are skipped until 'max_silence' seconds passed since OctoFarm last heard from us, after which a heartbeat is sent.
+    """
+    FULL = "full"
+    HEARTBEAT = "heartbeat"
+    SKIP = "skip"
+
+    def __init__(self, max_silence=Config.default_announce_max_silence_secs, clock=time.monotonic):
+        self.max_silence = max_silence
+        self._clock = clock
+        self._lock = Lock()
+        self._fingerprint = None
+        self._last_contact = None
+        self._counters = dict(sent=0, heartbeat=0, skipped=0)
+
+    def next_action(self, current_fingerprint):
+        with self._lock:
+            if self._fingerprint is None or current_fingerprint != self._fingerprint:
+                return self.FULL
+            if self._clock() - self._last_contact >= self.max_silence:
+                return self.HEARTBEAT
+            self._counters["skipped"] += 1
+            return self.SKIP
+
+    def mark_sent(self, sent_fingerprint):
+        with self._lock:
+            self._fingerprint = sent_fingerprint
+            self._last_contact = self._clock()
+            self._counters["sent"] += 1
+
+    def mark_heartbeat(self):
+        with self._lock:
+            self._last_contact = self._clock()
+            self._counters["heartbeat"] += 1
+
+    def reset(self):
+        """Forces the next ping to send the full announcement, f.e. after OctoFarm rejected a heartbeat."""
+        with self._lock:
+            self._fingerprint = None
+            self._last_contact = None
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters, fingerprint=self._fingerprint)
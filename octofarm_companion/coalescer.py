@@ -0,0 +1,90 @@
+from threading import Lock
+
+from octofarm_companion.constants import Config
+
+_unset = object()
+# Exact types, a bool is an int but no series and the ABC check of numbers.Number is slow on this hot path
+_numeric_types = frozenset((int, float))
+
+
+class _Series:
+    __slots__ = ("min", "max", "last", "count")
+
+    def __init__(self, value):
+        self.min = value
+        self.max = value
+        self.last = value
+        self.count = 1
+
+    def compact(self):
+        if self.min == self.max:
+            return self.last
+        return dict(min=self.min, max=self.max, last=self.last, count=self.count)
+
+
+class EventCoalescer:
+    """Reduces high frequency samples (temperatures, position, Z height) to one compact delta per window.
+
+    Within a window a numeric key keeps its min, max, last value and sample count, any other value only the
+    latest. 'flush' hands the keys whose summary differs from what was emitted before to 'emit' as one dict, a
+    steady temperature therefore costs nothing. Memory is bounded by 'max_keys', not by the event rate: samples
+    of further keys are dropped.
+    """
+
+    def __init__(self, emit, max_keys=Config.coalesce_max_keys):
+        self.max_keys = max_keys
+        self._emit = emit
+        self._lock = Lock()
+        # key -> _Series or latest value within the current window
+        self._window = dict()
+        # key -> last emitted compact value, every known key has an entry
+        self._emitted = dict()
+        self._counters = dict(events=0, messages=0, dropped=0)
+
+    def record(self, key, value):
+        with self._lock:
+            self._counters["events"] += 1
+            if key not in self._emitted:
+                if len(self._emitted) >= self.max_keys:
+                    self._counters["dropped"] += 1
+                    return
+                self._emitted[key] = _unset
+            if type(value) in _numeric_types:
+                series = self._window.get(key)
+                if type(series) is _Series:
+                    if value < series.min:
+                        series.min = value
+                    elif value > series.max:
+                        series.max = value
+                    series.last = value
+                    series.count += 1
+                    return
+                self._window[key] = _Series(value)
+            else:
+                self._window[key] = value
+
+    def record_all(self, prefix, values, keys):
+        """Records the entries of 'values' listed in 'keys' which are set, as '<prefix>.<key>'"""
+        for key in keys:
+            value = values.get(key)
+            if value is not None:
+                self.record(f"{prefix}.{key}", value)
+
+    def flush(self):
+        with self._lock:
+            window, self._window = self._window, dict()
+            delta = dict()
+            for key, entry in window.items():
+                value = entry.compact() if type(entry) is _Series else entry
+                if self._emitted[key] != value:
+                    self._emitted[key] = value
+                    delta[key] = value
+            if delta:
+                self._counters["messages"] += 1
+        if delta:
+            self._emit(delta)
+        return True
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters, keys=len(self._emitted), pending=len(self._window))
@@ -7,10 +7,41 @@ class Errors:
     openid_config_unset = "Error connecting to OctoFarm. 'oidc_client_id' or 'oidc_client_secret' not set"
     config_openid_missing = "Configuration error: 'oidc_client_id' or 'oidc_client_secret' not set"
     ping_setting_unset = "'ping' config value not set. Aborting"
+    network_deadline_exceeded = "OctoFarm did not respond before the request deadline"
+    outbox_unavailable = "The outbox is not available before the plugin was initialized"
+    network_engine_stopped = "The network engine was stopped, OctoFarm calls are no longer accepted"
+    tunnel_stream_reset = "The tunnel stream was reset by the peer or replaced by a new tunnel session"
+    tunnel_stream_timeout = "The tunnel stream did not make progress before its timeout"
+    tunnel_handshake_failed = "OctoFarm did not answer the tunnel handshake as expected"
+    invalid_sha256 = "Expected the SHA-256 of the file as 64 lowercase hexadecimal characters"
+    invalid_job_cursor = "Expected 'after' and 'limit' as non-negative integers and 'sha256' as a SHA-256 of a file"
+    token_malformed = "The bearer token is not a JWT"
+    token_algorithm_unsupported = "The token is not signed with RS256, RS384 or RS512"
+    token_key_unknown = "The token is not signed with a key of OctoFarm's JWKS"
+    token_signature_invalid = "The token signature is invalid"
+    token_expired = "The token expired or has no expiry"
+    token_not_yet_valid = "The token is not valid yet"
+    token_issuer_invalid = "The token was not issued by the configured OctoFarm issuer"
+    token_audience_invalid = "The token is not meant for this OctoPrint"
+    token_audience_unset = "OctoFarm tokens are only accepted once 'oidc_audience' or 'oidc_client_id' is set"
+    token_scope_missing = "The token does not grant the scope this route needs"
+    permission_denied = "Requires an OctoPrint login or a valid OctoFarm token"
+    file_hash_mismatch = "The downloaded file does not match its SHA-256, it was discarded"
+    file_range_invalid = "A file range request was answered with another range"
+    file_too_large_for_cache = "The file is larger than the file cache"
+    file_store_failed = "The cached file could not be added to OctoPrint's file storage"
+    file_not_cached = "No cached file with this SHA-256"
+    peers_unsigned = "Seed lists are only accepted inside a 'grant' signed by OctoFarm"
+    invalid_peer_grant = "Expected 'grant' as a peer grant signed by OctoFarm for this SHA-256, naming at most 16 " \
+                         "companion URLs starting with http:// or https://"
+    peer_grant_mismatch = "The peer grant is for another file"
+    gcode_index_not_found = "No index of a G-code file with this SHA-256, it may not be uploaded or indexed yet"
+
 
 class Keys:
     persistence_uuid_key = "persistence_uuid"
     device_uuid_key = "device_uuid"
+    targets_key = "targets"
 
 
 class Config:
@@ -21,6 +52,83 @@ class Config:
     default_octoprint_host = "http://127.0.0.1"
     default_octofarm_port = 4000
     default_ping_secs = 120
+    default_target_name = "default"
+    default_fanout_workers = 4
+    default_backoff_base_secs = 5
+    default_backoff_max_secs = 300
+    default_initial_delay_max_secs = 30
+    default_token_refresh_margin_secs = 60
+    default_announce_max_silence_secs = 600
+    announce_fingerprint_length = 16
+    default_telemetry_capacity = 500
+    default_telemetry_batch_size = 50
+    default_telemetry_max_age_secs = 30
+    telemetry_gzip_level = 6
+    outbox_folder = "outbox"
+    usage_folder = "usage"
+    gcode_index_folder = "gcode_index"
+    outbox_segment_bytes = 256 * 1024
+    default_outbox_max_bytes = 8 * 1024 * 1024
+    outbox_fsync_every = 20
+    outbox_fsync_interval_secs = 1.0
+    default_outbox_replay_rate = 2.0
+    outbox_replay_max_batches = 20
+    default_http_pool_size = 4
+    default_http_connect_timeout = 5.0
+    default_http_read_timeout = 10.0
+    default_http_retries = 2
+    http_pools_per_session = 4
+    http_retry_backoff_factor = 0.2
+    http_retry_status_codes = (502, 503, 504)
+    default_network_workers = 4
+    default_request_deadline_secs = 30.0
+    network_shutdown_timeout_secs = 5.0
+    default_tunnel_max_streams = 8
+    tunnel_stream_window_bytes = 256 * 1024
+    tunnel_max_frame_bytes = 32 * 1024
+    tunnel_replay_buffer_bytes = 4 * 1024 * 1024
+    tunnel_ack_every = 16
+    tunnel_reconnect_secs = 1
+    tunnel_reconnect_max_secs = 60
+    tunnel_ping_interval_secs = 30
+    tunnel_stream_timeout_secs = 60.0
+    tunnel_allowed_path_prefixes = ("/api/", "/plugin/")
+    default_state_push_rate = 1.0
+    default_state_progress_step = 5
+    default_coalesce_window_secs = 10
+    coalesce_max_keys = 64
+    discovery_ttl_secs = 300
+    discovery_max_candidates = 5
+    diagnostics_ttl_secs = 30
+    diagnostics_failure_ttl_secs = 3
+    diagnostics_stage_timeout_secs = 3.0
+    diagnostics_deadline_secs = 8.0
+    diagnostics_http_deadline_secs = 6.0
+    diagnostics_workers = 6
+    usage_ledger_max_bytes = 1024 * 1024
+    usage_sync_max_records = 2048
+    usage_sync_max_batches = 8
+    usage_compact_min_records = 1024
+    job_history_file = "job_history.db"
+    job_history_max_jobs = 10000
+    job_history_page_size = 100
+    job_history_max_page_size = 1000
+    jwks_ttl_secs = 3600
+    jwks_min_refresh_interval_secs = 30
+    jwt_leeway_secs = 30
+    jwt_memo_size = 1024
+    file_cache_folder = "file_cache"
+    default_file_cache_max_bytes = 1024 * 1024 * 1024
+    file_cache_chunk_bytes = 4 * 1024 * 1024
+    file_cache_download_workers = 2
+    max_file_peers = 16
+    file_peer_max_failures = 3
+    announced_cached_files = 100
+    # OctoPrint's machine code extensions
+    gcode_extensions = (".gcode", ".gco", ".g")
+    gcode_index_chunk_bytes = 1024 * 1024
+    gcode_index_default_feedrate = 1500.0
+    metrics_latency_buckets_secs = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
 
 
 class State:
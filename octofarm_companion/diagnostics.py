@@ -0,0 +1,245 @@
+import json
+import socket
+import ssl
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from threading import Lock
+from urllib.parse import urlsplit
+
+from octofarm_companion.constants import Config
+from octofarm_companion.network import NetworkTimeoutError
+
+OK = "ok"
+WARNING = "warning"
+FAILED = "failed"
+TIMEOUT = "timeout"
+SKIPPED = "skipped"
+
+# In report order, dns, tcp and tls run one after the other, next to the version and token checks
+stage_names = ("dns", "tcp", "tls", "version", "token")
+
+
+def _milliseconds(started, clock):
+    return round((clock() - started) * 1000, 1)
+
+
+def _describe(error):
+    return f"{type(error).__name__}: {error}"
+
+
+def _json_body(response):
+    try:
+        return json.loads(response.text)
+    except (TypeError, ValueError):
+        return None
+
+
+class ConnectionDiagnostics:
+    """Checks stage by stage whether OctoFarm is reachable at a URL, for the connection test of the settings page.
+
+    DNS, TCP connect and TLS handshake run one after the other, concurrently with the 'serverChecks/version' and
+    'oidc/token' calls done by 'fetch_version(url)' and 'fetch_token(url, client_id, client_secret)'. Each stage
+    reports its status, duration and a detail, the whole report is ready after 'deadline' seconds at the latest.
+    Reports are cached per URL and credentials, successful ones for 'ttl' and failed ones for 'failure_ttl'
+    seconds. Concurrent runs for the same URL wait for the one in flight instead of probing again.
+    """
+
+    def __init__(self, fetch_version, fetch_token, ttl=Config.diagnostics_ttl_secs,
+                 failure_ttl=Config.diagnostics_failure_ttl_secs, stage_timeout=Config.diagnostics_stage_timeout_secs,
+                 deadline=Config.diagnostics_deadline_secs, resolve=socket.getaddrinfo,
+                 connect=socket.create_connection, tls_context=None, clock=time.monotonic):
+        self.ttl = ttl
+        self.failure_ttl = failure_ttl
+        self.stage_timeout = stage_timeout
+        self.deadline = deadline
+        self._fetch_version = fetch_version
+        self._fetch_token = fetch_token
+        self._resolve = resolve
+        self._connect = connect
+        self._tls_context = tls_context
+        self._clock = clock
+        self._lock = Lock()
+        self._pool = None
+        # key -> (expires at, report)
+        self._cache = dict()
+        # key -> Future of the report being built
+        self._in_flight = dict()
+        self._counters = dict(runs=0, hits=0, joined=0)
+
+    def run(self, url, client_id=None, client_secret=None):
+        key = (url, client_id, client_secret)
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None and self._clock() < cached[0]:
+                self._counters["hits"] += 1
+                return dict(cached[1], cached=True)
+            in_flight = self._in_flight.get(key)
+            if in_flight is None:
+                self._counters["runs"] += 1
+                future = self._in_flight[key] = Future()
+            else:
+                self._counters["joined"] += 1
+        if in_flight is not None:
+            return dict(in_flight.result(), cached=True)
+
+        try:
+            report = self._diagnose(url, client_id, client_secret)
+        except BaseException as e:
+            with self._lock:
+                del self._in_flight[key]
+            future.set_exception(e)
+            raise
+        with self._lock:
+            del self._in_flight[key]
+            now = self._clock()
+            self._cache = {other: entry for other, entry in self._cache.items() if now < entry[0]}
+            self._cache[key] = (now + (self.ttl if report["ok"] else self.failure_ttl), report)
+        future.set_result(report)
+        return dict(report, cached=False)
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                # Stage checks only, a check which outlives the deadline keeps its worker until it finishes
+                self._pool = ThreadPoolExecutor(max_workers=Config.diagnostics_workers,
+                                                thread_name_prefix="OctoFarmCompanionDiagnostics")
+            return self._pool
+
+    def _diagnose(self, url, client_id, client_secret):
+        started = self._clock()
+        stages = dict()
+        parts = urlsplit(url)
+        if parts.scheme not in ("http", "https") or not parts.hostname:
+            for name in stage_names:
+                stages[name] = self._result(SKIPPED)
+            stages["dns"] = self._result(FAILED, detail=f"Not an http(s) URL: '{url}'")
+            return self._report(url, stages, None, started)
+
+        pool = self._get_pool()
+        futures = {
+            ("dns", "tcp", "tls"): pool.submit(self._check_socket, parts),
+            ("version",): pool.submit(self._check_version, url),
+            ("token",): pool.submit(self._check_token, url, client_id, client_secret),
+        }
+        wait(futures.values(), timeout=self.deadline)
+        version = None
+        for names, future in futures.items():
+            if not future.done():
+                stages.update((name, self._result(TIMEOUT, self.deadline * 1000)) for name in names)
+                continue
+            result = future.result()
+            if names == ("version",):
+                result, version = result
+            stages.update(result)
+        return self._report(url, {name: stages[name] for name in stage_names}, version, started)
+
+    def _report(self, url, stages, version, started):
+        # The socket checks only explain a failure, a proxy may answer although a direct connection fails
+        ok = stages["version"]["status"] == OK and stages["token"]["status"] in (OK, SKIPPED)
+        return dict(url=url, ok=ok, version=version, stages=stages, durationMs=_milliseconds(started, self._clock))
+
+    @staticmethod
+    def _result(status, duration_ms=None, detail=None):
+        return dict(status=status, durationMs=duration_ms, detail=detail)
+
+    def _check_socket(self, parts):
+        secure = parts.scheme == "https"
+        try:
+            port = parts.port or (443 if secure else 80)
+        except ValueError as e:
+            return dict(dns=self._result(FAILED, detail=_describe(e)), tcp=self._result(SKIPPED),
+                        tls=self._result(SKIPPED))
+        results = dict(tcp=self._result(SKIPPED), tls=self._result(SKIPPED))
+
+        started = self._clock()
+        try:
+            addresses = list(dict.fromkeys(info[4][0] for info in
+                                           self._resolve(parts.hostname, port, type=socket.SOCK_STREAM)))
+        except OSError as e:
+            results["dns"] = self._result(FAILED, _milliseconds(started, self._clock), _describe(e))
+            return results
+        results["dns"] = self._result(OK, _milliseconds(started, self._clock), ", ".join(addresses))
+
+        started = self._clock()
+        try:
+            connection = self._connect((addresses[0], port), timeout=self.stage_timeout)
+        except socket.timeout:
+            results["tcp"] = self._result(TIMEOUT, _milliseconds(started, self._clock), f"{addresses[0]}:{port}")
+            return results
+        except OSError as e:
+            results["tcp"] = self._result(FAILED, _milliseconds(started, self._clock), _describe(e))
+            return results
+        results["tcp"] = self._result(OK, _milliseconds(started, self._clock), f"{addresses[0]}:{port}")
+
+        with connection:
+            if secure:
+                results["tls"] = self._check_tls(connection, parts.hostname)
+        return results
+
+    def _check_tls(self, connection, hostname):
+        context = self._tls_context or ssl.create_default_context()
+        started = self._clock()
+        try:
+            with context.wrap_socket(connection, server_hostname=hostname) as tls:
+                return self._result(OK, _milliseconds(started, self._clock), tls.version())
+        except ssl.SSLCertVerificationError as e:
+            # The token call does not verify certificates, a self-signed OctoFarm still works
+            return self._result(WARNING, _milliseconds(started, self._clock), e.verify_message)
+        except socket.timeout:
+            return self._result(TIMEOUT, _milliseconds(started, self._clock))
+        except (OSError, ssl.SSLError) as e:
+            return self._result(FAILED, _milliseconds(started, self._clock), _describe(e))
+
+    def _check_version(self, url):
+        started = self._clock()
+        try:
+            response = self._fetch_version(url)
+        except NetworkTimeoutError as e:
+            return dict(version=self._result(TIMEOUT, _milliseconds(started, self._clock), str(e))), None
+        except Exception as e:
+            return dict(version=self._result(FAILED, _milliseconds(started, self._clock), _describe(e))), None
+        duration_ms = _milliseconds(started, self._clock)
+
+        body = _json_body(response)
+        version = body.get("version") if isinstance(body, dict) else None
+        if not 200 <= response.status_code < 300:
+            return dict(version=self._result(FAILED, duration_ms, f"HTTP {response.status_code}")), None
+        if version is None:
+            return dict(version=self._result(FAILED, duration_ms,
+                                             f"HTTP {response.status_code} without a JSON version")), None
+        return dict(version=self._result(OK, duration_ms, str(version))), str(version)
+
+    def _check_token(self, url, client_id, client_secret):
+        if not client_id or not client_secret:
+            return dict(token=self._result(SKIPPED, detail="No client id and secret provided"))
+        started = self._clock()
+        try:
+            response = self._fetch_token(url, client_id, client_secret)
+        except NetworkTimeoutError as e:
+            return dict(token=self._result(TIMEOUT, _milliseconds(started, self._clock), str(e)))
+        except Exception as e:
+            return dict(token=self._result(FAILED, _milliseconds(started, self._clock), _describe(e)))
+        duration_ms = _milliseconds(started, self._clock)
+
+        # The body holds the access_token, it never ends up in the report
+        body = _json_body(response)
+        if not 200 <= response.status_code < 300:
+            return dict(token=self._result(FAILED, duration_ms, f"HTTP {response.status_code}"))
+        if not isinstance(body, dict) or "access_token" not in body:
+            return dict(token=self._result(FAILED, duration_ms,
+                                           f"HTTP {response.status_code} without an access_token"))
+        return dict(token=self._result(OK, duration_ms, f"expires in {body.get('expires_in')}s"))
+
+    def invalidate(self):
+        with self._lock:
+            self._cache.clear()
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters, cached=len(self._cache))
+
+    def shutdown(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=False)
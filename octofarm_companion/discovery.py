@@ -0,0 +1,111 @@
+import ipaddress
+import socket
+import struct
+import time
+from threading import Lock
+
+from octofarm_companion.constants import Config
+from octofarm_companion.environment import default_route_address, lan_addresses
+
+try:
+    import fcntl
+except ImportError:
+    # Windows, interfaces are approximated by the addresses of the hostname
+    fcntl = None
+
+# ioctl returning the IPv4 address of an interface
+_SIOCGIFADDR = 0x8915
+
+# Bridges of container and VM runtimes, only reachable from this machine
+_virtual_interfaces = ("docker", "br-", "veth", "virbr", "vmnet", "vboxnet", "cni", "flannel", "cali", "podman",
+                       "lxc")
+# VPN and overlay networks, reachable for peers of the same network only
+_tunnel_interfaces = ("tun", "tap", "wg", "tailscale", "zt", "ppp")
+
+
+def interface_addresses():
+    """(interface, IPv4 address) of each interface with an address, including loopback"""
+    if fcntl is None:
+        return [("", address) for address in lan_addresses()] + [("lo", "127.0.0.1")]
+    addresses = []
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as query:
+        for index, name in socket.if_nameindex():
+            try:
+                request = struct.pack("256s", name.encode("utf-8")[:15])
+                response = fcntl.ioctl(query.fileno(), _SIOCGIFADDR, request)
+            except OSError:
+                # Down or without IPv4 address
+                continue
+            addresses.append((name, socket.inet_ntoa(response[20:24])))
+    return addresses
+
+
+def address_score(interface, address, default_address):
+    """How likely OctoFarm reaches this OctoPrint on 'address', higher is better"""
+    ip = ipaddress.ip_address(address)
+    if ip.is_loopback:
+        # Only works when OctoFarm runs on the same machine
+        return 0
+    if ip.is_link_local:
+        return 10
+    score = 50
+    if address == default_address:
+        score += 40
+    if ip.is_private:
+        score += 20
+    if interface.startswith(_virtual_interfaces):
+        score -= 40
+    elif interface.startswith(_tunnel_interfaces):
+        score -= 10
+    return score
+
+
+class AddressDiscovery:
+    """Ranks the addresses OctoFarm may reach this OctoPrint on, so it connects on the first try.
+
+    Each interface address is scored by its kind (default route, private, VPN, container bridge, loopback). They are
+    not probed: a connect from this machine to its own addresses does not show whether OctoFarm reaches them. The
+    ranked list is cached for 'ttl' seconds, a ping only enumerates the interfaces again when it expired.
+    """
+
+    def __init__(self, ttl=Config.discovery_ttl_secs, max_candidates=Config.discovery_max_candidates,
+                 interfaces=interface_addresses, default_address=default_route_address, clock=time.monotonic):
+        self.ttl = ttl
+        self.max_candidates = max_candidates
+        self._interfaces = interfaces
+        self._default_address = default_address
+        self._clock = clock
+        # Held while discovering, concurrent pings wait for one discovery instead of enumerating twice
+        self._lock = Lock()
+        # (announced port, expires at, candidates)
+        self._cached = None
+        self._counters = dict(discoveries=0, hits=0)
+
+    def candidates(self, announced_port):
+        with self._lock:
+            cached = self._cached
+            if cached is not None and cached[0] == announced_port and self._clock() < cached[1]:
+                self._counters["hits"] += 1
+                return cached[2]
+            candidates = self._discover(announced_port)
+            self._cached = (announced_port, self._clock() + self.ttl, candidates)
+            self._counters["discoveries"] += 1
+            return candidates
+
+    def _discover(self, announced_port):
+        default_address = self._default_address()
+        addresses = dict()
+        for interface, address in self._interfaces():
+            addresses.setdefault(address, interface)
+        ranked = sorted((-address_score(interface, address, default_address), address, interface)
+                        for address, interface in addresses.items())
+        return [dict(host=address, port=announced_port, interface=interface)
+                for score, address, interface in ranked[:self.max_candidates]]
+
+    def invalidate(self):
+        with self._lock:
+            self._cached = None
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters, candidates=self._cached[2] if self._cached is not None else None)
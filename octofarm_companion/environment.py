@@ -0,0 +1,114 @@
+import os
+import socket
+from threading import Lock
+
+# Hosts OctoPrint may listen on which do not tell OctoFarm where to connect to
+_unroutable_hosts = frozenset((None, "", "0.0.0.0", "::", "127.0.0.1", "::1", "localhost"))
+
+# Never contacted, connecting a UDP socket only selects the source address of the default route
+_default_route_probe = ("192.0.2.1", 9)
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return f.read()
+    except OSError:
+        return ""
+
+
+def detect_container(root="/", environ=os.environ):
+    """Detects the container runtime the plugin runs in, f.e. to tell OctoFarm the announced port may be mapped"""
+
+    def path(name):
+        return os.path.join(root, name.lstrip("/"))
+
+    cgroup_version = 2 if os.path.exists(path("/sys/fs/cgroup/cgroup.controllers")) else 1
+    cgroup = _read(path("/proc/self/cgroup"))
+    # With cgroup v2 /proc/self/cgroup is only '0::/', the container shows in the mount sources instead
+    mountinfo = _read(path("/proc/self/mountinfo")) if cgroup_version == 2 else ""
+    kubernetes = "KUBERNETES_SERVICE_HOST" in environ or "kubepods" in cgroup or \
+        os.path.exists(path("/var/run/secrets/kubernetes.io/serviceaccount"))
+    podman = environ.get("container") == "podman" or os.path.exists(path("/run/.containerenv"))
+    docker = os.path.exists(path("/.dockerenv")) or "docker" in cgroup or "/docker/containers/" in mountinfo
+
+    runtime = None
+    if kubernetes:
+        runtime = "kubernetes"
+    elif podman:
+        runtime = "podman"
+    elif docker:
+        runtime = "docker"
+    return dict(docker=docker, podman=podman, kubernetes=kubernetes, runtime=runtime, cgroupVersion=cgroup_version)
+
+
+def default_route_address():
+    """Source address of the default route, None without network"""
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as probe:
+            probe.connect(_default_route_probe)
+            return probe.getsockname()[0]
+    except OSError:
+        return None
+
+
+def lan_addresses():
+    """IPv4 addresses of this machine except loopback, the source address of the default route first"""
+    addresses = [default_route_address()]
+    try:
+        for info in socket.getaddrinfo(socket.gethostname(), None, socket.AF_INET, socket.SOCK_STREAM):
+            addresses.append(info[4][0])
+    except OSError:
+        pass
+    return [address for address in dict.fromkeys(addresses) if address and not address.startswith("127.")]
+
+
+class EnvironmentSnapshot:
+    """What the announcement tells OctoFarm about this OctoPrint, probed once instead of on every ping.
+
+    The container runtime cannot change while OctoPrint runs and is detected once. The listening host and port,
+    CORS setting and LAN addresses are cached until 'invalidate', called when settings are saved or the network
+    changed. 'read_settings' returns a dict with host, port, port_override and allow_cross_origin.
+    """
+
+    def __init__(self, read_settings, detect=detect_container, addresses=lan_addresses):
+        self._read_settings = read_settings
+        self._detect = detect
+        self._addresses = addresses
+        self._lock = Lock()
+        self._container = None
+        self._snapshot = None
+        self._counters = dict(probes=0, hits=0)
+
+    def get(self):
+        with self._lock:
+            if self._snapshot is not None:
+                self._counters["hits"] += 1
+                return self._snapshot
+            if self._container is None:
+                self._container = self._detect()
+            self._counters["probes"] += 1
+
+            settings = self._read_settings()
+            addresses = self._addresses()
+            host = settings.get("host")
+            if host in _unroutable_hosts and addresses:
+                # Listening on all interfaces or loopback, OctoFarm can only use a real address
+                host = addresses[0]
+            port = settings.get("port_override")
+            if port is None:
+                # Risk of failure when behind proxy (docker, vm, vpn, rev-proxy)
+                port = settings.get("port")
+            listen_port = settings.get("port")
+            self._snapshot = dict(self._container, host=host, port=int(port) if port is not None else None,
+                                  listenPort=int(listen_port) if listen_port is not None else None,
+                                  allowCrossOrigin=bool(settings.get("allow_cross_origin")), lanAddresses=addresses)
+            return self._snapshot
+
+    def invalidate(self):
+        with self._lock:
+            self._snapshot = None
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters, cached=self._snapshot is not None)
@@ -0,0 +1,258 @@
+import hashlib
+import io
+import os
+import re
+from collections import OrderedDict
+from threading import Lock
+
+from octofarm_companion.constants import Config, Errors
+from octofarm_companion.gcode_index import is_sha256
+
+_file_suffix = ".gcode"
+_part_suffix = ".part"
+_content_range = re.compile(r"bytes (\d+)-(\d+)/(\d+)")
+_read_size = 1024 * 1024
+
+
+class FileHashMismatch(Exception):
+    pass
+
+
+def _content_length(response):
+    try:
+        return int(response.headers.get("Content-Length"))
+    except (TypeError, ValueError):
+        return None
+
+
+class FileCache:
+    """G-code files received from OctoFarm, stored in the plugin data folder under their SHA-256 ('<sha256>.gcode').
+
+    'fetch' downloads a file in Range requests of 'chunk_size' bytes into '<sha256>.part' and only moves it into the
+    cache once its hash matches, so a cached file is always complete. Responses are streamed to the part file, a file
+    larger than the cache is refused by its announced size before its body is read. An interrupted download continues
+    where it stopped, also after a restart. The cache is bounded to 'max_size' bytes, the least recently used files
+    are evicted; the modification time of a file is its last use, so the order survives restarts.
+    """
+
+    def __init__(self, folder, max_size=Config.default_file_cache_max_bytes, chunk_size=Config.file_cache_chunk_bytes):
+        self.folder = folder
+        self.max_size = max_size
+        self.chunk_size = chunk_size
+        os.makedirs(folder, exist_ok=True)
+        self._lock = Lock()
+        # One download per file, a second request for it waits for the first
+        self._download_locks = dict()
+        self._progress = dict()
+        self._counters = dict(hits=0, misses=0, downloaded_bytes=0, resumed=0, evicted=0, mismatches=0)
+
+        cached = []
+        for name in os.listdir(folder):
+            sha256 = name[:-len(_file_suffix)]
+            if name.endswith(_file_suffix) and is_sha256(sha256):
+                stat = os.stat(os.path.join(folder, name))
+                cached.append((stat.st_mtime, sha256, stat.st_size))
+        # Least recently used first
+        self._files = OrderedDict((sha256, size) for mtime, sha256, size in sorted(cached))
+        self._size = sum(self._files.values())
+
+    def _path(self, sha256):
+        return os.path.join(self.folder, sha256 + _file_suffix)
+
+    def path(self, sha256):
+        """The path of the cached file, None when it is not cached. Counts as use of the file."""
+        with self._lock:
+            if sha256 not in self._files:
+                return None
+            self._files.move_to_end(sha256)
+        path = self._path(sha256)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            with self._lock:
+                self._size -= self._files.pop(sha256, 0)
+            return None
+        return path
+
+    def fetch(self, sha256, get_range):
+        """Returns the path of the file with 'sha256', downloaded with 'get_range(start, end)' unless it is cached.
+        'get_range' returns a streamed response for the inclusive byte range, it is closed once read. Raises
+        FileHashMismatch when the downloaded content does not match, the partial download is discarded then."""
+        if not is_sha256(sha256):
+            raise ValueError(Errors.invalid_sha256)
+        path = self.path(sha256)
+        if path is not None:
+            with self._lock:
+                self._counters["hits"] += 1
+            return path
+        with self._lock:
+            download_lock = self._download_locks.setdefault(sha256, Lock())
+        with download_lock:
+            path = self.path(sha256)
+            if path is not None:
+                # Downloaded by a concurrent request
+                with self._lock:
+                    self._counters["hits"] += 1
+                return path
+            with self._lock:
+                self._counters["misses"] += 1
+            try:
+                self._download(sha256, get_range)
+            finally:
+                with self._lock:
+                    self._progress.pop(sha256, None)
+            path = self._add(sha256)
+            with self._lock:
+                # Kept after a failed download, a waiting request retries it with the same lock
+                self._download_locks.pop(sha256, None)
+            return path
+
+    def _download(self, sha256, get_range):
+        part_path = os.path.join(self.folder, sha256 + _part_suffix)
+        digest = hashlib.sha256()
+        position = 0
+        if os.path.exists(part_path):
+            # What arrived before the interruption is hashed again instead of downloaded again
+            with io.open(part_path, "rb") as f:
+                for block in iter(lambda: f.read(_read_size), b""):
+                    digest.update(block)
+                    position += len(block)
+            if position:
+                with self._lock:
+                    self._counters["resumed"] += 1
+
+        total = None
+        with io.open(part_path, "ab") as f:
+            while total is None or position < total:
+                response = get_range(position, position + self.chunk_size - 1)
+                try:
+                    if response.status_code == 416:
+                        # Nothing left after the part, the hash tells whether it is the file
+                        break
+                    if response.status_code == 206:
+                        match = _content_range.fullmatch(response.headers.get("Content-Range", ""))
+                        if match is None or int(match.group(1)) != position:
+                            raise Exception(Errors.file_range_invalid)
+                        total = int(match.group(3))
+                    elif response.status_code == 200:
+                        # Range requests not supported, the whole file comes at once
+                        f.truncate(0)
+                        digest = hashlib.sha256()
+                        position = 0
+                        total = _content_length(response)
+                    else:
+                        raise Exception(f"OctoFarm answered {response.status_code} for file {sha256}")
+
+                    # Checked while reading too, the announced size may be missing or wrong
+                    too_large = total is not None and total > self.max_size
+                    if not too_large:
+                        for data in response.iter_content(_read_size):
+                            if position + len(data) > self.max_size:
+                                too_large = True
+                                break
+                            f.write(data)
+                            digest.update(data)
+                            position += len(data)
+                            with self._lock:
+                                self._counters["downloaded_bytes"] += len(data)
+                                self._progress[sha256] = dict(bytes=position, size=total)
+                    if too_large:
+                        f.close()
+                        os.remove(part_path)
+                        raise Exception(Errors.file_too_large_for_cache)
+                    f.flush()
+                    if response.status_code == 200:
+                        break
+                finally:
+                    response.close()
+            os.fsync(f.fileno())
+
+        if digest.hexdigest() != sha256:
+            os.remove(part_path)
+            with self._lock:
+                self._counters["mismatches"] += 1
+            raise FileHashMismatch(Errors.file_hash_mismatch)
+        os.replace(part_path, self._path(sha256))
+
+    def _add(self, sha256):
+        path = self._path(sha256)
+        size = os.path.getsize(path)
+        evicted = []
+        with self._lock:
+            self._files[sha256] = size
+            self._size += size
+            for other in list(self._files):
+                if self._size <= self.max_size:
+                    break
+                if other != sha256:
+                    self._size -= self._files.pop(other)
+                    evicted.append(other)
+            self._counters["evicted"] += len(evicted)
+        for other in evicted:
+            try:
+                os.remove(self._path(other))
+            except FileNotFoundError:
+                pass
+        return path
+
+    def hashes(self, limit=None):
+        """The SHA-256 of cached files, the most recently used first"""
+        with self._lock:
+            hashes = list(reversed(self._files))
+        return hashes if limit is None else hashes[:limit]
+
+    def downloads(self):
+        with self._lock:
+            return {sha256: dict(progress) for sha256, progress in self._progress.items()}
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters, files=len(self._files), bytes=self._size, max_bytes=self.max_size)
+
+
+class PeerRanges:
+    """'get_range' for FileCache.fetch asking the peers of OctoFarm's seed list before OctoFarm itself.
+
+    Each range is requested from the next peer in turn, so one download spreads over all peers. A peer which does not
+    have the file (404) is asked again for later ranges, a peer which fails otherwise 'max_failures' times in a row,
+    f.e. because it went offline, is dropped. OctoFarm answers when no peer does. Peers are not trusted more than
+    OctoFarm, the cache verifies the hash of the whole file. Transferred bytes are counted by Content-Length.
+    """
+
+    def __init__(self, peers, get_peer_range, get_server_range, max_failures=Config.file_peer_max_failures):
+        self.peers = list(peers)
+        self.max_failures = max_failures
+        self.peer_bytes = 0
+        self.server_bytes = 0
+        self.failed_peers = 0
+        self._get_peer_range = get_peer_range
+        self._get_server_range = get_server_range
+        self._next = 0
+        # peer -> failures in a row
+        self._failures = dict()
+
+    def __call__(self, start, end):
+        for attempt in range(len(self.peers)):
+            peer = self.peers[self._next % len(self.peers)]
+            self._next += 1
+            try:
+                response = self._get_peer_range(peer, start, end)
+            except Exception:
+                response = None
+            if response is not None and response.status_code in (200, 206):
+                self._failures.pop(peer, None)
+                self.peer_bytes += _content_length(response) or 0
+                return response
+            if response is not None:
+                response.close()
+            if response is None or response.status_code != 404:
+                self._failures[peer] = self._failures.get(peer, 0) + 1
+                if self._failures[peer] >= self.max_failures:
+                    self.peers.remove(peer)
+                    self._next -= 1
+                    self.failed_peers += 1
+                    if not self.peers:
+                        break
+        response = self._get_server_range(start, end)
+        self.server_bytes += _content_length(response) or 0
+        return response
@@ -0,0 +1,328 @@
+import hashlib
+import io
+import json
+import math
+import mmap
+import os
+import re
+from threading import Lock
+
+from octofarm_companion.constants import Config
+from octofarm_companion.persistence import JsonFileStore, atomic_write
+
+index_version = 1
+
+_paths_file = "paths.json"
+_sha256_hex = re.compile(r"[0-9a-f]{64}").fullmatch
+
+_G = ord("G")
+_M = ord("M")
+_T = ord("T")
+_X = ord("X")
+_Y = ord("Y")
+_Z = ord("Z")
+_E = ord("E")
+_F = ord("F")
+_P = ord("P")
+_S = ord("S")
+
+
+def is_sha256(value):
+    return _sha256_hex(value) is not None
+
+
+class _GcodeScanner:
+    """Walks G-code lines once, tracking position, extrusion per tool, layers and a time estimate.
+
+    A layer starts at the first extruding move at a new Z height, its offset and time are those of the line which
+    moved to that height, so a Z hop without extrusion is no layer. Move times are distance over feedrate without
+    acceleration, arcs count as their chord: an estimate for ETA and progress, not a simulation.
+    """
+
+    def __init__(self, default_feedrate):
+        self.relative = False
+        self.relative_e = False
+        self.x = self.y = self.z = self.e = 0.0
+        self.feedrate = default_feedrate
+        self.tool = 0
+        self.tools = dict()
+        self.lines = 0
+        self.time = 0.0
+        self.layer_z = None
+        self.layer_started_at = 0.0
+        self.z_moved_at = 0
+        self.z_moved_time = 0.0
+        self.layer_offsets = []
+        self.layer_heights = []
+        self.layer_times = []
+
+    def scan(self, chunk, offset):
+        """Processes the complete lines of 'chunk', which starts at byte 'offset' of the file"""
+        # Moves are nearly every line, their state lives in locals for the slice and is stored back after it
+        relative, relative_e = self.relative, self.relative_e
+        x, y, z, e = self.x, self.y, self.z, self.e
+        feedrate, time, lines = self.feedrate, self.time, self.lines
+        tool, tool_extruded, layer_z = self.tool, 0.0, self.layer_z
+        hypot = math.hypot
+        for line in chunk.split(b"\n"):
+            line_offset = offset
+            offset += len(line) + 1
+            if b";" in line:
+                line = line[:line.index(b";")]
+            words = line.split()
+            if not words:
+                continue
+            lines += 1
+            command = words[0]
+            if command == b"G1" or command == b"G0" or command == b"G2" or command == b"G3":
+                nx, ny, nz = x, y, z
+                extruded = 0.0
+                for word in words[1:]:
+                    axis = word[0]
+                    try:
+                        value = float(word[1:])
+                    except ValueError:
+                        continue
+                    # Most frequent first
+                    if axis == _X:
+                        nx = nx + value if relative else value
+                    elif axis == _Y:
+                        ny = ny + value if relative else value
+                    elif axis == _E:
+                        if relative_e:
+                            extruded = value
+                        else:
+                            extruded = value - e
+                            e = value
+                    elif axis == _F:
+                        if value > 0:
+                            feedrate = value
+                    elif axis == _Z:
+                        nz = nz + value if relative else value
+                if nz != z:
+                    self.z_moved_at, self.z_moved_time = line_offset, time
+                time += (hypot(nx - x, ny - y, nz - z) or abs(extruded)) * 60.0 / feedrate
+                x, y, z = nx, ny, nz
+                if extruded:
+                    tool_extruded += extruded
+                    if extruded > 0 and z != layer_z:
+                        layer_z = z
+                        self._start_layer(z)
+                continue
+
+            first = command[0]
+            if first == _G:
+                if command == b"G92":
+                    x, y, z, e = self._set_position(words, x, y, z, e)
+                elif command == b"G91":
+                    relative = relative_e = True
+                elif command == b"G90":
+                    relative = relative_e = False
+                elif command == b"G4":
+                    time += self._dwell(words)
+            elif first == _M:
+                if command == b"M83":
+                    relative_e = True
+                elif command == b"M82":
+                    relative_e = False
+            elif first == _T:
+                try:
+                    new_tool = int(command[1:])
+                except ValueError:
+                    continue
+                self._add_extruded(tool, tool_extruded)
+                tool, tool_extruded = new_tool, 0.0
+        self._add_extruded(tool, tool_extruded)
+        self.relative, self.relative_e = relative, relative_e
+        self.x, self.y, self.z, self.e = x, y, z, e
+        self.feedrate, self.time, self.lines = feedrate, time, lines
+        self.tool = tool
+
+    def _add_extruded(self, tool, length):
+        if length:
+            self.tools[tool] = self.tools.get(tool, 0.0) + length
+
+    def _start_layer(self, z):
+        if self.layer_z is not None:
+            self.layer_times.append(self.z_moved_time - self.layer_started_at)
+        self.layer_started_at = self.z_moved_time
+        self.layer_z = z
+        self.layer_offsets.append(self.z_moved_at)
+        self.layer_heights.append(round(z, 3))
+
+    @staticmethod
+    def _set_position(words, x, y, z, e):
+        if len(words) == 1:
+            return x, y, z, 0.0
+        for word in words[1:]:
+            try:
+                value = float(word[1:])
+            except ValueError:
+                continue
+            axis = word[0]
+            if axis == _E:
+                e = value
+            elif axis == _X:
+                x = value
+            elif axis == _Y:
+                y = value
+            elif axis == _Z:
+                z = value
+        return x, y, z, e
+
+    @staticmethod
+    def _dwell(words):
+        seconds = 0.0
+        for word in words[1:]:
+            try:
+                value = float(word[1:])
+            except ValueError:
+                continue
+            if word[0] == _P:
+                seconds += value / 1000.0
+            elif word[0] == _S:
+                seconds += value
+        return seconds
+
+    def result(self):
+        layer_times = self.layer_times
+        if self.layer_z is not None:
+            layer_times = layer_times + [self.time - self.layer_started_at]
+        return dict(
+            lines=self.lines,
+            tools={str(tool): round(length, 3) for tool, length in sorted(self.tools.items())},
+            estimatedTime=round(self.time, 1),
+            layers=dict(offsets=self.layer_offsets, z=self.layer_heights,
+                        time=[round(seconds, 1) for seconds in layer_times]),
+        )
+
+
+def index_buffer(buffer, chunk_size=Config.gcode_index_chunk_bytes,
+                 default_feedrate=Config.gcode_index_default_feedrate):
+    """Indexes G-code in 'buffer' (f.e. an mmap) in one pass of 'chunk_size' slices, hashing it on the way.
+
+    Only a slice and the scanner state are in memory at any time, whatever the size of the file.
+    """
+    sha256 = hashlib.sha256()
+    scanner = _GcodeScanner(default_feedrate)
+    size = len(buffer)
+    position = 0
+    while position < size:
+        end = position + chunk_size
+        if end < size:
+            # A line crossing the slice boundary is scanned with the next slice, a line longer than a slice whole
+            newline = buffer.rfind(b"\n", position, end)
+            if newline < 0:
+                newline = buffer.find(b"\n", end)
+            end = newline + 1 if newline >= 0 else size
+        chunk = buffer[position:end]
+        sha256.update(chunk)
+        scanner.scan(chunk, position)
+        position += len(chunk)
+    return dict(scanner.result(), sha256=sha256.hexdigest(), size=size, version=index_version)
+
+
+def map_file(path):
+    """Maps the file at 'path' read only. The mapping keeps the content available after the file was moved or
+    deleted, so it can be indexed after the upload was stored."""
+    with io.open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            # Empty files can not be mapped
+            return b""
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def index_file(path, **kwargs):
+    mapping = map_file(path)
+    try:
+        return index_buffer(mapping, **kwargs)
+    finally:
+        if isinstance(mapping, mmap.mmap):
+            mapping.close()
+
+
+class GcodeIndexStore:
+    """G-code indexes in the plugin data folder, one compact JSON file per content hash ('<sha256>.json').
+
+    Uploading the same file twice or under another name reuses its index. 'paths.json' maps the storage path of
+    each indexed file to its hash, an index is deleted with the last path referencing it.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+        self._lock = Lock()
+        self._paths_store = JsonFileStore(os.path.join(folder, _paths_file))
+        try:
+            self._paths = dict(self._paths_store.load() or {})
+        except ValueError:
+            self._paths = dict()
+        self._counters = dict(indexed=0, reused=0, failed=0)
+
+    def _path(self, sha256):
+        return os.path.join(self.folder, sha256 + ".json")
+
+    def get(self, sha256):
+        """The index as JSON encoded bytes, None when unknown"""
+        if not is_sha256(sha256):
+            return None
+        try:
+            with io.open(self._path(sha256), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, path, index):
+        """Stores 'index' of the file at storage 'path', the same content under another path shares the file"""
+        sha256 = index["sha256"]
+        with self._lock:
+            if os.path.exists(self._path(sha256)):
+                self._counters["reused"] += 1
+            else:
+                atomic_write(self._path(sha256), json.dumps(index, separators=(",", ":")).encode("utf-8"))
+                self._counters["indexed"] += 1
+            self._assign(path, sha256)
+
+    def move(self, source, destination):
+        with self._lock:
+            sha256 = self._paths.pop(source, None)
+            if sha256 is not None:
+                self._assign(destination, sha256)
+
+    def _assign(self, path, sha256):
+        previous = self._paths.get(path)
+        self._paths[path] = sha256
+        self._paths_store.save(self._paths)
+        if previous is not None and previous != sha256:
+            self._delete_unreferenced(previous)
+
+    def remove(self, path):
+        with self._lock:
+            sha256 = self._paths.pop(path, None)
+            if sha256 is None:
+                return
+            self._paths_store.save(self._paths)
+            self._delete_unreferenced(sha256)
+
+    def _delete_unreferenced(self, sha256):
+        if sha256 not in self._paths.values():
+            try:
+                os.remove(self._path(sha256))
+            except FileNotFoundError:
+                pass
+
+    def failed(self):
+        with self._lock:
+            self._counters["failed"] += 1
+
+    def sha256_of(self, path):
+        with self._lock:
+            return self._paths.get(path)
+
+    def paths(self):
+        with self._lock:
+            return dict(self._paths)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters, files=len(set(self._paths.values())))
@@ -0,0 +1,78 @@
+from threading import Lock
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from octofarm_companion.constants import Config
+
+
+def get_base_url(url):
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}".lower()
+
+
+class OctoFarmHttpClient:
+    """Keeps one pooled keep-alive requests.Session per OctoFarm base URL, so consecutive pings reuse the
+    same TCP/TLS connection instead of performing a new handshake each time."""
+
+    def __init__(self,
+                 pool_size=Config.default_http_pool_size,
+                 connect_timeout=Config.default_http_connect_timeout,
+                 read_timeout=Config.default_http_read_timeout,
+                 retries=Config.default_http_retries):
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self._sessions = dict()
+        self._lock = Lock()
+
+    def _create_session(self):
+        retry = Retry(
+            total=self.retries,
+            connect=self.retries,
+            read=0,
+            status=self.retries,
+            backoff_factor=Config.http_retry_backoff_factor,
+            status_forcelist=Config.http_retry_status_codes,
+            # Status retries only for idempotent methods, a 502 after a slow POST may have been processed already
+            allowed_methods=Retry.DEFAULT_ALLOWED_METHODS,
+            raise_on_status=False
+        )
+        # requests keys connection pools by TLS verification too, the token call (verify=False) and the announce
+        # would evict each other's pool and reconnect on every ping with a single pool
+        adapter = HTTPAdapter(pool_connections=Config.http_pools_per_session, pool_maxsize=self.pool_size,
+                              max_retries=retry)
+        session = requests.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def session(self, url):
+        base_url = get_base_url(url)
+        with self._lock:
+            session = self._sessions.get(base_url)
+            if session is None:
+                session = self._create_session()
+                self._sessions[base_url] = session
+            return session
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return self.session(url).request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return self.session(url).get(url, **kwargs)
+
+    def post(self, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return self.session(url).post(url, **kwargs)
+
+    def close(self):
+        with self._lock:
+            sessions = list(self._sessions.values())
+            self._sessions.clear()
+        for session in sessions:
+            session.close()
@@ -0,0 +1,127 @@
+import os
+import random
+import sqlite3
+import time
+from threading import Lock
+
+from octofarm_companion.constants import Config
+
+PRINTING = "printing"
+DONE = "done"
+FAILED = "failed"
+# Printing when OctoPrint stopped, the serial connection and with it the print did not survive
+INTERRUPTED = "interrupted"
+
+_schema = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    revision INTEGER NOT NULL,
+    name TEXT,
+    path TEXT,
+    origin TEXT,
+    sha256 TEXT,
+    state TEXT NOT NULL,
+    reason TEXT,
+    started_at REAL NOT NULL,
+    ended_at REAL,
+    print_time REAL,
+    extruded_mm REAL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS jobs_revision ON jobs (revision);
+CREATE INDEX IF NOT EXISTS jobs_started_at ON jobs (started_at);
+CREATE INDEX IF NOT EXISTS jobs_sha256 ON jobs (sha256, revision);
+"""
+_columns = "revision, job_id, name, path, origin, sha256, state, reason, started_at, ended_at, print_time, extruded_mm"
+_keys = ("revision", "jobId", "name", "path", "origin", "sha256", "state", "reason", "startedAt", "endedAt",
+         "printTime", "extrudedMm")
+
+
+class JobHistory:
+    """Print jobs of this printer in an SQLite database in the plugin data folder, in WAL mode so exports do not block
+    recording a job.
+
+    Every insert or update of a job gives it the next revision. Exports page through the jobs by revision, the last
+    revision of a page is the cursor of the next one, so OctoFarm only fetches jobs which changed since its last sync.
+    Beyond 'max_jobs' the jobs which started first are deleted.
+    """
+
+    def __init__(self, path, max_jobs=Config.job_history_max_jobs, clock=time.time):
+        self.path = path
+        self.max_jobs = max_jobs
+        self._clock = clock
+        self._lock = Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # Used by the event and the HTTP threads, serialized by the lock
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        # A power cut may lose the last transactions, never corrupt the database
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(_schema)
+        self._revision = self._db.execute("SELECT COALESCE(MAX(revision), 0) FROM jobs").fetchone()[0]
+        # Random id of this database, a recreated one starts again at revision 1 and must not match old ETags
+        self._database_id = self._db.execute("PRAGMA user_version").fetchone()[0]
+        if not self._database_id:
+            self._database_id = random.randint(1, 2 ** 31 - 1)
+            self._db.execute(f"PRAGMA user_version = {self._database_id}")
+        with self._lock, self._db:
+            for (job_id,) in self._db.execute("SELECT job_id FROM jobs WHERE state = ?", (PRINTING,)).fetchall():
+                self._update(job_id, state=INTERRUPTED)
+
+    def _next_revision(self):
+        self._revision += 1
+        return self._revision
+
+    def _update(self, job_id, **values):
+        values["revision"] = self._next_revision()
+        assignments = ", ".join(f"{column} = ?" for column in values)
+        self._db.execute(f"UPDATE jobs SET {assignments} WHERE job_id = ?", (*values.values(), job_id))
+
+    def start(self, job_id, name=None, path=None, origin=None, sha256=None):
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO jobs (job_id, revision, name, path, origin, sha256, state, started_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (job_id, self._next_revision(), name, path, origin, sha256, PRINTING, self._clock()))
+            self._prune()
+
+    def finish(self, job_id, state, print_time=None, reason=None, extruded_mm=None):
+        with self._lock, self._db:
+            self._update(job_id, state=state, reason=reason, ended_at=self._clock(), print_time=print_time,
+                         extruded_mm=extruded_mm)
+
+    def _prune(self):
+        count = self._db.execute("SELECT COUNT(*) FROM jobs").fetchone()[0]
+        if count > self.max_jobs:
+            self._db.execute("DELETE FROM jobs WHERE job_id IN "
+                             "(SELECT job_id FROM jobs ORDER BY started_at LIMIT ?)", (count - self.max_jobs,))
+
+    def export(self, after=0, limit=Config.job_history_page_size, sha256=None):
+        """Returns the jobs changed after revision 'after', at most 'limit', oldest change first, with the cursor of
+        the next page and whether there are more"""
+        query = f"SELECT {_columns} FROM jobs WHERE revision > ?"
+        parameters = [after]
+        if sha256 is not None:
+            query += " AND sha256 = ?"
+            parameters.append(sha256)
+        # One more than requested tells whether there is a next page
+        query += " ORDER BY revision LIMIT ?"
+        parameters.append(limit + 1)
+        with self._lock:
+            rows = self._db.execute(query, parameters).fetchall()
+        jobs = [dict(zip(_keys, row)) for row in rows[:limit]]
+        return dict(jobs=jobs, cursor=jobs[-1]["revision"] if jobs else after, more=len(rows) > limit)
+
+    def etag(self):
+        """Changes with every recorded job, which is also when old jobs are deleted. An export with the same
+        parameters is unchanged otherwise."""
+        with self._lock:
+            return f"{self._database_id:x}-{self._revision}"
+
+    def stats(self):
+        with self._lock:
+            count = self._db.execute("SELECT COUNT(*) FROM jobs").fetchone()[0]
+            return dict(jobs=count, revision=self._revision)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
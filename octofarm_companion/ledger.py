@@ -0,0 +1,206 @@
+import io
+import json
+import os
+import struct
+import time
+from threading import Lock
+
+from octofarm_companion.constants import Config
+from octofarm_companion.persistence import atomic_write
+
+# Timestamp in seconds, spool index, extruded mm and job UUID (zero without job), little endian without padding
+record_format = "<IHf16s"
+_record = struct.Struct(record_format)
+record_size = _record.size
+
+_state_file = "state.json"
+_ledger_prefix = "ledger-"
+_ledger_suffix = ".bin"
+_no_job = bytes(16)
+
+
+def _ledger_name(base):
+    return f"{_ledger_prefix}{base:012d}{_ledger_suffix}"
+
+
+def _job_bytes(job_id):
+    if job_id is None:
+        return _no_job
+    return bytes.fromhex(job_id.replace("-", ""))
+
+
+def _job_id(job):
+    if job == _no_job:
+        return None
+    h = job.hex()
+    return f"{h[:8]}-{h[8:12]}-{h[12:16]}-{h[16:20]}-{h[20:]}"
+
+
+class UsageLedger:
+    """Append-only filament usage ledger of one printer, in fixed-width binary records in the plugin data folder.
+
+    A record holds the time, spool, extruded mm and job of one usage report of the pedometer. Records are
+    addressed by their offset since the ledger was created: OctoFarm receives them in bulk with 'read' and 'ack'
+    marks what it stored. 'compact' folds acknowledged records into per-spool totals and rewrites the remaining
+    ones to a new file, which is only switched to once the state referencing it was written. Job ids are UUIDs.
+    """
+
+    def __init__(self, folder, max_size=Config.usage_ledger_max_bytes, clock=time.time):
+        self.folder = folder
+        self.max_size = max_size
+        self._clock = clock
+        self._lock = Lock()
+        self._counters = dict(appended=0, compactions=0, dropped=0)
+
+        os.makedirs(folder, exist_ok=True)
+        state = self._load_state()
+        # Offset of the first record in the ledger file, all before it are in the totals
+        self._base = state.get("base", 0)
+        self._synced = state.get("synced", 0)
+        self._totals = state.get("totals", dict())
+        self._spools = state.get("spools", [])
+        self._spool_indexes = {spool_id: index for index, spool_id in enumerate(self._spools)}
+
+        path = self._path(self._base)
+        for name in os.listdir(folder):
+            # Left over by a compaction interrupted before or after its state was written
+            if name.startswith(_ledger_prefix) and name != os.path.basename(path):
+                os.remove(os.path.join(folder, name))
+        self._file = io.open(path, "ab")
+        size = self._file.tell()
+        if size % record_size:
+            # Torn record of a power cut
+            self._file.truncate(size - size % record_size)
+        self._count = size // record_size
+
+    def _path(self, base):
+        return os.path.join(self.folder, _ledger_name(base))
+
+    def _load_state(self):
+        try:
+            with io.open(os.path.join(self.folder, _state_file), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return dict()
+
+    def _save_state(self):
+        state = dict(base=self._base, synced=self._synced, totals=self._totals, spools=self._spools)
+        atomic_write(os.path.join(self.folder, _state_file), json.dumps(state).encode("utf-8"))
+
+    def _spool_index(self, spool_id):
+        index = self._spool_indexes.get(spool_id)
+        if index is None:
+            index = self._spool_indexes[spool_id] = len(self._spools)
+            self._spools.append(spool_id)
+            self._save_state()
+        return index
+
+    def append(self, usage, job_id=None):
+        """Appends one record per spool of 'usage', a dict of spool id to extruded mm, with a single fsync"""
+        if not usage:
+            return
+        timestamp = int(self._clock())
+        job = _job_bytes(job_id)
+        with self._lock:
+            data = b"".join(_record.pack(timestamp, self._spool_index(spool_id), extruded_mm, job)
+                            for spool_id, extruded_mm in usage.items())
+            self._file.write(data)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._count += len(usage)
+            self._counters["appended"] += len(usage)
+            if self._count * record_size > self.max_size:
+                # OctoFarm did not collect the records for long, the oldest are only kept in the totals
+                self._counters["dropped"] += max(0, self._base + self._count // 2 - self._synced)
+                self._compact(self._base + self._count // 2)
+
+    def read(self, start, limit=Config.usage_sync_max_records):
+        """Returns the raw records from offset 'start', at most 'limit', with the offsets of the first and after the
+        last. Records folded into the totals are skipped."""
+        with self._lock:
+            return self._read(start, limit)
+
+    def pending(self, limit=Config.usage_sync_max_records):
+        """Like 'read', from the first record OctoFarm did not acknowledge yet"""
+        with self._lock:
+            return self._read(self._synced, limit)
+
+    def _read(self, start, limit):
+        start = max(start, self._base)
+        end = min(self._base + self._count, start + limit)
+        if end <= start:
+            return b"", start, start
+        self._file.flush()
+        with io.open(self._path(self._base), "rb") as f:
+            f.seek((start - self._base) * record_size)
+            return f.read((end - start) * record_size), start, end
+
+    def decode(self, data):
+        spools = self.spools()
+        return [dict(timestamp=timestamp, spool_id=spools[index], extruded_mm=extruded_mm, job_id=_job_id(job))
+                for timestamp, index, extruded_mm, job in _record.iter_unpack(data)]
+
+    def ack(self, offset):
+        with self._lock:
+            if offset > self._synced:
+                self._synced = min(offset, self._base + self._count)
+                self._save_state()
+
+    def compact(self, min_records=Config.usage_compact_min_records):
+        """Folds the acknowledged records into the totals once there are at least 'min_records' of them"""
+        with self._lock:
+            if min(self._synced, self._base + self._count) - self._base < min_records:
+                return False
+            self._compact(self._synced)
+            return True
+
+    def _compact(self, until):
+        if until <= self._base:
+            return
+        folded = (until - self._base) * record_size
+        self._file.flush()
+        with io.open(self._path(self._base), "rb") as f:
+            data = f.read()
+        totals = dict(self._totals)
+        for timestamp, index, extruded_mm, job in _record.iter_unpack(data[:folded]):
+            spool_id = self._spools[index]
+            totals[spool_id] = totals.get(spool_id, 0.0) + extruded_mm
+
+        previous = self._path(self._base)
+        atomic_write(self._path(until), data[folded:])
+        self._base = until
+        self._synced = max(self._synced, until)
+        self._totals = totals
+        self._save_state()
+        self._file.close()
+        os.remove(previous)
+        self._file = io.open(self._path(until), "ab")
+        self._count = (len(data) - folded) // record_size
+        self._counters["compactions"] += 1
+
+    def spools(self):
+        with self._lock:
+            return list(self._spools)
+
+    def compacted_totals(self):
+        with self._lock:
+            return dict(self._totals)
+
+    def totals(self):
+        """Extruded mm per spool over the lifetime of the ledger"""
+        with self._lock:
+            data, start, end = self._read(self._base, self._count)
+            totals = dict(self._totals)
+            for timestamp, index, extruded_mm, job in _record.iter_unpack(data):
+                spool_id = self._spools[index]
+                totals[spool_id] = totals.get(spool_id, 0.0) + extruded_mm
+        return {spool_id: round(length, 3) for spool_id, length in totals.items()}
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters, base=self._base, synced=self._synced, end=self._base + self._count,
+                        records=self._count, bytes=self._count * record_size)
+
+    def close(self):
+        with self._lock:
+            self._file.close()
@@ -0,0 +1,89 @@
+import concurrent.futures
+from functools import partial
+from threading import Lock
+
+from octofarm_companion.constants import Config, Errors
+
+
+class NetworkTimeoutError(Exception):
+    pass
+
+
+class NetworkStoppedError(Exception):
+    pass
+
+
+class NetworkEngine:
+    """Runs all outbound OctoFarm calls on a small thread pool, callers wait for them at most a strict deadline.
+
+    The calls are blocking requests calls and a running thread cannot be interrupted. A call which passed its
+    deadline is abandoned: its caller, like a blueprint route, returns at once, but the worker and its pooled connection
+    stay busy until the HTTP connect/read timeouts expire. At shutdown all pending calls are cancelled, their callers
+    return at once and calls which did not start yet never run.
+    """
+
+    def __init__(self, workers=Config.default_network_workers, deadline=Config.default_request_deadline_secs):
+        self.workers = workers
+        self.deadline = deadline
+        self._executor = None
+        self._pending = set()
+        self._stopped = False
+        self._lock = Lock()
+
+    def submit(self, fn, *args, **kwargs):
+        """Schedules a blocking call, returning a concurrent.futures.Future which is cancelled at shutdown"""
+        future = concurrent.futures.Future()
+        with self._lock:
+            if self._stopped:
+                raise NetworkStoppedError(Errors.network_engine_stopped)
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix="OctoFarmCompanionNetwork")
+            self._pending.add(future)
+            self._executor.submit(self._run, future, partial(fn, *args, **kwargs))
+        return future
+
+    def _run(self, future, fn):
+        # Abandoned at its deadline or at shutdown before a worker was free
+        if future.cancelled():
+            with self._lock:
+                self._pending.discard(future)
+            return
+        try:
+            result = fn()
+        except BaseException as e:
+            self._finish(future, lambda: future.set_exception(e))
+        else:
+            self._finish(future, lambda: future.set_result(result))
+
+    def _finish(self, future, set_outcome):
+        with self._lock:
+            self._pending.discard(future)
+            # Cancelled futures keep their state, the result of an abandoned call is dropped
+            if not future.cancelled():
+                set_outcome()
+
+    def call(self, fn, *args, deadline=None, **kwargs):
+        """Runs a blocking call on the engine and waits for its result at most 'deadline' seconds"""
+        return self.result(self.submit(fn, *args, **kwargs), deadline or self.deadline)
+
+    def result(self, future, deadline):
+        try:
+            return future.result(deadline)
+        except concurrent.futures.TimeoutError:
+            with self._lock:
+                future.cancel()
+            raise NetworkTimeoutError(Errors.network_deadline_exceeded)
+        except concurrent.futures.CancelledError:
+            raise NetworkStoppedError(Errors.network_engine_stopped)
+
+    def shutdown(self):
+        with self._lock:
+            self._stopped = True
+            executor = self._executor
+            self._executor = None
+            for future in self._pending:
+                future.cancel()
+            self._pending.clear()
+        if executor is not None:
+            executor.shutdown(wait=False)
@@ -0,0 +1,194 @@
+import io
+import json
+import os
+import time
+from threading import Lock
+
+from octofarm_companion.constants import Config
+from octofarm_companion.persistence import atomic_write
+
+_segment_suffix = ".seg"
+_cursor_file = "cursor.json"
+
+
+def _segment_name(number):
+    return f"{number:08d}{_segment_suffix}"
+
+
+class RateLimiter:
+    """Token bucket allowing 'rate' acquisitions per second with bursts up to 'burst'"""
+
+    def __init__(self, rate, burst=1, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.burst = burst
+        self._clock = clock
+        self._sleep = sleep
+        self._tokens = burst
+        self._updated_at = clock()
+
+    def acquire(self):
+        now = self._clock()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+        if self._tokens < 1:
+            self._sleep((1 - self._tokens) / self.rate)
+            self._tokens = 1
+            self._updated_at = self._clock()
+        self._tokens -= 1
+
+
+class DurableOutbox:
+    """Append-only, size-capped queue of JSON records on disk which survives OctoFarm outages and restarts.
+
+    Records are appended as JSON lines to sequential segment files, fsync'ed in batches of 'fsync_every' records
+    or after 'fsync_interval' seconds. A persisted cursor marks what was delivered: 'read' returns the records after
+    it in order and 'ack' moves it forward, deleting fully delivered segments. When the total size exceeds 'max_size'
+    the oldest segments are dropped. Delivery is at-least-once.
+    """
+
+    def __init__(self, folder, segment_size=Config.outbox_segment_bytes, max_size=Config.default_outbox_max_bytes,
+                 fsync_every=Config.outbox_fsync_every, fsync_interval=Config.outbox_fsync_interval_secs,
+                 clock=time.monotonic):
+        self.folder = folder
+        self.segment_size = segment_size
+        self.max_size = max_size
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self._clock = clock
+        self._lock = Lock()
+        self._file = None
+        self._unsynced = 0
+        self._synced_at = clock()
+        self._counters = dict(appended=0, dropped_segments=0, corrupt=0)
+
+        os.makedirs(folder, exist_ok=True)
+        self._segments = {}
+        for name in os.listdir(folder):
+            if name.endswith(_segment_suffix):
+                self._segments[int(name[:-len(_segment_suffix)])] = os.path.getsize(os.path.join(folder, name))
+        self._cursor = self._load_cursor()
+        # Never append to a segment of an earlier run, its last record may be torn
+        self._active = max(self._segments, default=0) + 1
+
+    def _path(self, number):
+        return os.path.join(self.folder, _segment_name(number))
+
+    def _load_cursor(self):
+        try:
+            with io.open(os.path.join(self.folder, _cursor_file), "r", encoding="utf-8") as f:
+                cursor = json.load(f)
+            return cursor["segment"], cursor["offset"]
+        except (OSError, ValueError, KeyError):
+            return min(self._segments, default=1), 0
+
+    def _save_cursor(self):
+        cursor = dict(segment=self._cursor[0], offset=self._cursor[1])
+        atomic_write(os.path.join(self.folder, _cursor_file), json.dumps(cursor).encode("utf-8"))
+
+    def append(self, record):
+        line = (json.dumps(record, separators=(",", ":")) + "\n").encode("utf-8")
+        with self._lock:
+            if self._file is None:
+                self._file = io.open(self._path(self._active), "ab")
+                self._segments.setdefault(self._active, 0)
+            self._file.write(line)
+            self._segments[self._active] += len(line)
+            self._counters["appended"] += 1
+            self._unsynced += 1
+            if self._unsynced >= self.fsync_every or self._clock() - self._synced_at >= self.fsync_interval:
+                self._sync()
+            if self._segments[self._active] >= self.segment_size:
+                self._roll()
+            self._enforce_max_size()
+
+    def _sync(self):
+        if self._file is None:
+            return
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._synced_at = self._clock()
+
+    def _roll(self):
+        self._sync()
+        self._file.close()
+        self._file = None
+        self._active += 1
+
+    def _enforce_max_size(self):
+        while sum(self._segments.values()) > self.max_size and len(self._segments) > 1:
+            oldest = min(self._segments)
+            if oldest == self._active:
+                return
+            self._delete_segment(oldest)
+            self._counters["dropped_segments"] += 1
+            if self._cursor[0] <= oldest:
+                self._cursor = (oldest + 1, 0)
+                self._save_cursor()
+
+    def _delete_segment(self, number):
+        del self._segments[number]
+        try:
+            os.remove(self._path(number))
+        except FileNotFoundError:
+            pass
+
+    def flush(self):
+        with self._lock:
+            self._sync()
+
+    def read(self, limit):
+        """Returns up to 'limit' undelivered records in order and the position to 'ack' once they are delivered"""
+        records = []
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+            segment, offset = self._cursor
+            for number in sorted(n for n in self._segments if n >= segment):
+                if number != segment:
+                    offset = 0
+                with io.open(self._path(number), "rb") as f:
+                    f.seek(offset)
+                    while len(records) < limit:
+                        line = f.readline()
+                        if not line.endswith(b"\n"):
+                            # Torn record of an earlier crash or an empty tail, an active segment is complete
+                            if line and number != self._active:
+                                self._counters["corrupt"] += 1
+                                offset += len(line)
+                            break
+                        offset += len(line)
+                        try:
+                            records.append(json.loads(line))
+                        except ValueError:
+                            self._counters["corrupt"] += 1
+                segment = number
+                if len(records) >= limit:
+                    break
+        return records, (segment, offset)
+
+    def ack(self, position):
+        with self._lock:
+            self._cursor = position
+            for number in [n for n in self._segments if n < position[0]]:
+                self._delete_segment(number)
+            self._save_cursor()
+
+    def pending_bytes(self):
+        with self._lock:
+            segment, offset = self._cursor
+            pending = sum(size for number, size in self._segments.items() if number > segment)
+            if segment in self._segments:
+                pending += self._segments[segment] - offset
+            return pending
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters, segments=len(self._segments), bytes=sum(self._segments.values()))
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._sync()
+                self._file.close()
+                self._file = None
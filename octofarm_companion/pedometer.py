@@ -0,0 +1,117 @@
+import re
+from threading import Lock
+
+# Parameters are only looked up for the few commands which move or reset the extruder
+_e_parameter = re.compile(r"E([-+]?\d*\.?\d+)").search
+_tool_number = re.compile(r"T(\d+)").match
+
+_moves = frozenset(("G0", "G1", "G2", "G3"))
+
+
+class FilamentPedometer:
+    """Streaming extrusion accounting fed with every G-code line OctoPrint sent to the printer.
+
+    Tracks the E axis incrementally for absolute (G90/M82) and relative (G91/M83) extrusion and G92 resets,
+    attributing the net extruded length in mm to the active spool of the current tool and, while a job is
+    running, to that job. The per-line path does not allocate besides the regex match of extruding moves.
+    """
+
+    def __init__(self, spool_ids=None):
+        # Tool index to spool identifier, unmapped tools fall back to 'tool<index>'
+        self.spool_ids = dict(spool_ids or {})
+        self.relative_extrusion = False
+        self.tool = 0
+        self.job_id = None
+        self.job_extruded = 0.0
+        self.spool_extruded = dict()
+        self._position = 0.0
+        self._tool_extruded = 0.0
+        self._lock = Lock()
+        # Spool totals handed to the usage ledger so far
+        self._taken = dict()
+        self._take_lock = Lock()
+
+    def on_gcode_sent(self, gcode, cmd):
+        if gcode in _moves:
+            if "E" in cmd:
+                match = _e_parameter(cmd)
+                if match is not None:
+                    value = float(match.group(1))
+                    if self.relative_extrusion:
+                        self._position += value
+                        self._extruded(value)
+                    else:
+                        self._extruded(value - self._position)
+                        self._position = value
+        elif gcode == "G92":
+            match = _e_parameter(cmd)
+            if match is not None:
+                self._position = float(match.group(1))
+            elif cmd.strip() == "G92":
+                self._position = 0.0
+        elif gcode == "M83" or gcode == "G91":
+            self.relative_extrusion = True
+        elif gcode == "M82" or gcode == "G90":
+            self.relative_extrusion = False
+        elif gcode == "T":
+            match = _tool_number(cmd)
+            if match is not None:
+                self._switch_tool(int(match.group(1)))
+
+    def _extruded(self, length):
+        self._tool_extruded += length
+        if self.job_id is not None:
+            self.job_extruded += length
+
+    def _switch_tool(self, tool):
+        with self._lock:
+            if self._tool_extruded:
+                spool_id = self.spool_id(self.tool)
+                self.spool_extruded[spool_id] = self.spool_extruded.get(spool_id, 0.0) + self._tool_extruded
+                self._tool_extruded = 0.0
+            self.tool = tool
+
+    def spool_id(self, tool):
+        return self.spool_ids.get(tool, f"tool{tool}")
+
+    def start_job(self, job_id):
+        self.job_id = job_id
+        self.job_extruded = 0.0
+
+    def finish_job(self):
+        """Ends the running job, returning its usage or None when no job was tracked"""
+        if self.job_id is None:
+            return None
+        usage = dict(job_id=self.job_id, extruded_mm=round(self.job_extruded, 3))
+        self.job_id = None
+        self.job_extruded = 0.0
+        return usage
+
+    def _spool_totals(self):
+        # Only the printer communication thread folds the current tool's length into the totals, others read
+        with self._lock:
+            spools = dict(self.spool_extruded)
+            spool_id = self.spool_id(self.tool)
+            spools[spool_id] = spools.get(spool_id, 0.0) + self._tool_extruded
+        return spools
+
+    def spool_usage(self):
+        return {spool_id: round(length, 3) for spool_id, length in self._spool_totals().items() if length}
+
+    def take_spool_usage(self):
+        """Extruded mm per spool since the previous call, lengths below a micrometer are left for the next one"""
+        with self._take_lock:
+            usage = dict()
+            for spool_id, length in self._spool_totals().items():
+                delta = length - self._taken.get(spool_id, 0.0)
+                if abs(delta) >= 0.001:
+                    usage[spool_id] = delta
+                    self._taken[spool_id] = length
+            return usage
+
+    def usage(self):
+        spools = self.spool_usage()
+        job = None
+        if self.job_id is not None:
+            job = dict(job_id=self.job_id, extruded_mm=round(self.job_extruded, 3))
+        return dict(job=job, spools=spools, tool=self.tool, relative_extrusion=self.relative_extrusion)
@@ -0,0 +1,92 @@
+import io
+import json
+import os
+from threading import Lock
+
+
+def _fsync_directory(path):
+    try:
+        fd = os.open(os.path.dirname(path) or ".", os.O_RDONLY)
+    except OSError:
+        # Not supported on every platform (f.e. Windows), the rename itself is still atomic
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def atomic_write(path, data, backup_path=None):
+    """Writes to a temporary file, fsyncs it and renames it over 'path'. A power cut leaves either the old or the
+    new file. With 'backup_path' the replaced file is kept there as previous generation."""
+    temp_path = path + ".tmp"
+    with io.open(temp_path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    if backup_path is not None and os.path.exists(path):
+        os.replace(path, backup_path)
+    os.replace(temp_path, path)
+    _fsync_directory(path)
+
+
+class JsonFileStore:
+    """Crash-safe JSON document file which keeps one previous generation in '<path>.bak' for recovery.
+
+    The loaded document is cached in memory, so repeated loads only cost a stat of the file as long as its
+    modification time, size and inode did not change.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.backup_path = path + ".bak"
+        self._lock = Lock()
+        self._document = None
+        self._stat_key = None
+
+    @staticmethod
+    def _stat_key_of(path):
+        stat = os.stat(path)
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+    @staticmethod
+    def _read(path):
+        with io.open(path, "r", encoding="utf-8") as f:
+            return json.loads(f.read())
+
+    def load(self):
+        """Returns the document, the previous generation when the current file is missing or corrupt, or None when
+        nothing was stored. Raises ValueError when the file is corrupt and no previous generation exists."""
+        with self._lock:
+            try:
+                stat_key = self._stat_key_of(self.path)
+            except FileNotFoundError:
+                stat_key = None
+
+            if stat_key is not None:
+                if stat_key == self._stat_key:
+                    return self._document
+                try:
+                    document = self._read(self.path)
+                    self._document, self._stat_key = document, stat_key
+                    return document
+                except ValueError:
+                    if not os.path.exists(self.backup_path):
+                        raise
+
+            if not os.path.exists(self.backup_path):
+                return None
+            # Crash during a write or a corrupt file, restore the previous generation
+            document = self._read(self.backup_path)
+            self._save(document, keep_backup=False)
+            return document
+
+    def save(self, document):
+        with self._lock:
+            self._save(document, keep_backup=True)
+
+    def _save(self, document, keep_backup):
+        data = json.dumps(document).encode("utf-8")
+        atomic_write(self.path, data, backup_path=self.backup_path if keep_backup else None)
+        self._document = document
+        self._stat_key = self._stat_key_of(self.path)
@@ -0,0 +1,76 @@
+import random
+import time
+from threading import Event, Thread
+
+from octofarm_companion.constants import Config
+
+
+class BackoffScheduler:
+    """Runs 'task' every 'interval' seconds on a daemon thread. The task returns whether it succeeded.
+
+    Failures are retried with decorrelated jitter exponential backoff (capped at 'max_delay') and a success resets
+    to the regular interval. The first run is delayed by a random offset, so a farm booting at once spreads out.
+    """
+
+    def __init__(self, task, interval,
+                 base_delay=Config.default_backoff_base_secs,
+                 max_delay=Config.default_backoff_max_secs,
+                 initial_delay_max=Config.default_initial_delay_max_secs,
+                 clock=time.monotonic, wait=None, rng=None):
+        self.interval = interval
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.initial_delay_max = initial_delay_max
+        self._task = task
+        self._clock = clock
+        self._rng = rng or random.Random()
+        self._backoff = None
+        self._stop_event = Event()
+        # Blocks for the given delay and returns True when the scheduler was stopped meanwhile
+        self._wait = wait or self._stop_event.wait
+        self._thread = None
+        self.failures = 0
+        self.next_run_at = None
+
+    def initial_delay(self):
+        return self._rng.uniform(0, self.initial_delay_max)
+
+    def next_delay(self, success):
+        if success:
+            self._backoff = None
+            self.failures = 0
+            return self.interval
+
+        self.failures += 1
+        previous = self._backoff or self.base_delay
+        self._backoff = min(self.max_delay, self._rng.uniform(self.base_delay, previous * 3))
+        return self._backoff
+
+    def run_once(self):
+        try:
+            success = bool(self._task())
+        except Exception:
+            success = False
+        delay = self.next_delay(success)
+        self.next_run_at = self._clock() + delay
+        return delay
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop_event.clear()
+        self._thread = Thread(target=self.run, name="OctoFarmCompanionScheduler", daemon=True)
+        self._thread.start()
+
+    def run(self):
+        delay = self.initial_delay()
+        self.next_run_at = self._clock() + delay
+        while not self._wait(delay) and not self._stop_event.is_set():
+            delay = self.run_once()
+
+    def stop(self):
+        self._stop_event.set()
+        self._thread = None
+
+    def is_running(self):
+        return self._thread is not None
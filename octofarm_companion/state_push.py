@@ -0,0 +1,115 @@
+import time
+from threading import Condition, Event, Thread
+
+from octofarm_companion.constants import Config
+from octofarm_companion.outbox import RateLimiter
+
+
+class StatePublisher:
+    """Pushes printer state changes to OctoFarm over a persistent connection, so OctoFarm does not have to poll.
+
+    The state is a flat dict (connection, state, job, progress, error). Changes are coalesced per key and sent by a
+    daemon thread in messages of at most 'rate' per second, however often the printer changes state. 'send' gets a
+    message and returns whether it was delivered, undelivered changes stay pending and merge with newer ones. After
+    'resync' the next message carries the full state, f.e. once OctoFarm lost the previous connection's state.
+    """
+
+    def __init__(self, send, rate=Config.default_state_push_rate, clock=time.monotonic, wall_clock=time.time):
+        self._send = send
+        self._wall_clock = wall_clock
+        self._state = dict()
+        # key -> latest value not yet delivered
+        self._pending = dict()
+        self._full = True
+        self._condition = Condition()
+        self._stop_event = Event()
+        # Waiting for a token coalesces the changes arriving meanwhile, stop interrupts the wait
+        self._limiter = RateLimiter(rate, clock=clock, sleep=self._stop_event.wait)
+        self._thread = None
+        self._counters = dict(updates=0, coalesced=0, messages=0, failed=0)
+
+    @property
+    def rate(self):
+        return self._limiter.rate
+
+    @rate.setter
+    def rate(self, rate):
+        self._limiter.rate = rate
+
+    def update(self, key, value):
+        with self._condition:
+            if key in self._state and self._state[key] == value:
+                return
+            self._state[key] = value
+            self._counters["updates"] += 1
+            if key in self._pending:
+                self._counters["coalesced"] += 1
+            self._pending[key] = value
+            self._condition.notify()
+
+    def state(self):
+        with self._condition:
+            return dict(self._state)
+
+    def resync(self):
+        with self._condition:
+            self._full = True
+            self._condition.notify()
+
+    def _has_message(self):
+        return bool(self._pending) or (self._full and bool(self._state))
+
+    def publish_pending(self):
+        """Sends the pending changes, or the full state after a resync, in one message"""
+        with self._condition:
+            if not self._has_message():
+                return False
+            full = self._full
+            changes = dict(self._state) if full else self._pending
+            self._pending = dict()
+            self._full = False
+        message = dict(type="state", timestamp=round(self._wall_clock(), 3), full=full, state=changes)
+        try:
+            delivered = bool(self._send(message))
+        except Exception:
+            delivered = False
+        with self._condition:
+            if delivered:
+                self._counters["messages"] += 1
+                return True
+            self._counters["failed"] += 1
+            self._full = self._full or full
+            # Newer changes made while sending win, the others are retried with their current value
+            for key in changes:
+                if key not in self._pending and key in self._state:
+                    self._pending[key] = self._state[key]
+            return False
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop_event.clear()
+        self._thread = Thread(target=self._run, name="OctoFarmCompanionStatePush", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        with self._condition:
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join(Config.network_shutdown_timeout_secs)
+            self._thread = None
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            with self._condition:
+                self._condition.wait_for(lambda: self._has_message() or self._stop_event.is_set())
+            if self._stop_event.is_set():
+                return
+            self._limiter.acquire()
+            if not self._stop_event.is_set():
+                self.publish_pending()
+
+    def stats(self):
+        with self._condition:
+            return dict(self._counters, pending=len(self._pending), rate=self._limiter.rate)
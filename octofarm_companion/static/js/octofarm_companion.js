@@ -55,11 +55,27 @@ $(function () {
             window.open(currentUrl, '_blank');
         }
 
+        function showConnectionStages(stagesList, report) {
+            stagesList.empty();
+            if (!report || !report.stages) {
+                return;
+            }
+            for (const [name, stage] of Object.entries(report.stages)) {
+                const duration = stage.durationMs === null ? "" : ` (${stage.durationMs} ms)`;
+                const detail = stage.detail ? `: ${stage.detail}` : "";
+                stagesList.append($("<li>").text(`${name} ${stage.status}${duration}${detail}`));
+            }
+            if (report.cached) {
+                stagesList.append($("<li>").text("result of a test a few seconds ago"));
+            }
+        }
+
         self.settings.testUrlBackend = async function () {
             const loader = $("#connection-loader");
             const successBar = $("#connection-success");
             const failureBar = $("#connection-failed");
             const responseVersion = $("#response-version");
+            const stagesList = $("#connection-stages");
 
             const currentUrl = getCurrentProposedUrl();
 
@@ -68,6 +84,7 @@ $(function () {
             loader.show();
             successBar.hide();
             failureBar.hide();
+            stagesList.empty();
             responseVersion[0].innerText = "unset";
             return await fetch(fullUrl, {
                 method: 'POST',
@@ -75,19 +92,22 @@ $(function () {
                     'Content-Type': 'application/json'
                 },
                 body: JSON.stringify({
-                    url: currentUrl
+                    url: currentUrl,
+                    ...getClientIdAndSecret()
                 })
             })
                 .then(async (response) => {
                     try {
+                        // Failed tests answer with the report too, except for invalid input
+                        const report = await response.json().catch(() => null);
                         if (response.status >= 300) {
                             successBar.hide();
                             failureBar.show();
                         } else {
                             successBar.show();
-                            const body = await response.json();
-                            responseVersion[0].innerText = body.version;
+                            responseVersion[0].innerText = report.version;
                         }
+                        showConnectionStages(stagesList, report);
                     } catch (e) {
                         console.log("Error occurred while testing OctoFarm", e);
                     } finally {
@@ -0,0 +1,45 @@
+from functools import partial
+
+from octofarm_companion.announcement import AnnouncementTracker
+from octofarm_companion.constants import Config, State
+from octofarm_companion.token_manager import AccessTokenManager
+
+
+def _ignore(*args, **kwargs):
+    return False
+
+
+class OctoFarmTarget:
+    """One OctoFarm server the companion announces to.
+
+    Every target has its own OIDC credentials, access token, announcement tracker and state, so a production,
+    staging or HA server never shares a session with another one. 'refresh_token' and 'persist_token' are called
+    with the target as first argument.
+    """
+
+    def __init__(self, name, base_url, oidc_client_id, oidc_client_secret, refresh_token=None, persist_token=None,
+                 refresh_margin=Config.default_token_refresh_margin_secs,
+                 max_silence=Config.default_announce_max_silence_secs):
+        self.name = name
+        self.base_url = base_url
+        self.oidc_client_id = oidc_client_id
+        self.oidc_client_secret = oidc_client_secret
+        self.primary = False
+        self.state = State.BOOT
+        self.token_manager = AccessTokenManager(
+            partial(refresh_token, self) if refresh_token is not None else _ignore,
+            partial(persist_token, self) if persist_token is not None else _ignore,
+            refresh_margin=refresh_margin
+        )
+        self.announcement_tracker = AnnouncementTracker(max_silence=max_silence)
+
+    @property
+    def key(self):
+        # A target is recreated, with a fresh token, when its server or credentials change
+        return self.name, self.base_url, self.oidc_client_id, self.oidc_client_secret
+
+    def stats(self):
+        return dict(self.announcement_tracker.stats(), url=self.base_url, state=self.state, primary=self.primary)
+
+    def shutdown(self):
+        self.token_manager.shutdown()
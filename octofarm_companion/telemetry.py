@@ -0,0 +1,164 @@
+import gzip
+import json
+import time
+from collections import OrderedDict
+from itertools import count
+from threading import Condition, Thread
+
+from octofarm_companion.constants import Config
+
+
+def compress_batch(document, compresslevel=Config.telemetry_gzip_level):
+    return gzip.compress(json.dumps(document, separators=(",", ":")).encode("utf-8"), compresslevel)
+
+
+class TelemetryUplink:
+    """Buffers telemetry events in a bounded in-memory ring and hands them to 'send_batch' in batches.
+
+    A batch is flushed once 'batch_size' events are pending or the oldest pending event is 'max_age' seconds old.
+    Events emitted with a key replace the pending event with the same key (coalescing), when the ring is full the
+    oldest event is dropped. Batches which could not be sent are handed to 'spill' (f.e. a durable outbox) or,
+    without it or when spilling fails, put back in front of the ring.
+    """
+
+    def __init__(self, send_batch, spill=None, capacity=Config.default_telemetry_capacity,
+                 batch_size=Config.default_telemetry_batch_size, max_age=Config.default_telemetry_max_age_secs,
+                 clock=time.monotonic, wall_clock=time.time):
+        self.capacity = capacity
+        self.batch_size = batch_size
+        self.max_age = max_age
+        self._send_batch = send_batch
+        self._spill = spill
+        self._clock = clock
+        self._wall_clock = wall_clock
+        self._sequence = count()
+        # (coalesce key or sequence number) -> (enqueued at, event)
+        self._pending = OrderedDict()
+        self._condition = Condition()
+        self._thread = None
+        self._running = False
+        # After a failed batch nothing is flushed before this time, unless forced
+        self._retry_at = None
+        self._counters = dict(emitted=0, coalesced=0, dropped=0, spilled=0, sent_events=0, sent_batches=0,
+                              failed_batches=0)
+
+    def make_event(self, event_type, data):
+        return dict(type=event_type, timestamp=round(self._wall_clock(), 3), data=data)
+
+    def emit(self, event_type, data, key=None):
+        event = self.make_event(event_type, data)
+        with self._condition:
+            self._counters["emitted"] += 1
+            if key is not None and key in self._pending:
+                enqueued_at = self._pending[key][0]
+                self._pending[key] = (enqueued_at, event)
+                self._counters["coalesced"] += 1
+                return
+            if len(self._pending) >= self.capacity:
+                self._pending.popitem(last=False)
+                self._counters["dropped"] += 1
+            self._pending[key if key is not None else next(self._sequence)] = (self._clock(), event)
+            if len(self._pending) >= self.batch_size:
+                self._condition.notify()
+
+    def pending(self):
+        with self._condition:
+            return len(self._pending)
+
+    def _flush_due(self):
+        if not self._pending:
+            return False
+        if self._retry_at is not None and self._clock() < self._retry_at:
+            return False
+        return len(self._pending) >= self.batch_size or self._next_flush_in() <= 0
+
+    def _next_flush_in(self):
+        if not self._pending:
+            return self.max_age
+        if self._retry_at is not None:
+            return max(0.0, self._retry_at - self._clock())
+        oldest_enqueued_at = next(iter(self._pending.values()))[0]
+        return max(0.0, self.max_age - (self._clock() - oldest_enqueued_at))
+
+    def flush(self, force=False):
+        """Sends at most one batch, returns whether a batch was sent"""
+        with self._condition:
+            if not self._pending or not (force or self._flush_due()):
+                return False
+            batch = []
+            while self._pending and len(batch) < self.batch_size:
+                batch.append(self._pending.popitem(last=False))
+
+        events = [entry[1][1] for entry in batch]
+        try:
+            success = bool(self._send_batch(events))
+        except Exception:
+            success = False
+
+        spilled = False
+        if not success and self._spill is not None:
+            try:
+                self._spill(events)
+                spilled = True
+            except Exception:
+                pass
+
+        with self._condition:
+            if success:
+                self._retry_at = None
+                self._counters["sent_batches"] += 1
+                self._counters["sent_events"] += len(batch)
+                return True
+
+            self._counters["failed_batches"] += 1
+            self._retry_at = self._clock() + self.max_age
+            if spilled:
+                self._counters["spilled"] += len(batch)
+            else:
+                self._requeue(batch)
+            return False
+
+    def _requeue(self, batch):
+        # Newer events with the same coalesce key win over the failed ones
+        for key, entry in reversed(batch):
+            if key in self._pending:
+                continue
+            if len(self._pending) >= self.capacity:
+                self._counters["dropped"] += 1
+                continue
+            self._pending[key] = entry
+            self._pending.move_to_end(key, last=False)
+
+    def drain(self):
+        """Removes and returns all pending events, f.e. to persist them at shutdown"""
+        with self._condition:
+            events = [entry[1] for entry in self._pending.values()]
+            self._pending.clear()
+            return events
+
+    def stats(self):
+        with self._condition:
+            return dict(self._counters, pending=len(self._pending))
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._running = True
+        self._thread = Thread(target=self._run, name="OctoFarmCompanionTelemetry", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if not self._running:
+                    return
+                if not self._flush_due():
+                    self._condition.wait(self._next_flush_in())
+                    continue
+            self.flush()
+
+    def stop(self):
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+        self._thread = None
@@ -0,0 +1,97 @@
+import time
+from datetime import datetime
+from threading import RLock, Timer
+
+from octofarm_companion.constants import Config
+
+
+def utc_timestamp():
+    return datetime.utcnow().timestamp()
+
+
+class AccessTokenManager:
+    """Keeps the OIDC access_token in memory and tracks its expiry on a monotonic clock. A background timer
+    refreshes the token 'refresh_margin' seconds ahead of expiry, so the announce path never waits for it."""
+
+    def __init__(self, refresh_token, persist_token, refresh_margin=Config.default_token_refresh_margin_secs,
+                 clock=time.monotonic, wall_clock=utc_timestamp):
+        self.refresh_margin = refresh_margin
+        self._refresh_token = refresh_token
+        self._persist_token = persist_token
+        self._clock = clock
+        self._wall_clock = wall_clock
+        self._lock = RLock()
+        self._access_token = None
+        self._expires_at = None
+        self._refresh_timer = None
+
+    @property
+    def access_token(self):
+        with self._lock:
+            if self._access_token is None or self._clock() >= self._expires_at:
+                return None
+            return self._access_token
+
+    @property
+    def expires_in(self):
+        with self._lock:
+            if self._expires_at is None:
+                return None
+            return self._expires_at - self._clock()
+
+    def needs_refresh(self):
+        with self._lock:
+            return self._access_token is None or self._clock() >= self._expires_at - self.refresh_margin
+
+    def load(self, persisted_data):
+        """Restores a token persisted by an earlier run. The wall clock is only consulted here, once."""
+        access_token = persisted_data.get("access_token", None)
+        expires_in = persisted_data.get("expires_in", None)
+        requested_at = persisted_data.get("requested_at", None)
+        if not access_token or expires_in is None or requested_at is None:
+            return False
+
+        remaining = requested_at + expires_in - self._wall_clock()
+        with self._lock:
+            self._access_token = access_token
+            self._expires_at = self._clock() + remaining
+        if remaining > 0:
+            self._schedule_refresh(remaining)
+        return remaining > 0
+
+    def update(self, at_data):
+        access_token = at_data["access_token"]
+        expires_in = float(at_data["expires_in"])
+        expires_at = self._clock() + expires_in
+        with self._lock:
+            # The same token refreshed with a later expiry is persisted too, or a restart would load the old expiry
+            changed = access_token != self._access_token or expires_at != self._expires_at
+            self._access_token = access_token
+            self._expires_at = expires_at
+        if changed:
+            self._persist_token(at_data)
+        self._schedule_refresh(expires_in)
+        return changed
+
+    def invalidate(self):
+        with self._lock:
+            self._access_token = None
+            self._expires_at = None
+        self._cancel_refresh()
+
+    def _schedule_refresh(self, expires_in):
+        delay = max(expires_in - self.refresh_margin, expires_in / 2)
+        with self._lock:
+            self._cancel_refresh()
+            self._refresh_timer = Timer(delay, self._refresh_token)
+            self._refresh_timer.daemon = True
+            self._refresh_timer.start()
+
+    def _cancel_refresh(self):
+        with self._lock:
+            if self._refresh_timer is not None:
+                self._refresh_timer.cancel()
+                self._refresh_timer = None
+
+    def shutdown(self):
+        self._cancel_refresh()
@@ -0,0 +1,202 @@
+import base64
+import hashlib
+import hmac
+import json
+import time
+from collections import OrderedDict
+from threading import Lock
+
+from octofarm_companion.constants import Config, Errors
+
+# ASN.1 DigestInfo prefix of each hash in a PKCS#1 v1.5 signature (RFC 8017, section 9.2)
+_rsa_algorithms = {
+    "RS256": (hashlib.sha256, bytes.fromhex("3031300d060960864801650304020105000420")),
+    "RS384": (hashlib.sha384, bytes.fromhex("3041300d060960864801650304020205000430")),
+    "RS512": (hashlib.sha512, bytes.fromhex("3051300d060960864801650304020305000440")),
+}
+
+
+class TokenVerificationError(Exception):
+    pass
+
+
+def _b64decode(segment):
+    if isinstance(segment, str):
+        segment = segment.encode("ascii")
+    return base64.urlsafe_b64decode(segment + b"=" * (-len(segment) % 4))
+
+
+def _b64int(segment):
+    return int.from_bytes(_b64decode(segment), "big")
+
+
+def is_jwt(token):
+    """Tells an OctoFarm token apart from an OctoPrint API key, which has no dots"""
+    return token.count(".") == 2
+
+
+def has_scope(claims, scope):
+    """Whether the token grants 'scope', as space separated 'scope' claim (RFC 9068) or 'scp' list"""
+    scopes = claims.get("scope")
+    if isinstance(scopes, str) and scope in scopes.split():
+        return True
+    scopes = claims.get("scp")
+    return isinstance(scopes, list) and scope in scopes
+
+
+def rsa_verify(algorithm, n, e, message, signature):
+    """RSASSA-PKCS1-v1_5 verification: the signature raised to the public exponent must be exactly the padded hash"""
+    hash_function, digest_info = _rsa_algorithms[algorithm]
+    size = (n.bit_length() + 7) // 8
+    if len(signature) != size:
+        return False
+    s = int.from_bytes(signature, "big")
+    if s >= n:
+        return False
+    expected_suffix = digest_info + hash_function(message).digest()
+    expected = b"\x00\x01" + b"\xff" * (size - len(expected_suffix) - 3) + b"\x00" + expected_suffix
+    return hmac.compare_digest(pow(s, e, n).to_bytes(size, "big"), expected)
+
+
+class TokenVerifier:
+    """Verifies OctoFarm's JWT access tokens locally with the public keys of its JWKS, without a call per request.
+
+    The JWKS is fetched once and cached for 'ttl' seconds. A token signed with an unknown key id refetches it, so a
+    key rotation is picked up at once, but at most every 'min_refresh_interval' seconds, so made up key ids do not
+    make the plugin flood OctoFarm. When OctoFarm is unreachable the known keys stay in use. Tokens which passed are
+    remembered until they expire in a bounded LRU, repeated requests with the same token only cost a hash lookup.
+    Only RSA keys are supported (RS256, RS384 and RS512).
+    """
+
+    def __init__(self, fetch_jwks, issuer=None, audience=None, ttl=Config.jwks_ttl_secs,
+                 min_refresh_interval=Config.jwks_min_refresh_interval_secs, leeway=Config.jwt_leeway_secs,
+                 memo_size=Config.jwt_memo_size, clock=time.time):
+        self.issuer = issuer
+        self.audience = audience
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.leeway = leeway
+        self.memo_size = memo_size
+        self._fetch_jwks = fetch_jwks
+        self._clock = clock
+        self._lock = Lock()
+        # Serializes fetching the JWKS, concurrent requests with a new key id wait for one fetch
+        self._fetch_lock = Lock()
+        self._keys = dict()
+        self._fetched_at = None
+        self._attempted_at = None
+        self._memo = OrderedDict()
+        self._counters = dict(verified=0, memoized=0, rejected=0, fetches=0, fetch_errors=0)
+
+    def verify(self, token, check_audience=True):
+        """Returns the claims of 'token', raises TokenVerificationError when it is not valid. Without 'check_audience'
+        tokens meant for other companions pass too, as peer grants for the companions they name"""
+        now = self._clock()
+        key = (hashlib.sha256(token.encode("utf-8")).digest(), check_audience)
+        with self._lock:
+            memo = self._memo.get(key)
+            if memo is not None and memo[1] > now:
+                self._memo.move_to_end(key)
+                self._counters["memoized"] += 1
+                return memo[0]
+        try:
+            claims = self._verify(token, now, check_audience)
+        except TokenVerificationError:
+            with self._lock:
+                self._counters["rejected"] += 1
+            raise
+        with self._lock:
+            self._counters["verified"] += 1
+            self._memo[key] = (claims, claims["exp"] + self.leeway)
+            while len(self._memo) > self.memo_size:
+                self._memo.popitem(last=False)
+        return claims
+
+    def _verify(self, token, now, check_audience):
+        try:
+            header_segment, claims_segment, signature_segment = token.split(".")
+            header = json.loads(_b64decode(header_segment))
+            claims = json.loads(_b64decode(claims_segment))
+            signature = _b64decode(signature_segment)
+        except (ValueError, TypeError):
+            raise TokenVerificationError(Errors.token_malformed)
+        if not isinstance(header, dict) or not isinstance(claims, dict):
+            raise TokenVerificationError(Errors.token_malformed)
+        # Never 'none' or a symmetric algorithm with the public key as secret
+        algorithm = header.get("alg")
+        if algorithm not in _rsa_algorithms:
+            raise TokenVerificationError(Errors.token_algorithm_unsupported)
+
+        public_key = self._key(header.get("kid"))
+        if public_key is None:
+            raise TokenVerificationError(Errors.token_key_unknown)
+        message = f"{header_segment}.{claims_segment}".encode("ascii")
+        if not rsa_verify(algorithm, public_key[0], public_key[1], message, signature):
+            raise TokenVerificationError(Errors.token_signature_invalid)
+
+        self._check_claims(claims, now, check_audience)
+        return claims
+
+    def _check_claims(self, claims, now, check_audience):
+        expires = claims.get("exp")
+        if not isinstance(expires, (int, float)) or expires + self.leeway <= now:
+            raise TokenVerificationError(Errors.token_expired)
+        not_before = claims.get("nbf")
+        if isinstance(not_before, (int, float)) and not_before - self.leeway > now:
+            raise TokenVerificationError(Errors.token_not_yet_valid)
+        if self.issuer is not None and claims.get("iss") != self.issuer:
+            raise TokenVerificationError(Errors.token_issuer_invalid)
+        if check_audience and self.audience is not None:
+            audience = claims.get("aud")
+            if self.audience != audience and not (isinstance(audience, list) and self.audience in audience):
+                raise TokenVerificationError(Errors.token_audience_invalid)
+
+    def _key(self, kid):
+        now = self._clock()
+        with self._lock:
+            fresh = self._fetched_at is not None and now - self._fetched_at < self.ttl
+            if kid in self._keys and fresh:
+                return self._keys[kid]
+        with self._fetch_lock:
+            with self._lock:
+                # Fetched by a concurrent request while this one waited
+                if kid in self._keys and self._fetched_at is not None and now - self._fetched_at < self.ttl:
+                    return self._keys[kid]
+                may_fetch = self._attempted_at is None or now - self._attempted_at >= self.min_refresh_interval
+                if may_fetch:
+                    self._attempted_at = now
+            if may_fetch:
+                self._refresh(now)
+        with self._lock:
+            return self._keys.get(kid)
+
+    def _refresh(self, now):
+        try:
+            jwks = self._fetch_jwks()
+            keys = dict()
+            for jwk in jwks.get("keys", []):
+                if jwk.get("kty") == "RSA" and jwk.get("use", "sig") == "sig":
+                    keys[jwk.get("kid")] = (_b64int(jwk["n"]), _b64int(jwk["e"]))
+        except Exception:
+            # The keys fetched before stay in use until OctoFarm answers again
+            with self._lock:
+                self._counters["fetch_errors"] += 1
+            return
+        with self._lock:
+            if set(self._keys) - set(keys):
+                # Tokens signed with a withdrawn key are no longer accepted
+                self._memo.clear()
+            self._keys = keys
+            self._fetched_at = now
+            self._counters["fetches"] += 1
+
+    def invalidate(self):
+        with self._lock:
+            self._keys = dict()
+            self._fetched_at = None
+            self._attempted_at = None
+            self._memo.clear()
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters, keys=len(self._keys), memo=len(self._memo))
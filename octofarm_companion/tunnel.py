@@ -0,0 +1,452 @@
+import json
+import struct
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import Condition, Lock
+
+import requests
+import websocket
+
+from octofarm_companion.constants import Config, Errors
+from octofarm_companion.scheduler import BackoffScheduler
+
+# Frame type, stream id, sequence number and the highest sequence number received from the peer
+_header = struct.Struct(">BIQQ")
+_window_update = struct.Struct(">I")
+
+HELLO = 1
+WELCOME = 2
+OPEN = 3
+RESPONSE = 4
+DATA = 5
+END = 6
+WINDOW = 7
+RESET = 8
+ACK = 9
+# Printer state pushed by the companion, outside of any stream
+STATE = 10
+
+# Frames about the connection itself are neither numbered nor replayed after a reconnect
+_unsequenced = frozenset((HELLO, WELCOME, ACK))
+
+# Hop-by-hop headers and headers describing the framing of one side, not forwarded through the tunnel
+_unforwarded_headers = frozenset(("connection", "keep-alive", "proxy-authenticate", "proxy-authorization", "te",
+                                  "trailer", "transfer-encoding", "upgrade", "content-length", "host"))
+
+
+class TunnelStreamReset(Exception):
+    pass
+
+
+class TunnelTimeoutError(Exception):
+    pass
+
+
+def forwarded_headers(headers):
+    return {key: value for key, value in headers.items() if key.lower() not in _unforwarded_headers}
+
+
+class TunnelStream:
+    """One HTTP exchange multiplexed over the tunnel.
+
+    Each direction has a flow control window: a writer may only have 'window' bytes in flight, the reader grants
+    more with WINDOW frames as it consumes data. A slow local OctoPrint or a slow OctoFarm therefore never buffers
+    more than a window per stream.
+    """
+
+    def __init__(self, session, stream_id, window):
+        self.session = session
+        self.stream_id = stream_id
+        self.window = window
+        self.request = None
+        self.response = None
+        self.reset = False
+        self._send_window = window
+        self._inbound = deque()
+        self._inbound_ended = False
+        self._consumed = 0
+
+    def _wait(self, predicate, timeout):
+        condition = self.session._condition
+        if not condition.wait_for(lambda: self.reset or predicate(), timeout):
+            raise TunnelTimeoutError(Errors.tunnel_stream_timeout)
+        if self.reset:
+            raise TunnelStreamReset(Errors.tunnel_stream_reset)
+
+    def send_request(self, request):
+        self.session._send(OPEN, self.stream_id, json.dumps(request).encode("utf-8"))
+
+    def send_response(self, status, headers):
+        self.session._send(RESPONSE, self.stream_id, json.dumps(dict(status=status, headers=headers)).encode("utf-8"))
+
+    def wait_response(self, timeout=Config.tunnel_stream_timeout_secs):
+        with self.session._condition:
+            self._wait(lambda: self.response is not None, timeout)
+            return self.response
+
+    def write(self, data, timeout=Config.tunnel_stream_timeout_secs):
+        view = memoryview(data)
+        while view:
+            with self.session._condition:
+                self._wait(lambda: self._send_window > 0, timeout)
+                length = min(len(view), self._send_window, self.session.max_frame)
+                self._send_window -= length
+            self.session._send(DATA, self.stream_id, bytes(view[:length]))
+            view = view[length:]
+
+    def end(self):
+        self.session._send(END, self.stream_id)
+
+    def read(self, timeout=Config.tunnel_stream_timeout_secs):
+        """Returns the next chunk of the body, or b"" once the peer ended it"""
+        update = 0
+        with self.session._condition:
+            self._wait(lambda: self._inbound or self._inbound_ended, timeout)
+            if not self._inbound:
+                return b""
+            chunk = self._inbound.popleft()
+            self._consumed += len(chunk)
+            # Granting in halves keeps the frames few while the writer rarely stalls
+            if self._consumed >= self.window // 2:
+                update = self._consumed
+                self._consumed = 0
+        if update:
+            self.session._send(WINDOW, self.stream_id, _window_update.pack(update))
+        return chunk
+
+    def abort(self):
+        if not self.reset:
+            self.session._send(RESET, self.stream_id)
+        self.close()
+
+    def close(self):
+        self.session._remove_stream(self)
+
+
+class TunnelSession:
+    """Transport independent half of the multiplexed tunnel, used by the companion and by the OctoFarm side.
+
+    Sequenced frames are numbered and kept in a replay buffer until the peer acknowledges them, the highest
+    received number is piggybacked on every frame. After a reconnect both sides retransmit what the other did not
+    receive yet, so streams survive a dropped connection. A session whose replay buffer overflowed cannot be
+    resumed and is replaced by a new one, resetting its streams.
+    """
+
+    def __init__(self, on_open=None, window=Config.tunnel_stream_window_bytes, max_frame=Config.tunnel_max_frame_bytes,
+                 replay_limit=Config.tunnel_replay_buffer_bytes, ack_every=Config.tunnel_ack_every, on_state=None):
+        self.window = window
+        self.max_frame = max_frame
+        self.replay_limit = replay_limit
+        self.ack_every = ack_every
+        self.session_id = None
+        self._on_open = on_open
+        self._on_state = on_state
+        self._condition = Condition()
+        self._send_lock = Lock()
+        self._transport = None
+        self._next_sequence = 1
+        self._received = 0
+        self._received_since_ack = 0
+        # (sequence, frame) not acknowledged by the peer yet
+        self._replay = deque()
+        self._replay_bytes = 0
+        self._replay_complete = True
+        self._streams = dict()
+        self._next_stream_id = 1
+        self._counters = dict(frames_sent=0, frames_received=0, retransmitted=0, resumed=0, streams=0)
+
+    @property
+    def resumable(self):
+        return self.session_id is not None and self._replay_complete
+
+    @property
+    def connected(self):
+        return self._transport is not None
+
+    def hello(self, identity=None):
+        return self._frame(HELLO, 0, 0, dict(identity or {}, sessionId=self.session_id, received=self._received,
+                                             resumable=self.resumable))
+
+    def welcome(self, resumed):
+        return self._frame(WELCOME, 0, 0, dict(sessionId=self.session_id, received=self._received, resumed=resumed))
+
+    def _frame(self, frame_type, stream_id, sequence, document):
+        return _header.pack(frame_type, stream_id, sequence, self._received) + json.dumps(document).encode("utf-8")
+
+    @staticmethod
+    def parse_control(data, expected_type):
+        # A refused connection answers with a close frame instead
+        if len(data) < _header.size or data[0] != expected_type:
+            raise ValueError(Errors.tunnel_handshake_failed)
+        return json.loads(bytes(data[_header.size:]))
+
+    def connect(self, transport, peer_received, resumed=False):
+        """Attaches a connection, retransmitting the frames the peer did not receive"""
+        with self._send_lock:
+            self._acknowledged(peer_received)
+            for sequence, frame in self._replay:
+                transport(frame)
+                self._counters["retransmitted"] += 1
+            if resumed:
+                self._counters["resumed"] += 1
+            self._transport = transport
+
+    def detach(self):
+        with self._send_lock:
+            self._transport = None
+
+    def reset(self, session_id):
+        """Starts a new session, streams of the previous one fail with TunnelStreamReset"""
+        with self._send_lock, self._condition:
+            for stream in self._streams.values():
+                stream.reset = True
+            self._streams.clear()
+            self._condition.notify_all()
+            self.session_id = session_id
+            self._next_sequence = 1
+            self._received = 0
+            self._received_since_ack = 0
+            self._replay.clear()
+            self._replay_bytes = 0
+            self._replay_complete = True
+
+    def _acknowledged(self, sequence):
+        while self._replay and self._replay[0][0] <= sequence:
+            self._replay_bytes -= len(self._replay.popleft()[1])
+
+    def _send(self, frame_type, stream_id=0, payload=b""):
+        with self._send_lock:
+            sequence = 0
+            if frame_type not in _unsequenced:
+                sequence = self._next_sequence
+                self._next_sequence += 1
+            frame = _header.pack(frame_type, stream_id, sequence, self._received) + payload
+            self._received_since_ack = 0
+            if sequence:
+                if self._replay_bytes + len(frame) <= self.replay_limit:
+                    self._replay.append((sequence, frame))
+                    self._replay_bytes += len(frame)
+                else:
+                    self._replay_complete = False
+            self._counters["frames_sent"] += 1
+            if self._transport is not None:
+                try:
+                    self._transport(frame)
+                except Exception:
+                    # The connection loop notices the broken connection and resumes, the frame is in the replay
+                    self._transport = None
+
+    def feed(self, data):
+        frame_type, stream_id, sequence, acknowledged = _header.unpack_from(data)
+        payload = data[_header.size:]
+        send_ack = False
+        with self._send_lock:
+            self._acknowledged(acknowledged)
+            if sequence:
+                if sequence <= self._received:
+                    # Retransmitted before our acknowledgement reached the peer
+                    return
+                self._received = sequence
+                self._received_since_ack += 1
+                send_ack = self._received_since_ack >= self.ack_every
+            self._counters["frames_received"] += 1
+        if send_ack:
+            self._send(ACK)
+        if frame_type == STATE:
+            return self._on_state(json.loads(bytes(payload))) if self._on_state is not None else None
+
+        opened = None
+        with self._condition:
+            if frame_type == OPEN:
+                opened = TunnelStream(self, stream_id, self.window)
+                opened.request = json.loads(bytes(payload))
+                self._streams[stream_id] = opened
+                self._counters["streams"] += 1
+                return self._on_open(opened) if self._on_open is not None else None
+            stream = self._streams.get(stream_id)
+            if stream is None:
+                return
+            if frame_type == DATA:
+                stream._inbound.append(bytes(payload))
+            elif frame_type == END:
+                stream._inbound_ended = True
+            elif frame_type == RESPONSE:
+                stream.response = json.loads(bytes(payload))
+            elif frame_type == WINDOW:
+                stream._send_window += _window_update.unpack_from(payload)[0]
+            elif frame_type == RESET:
+                stream.reset = True
+                del self._streams[stream_id]
+            self._condition.notify_all()
+
+    def send_state(self, document):
+        """Sends a state message, numbered like stream frames so a resumed session does not lose it"""
+        self._send(STATE, 0, json.dumps(document, separators=(",", ":")).encode("utf-8"))
+
+    def open_stream(self, request):
+        """Opens a stream carrying 'request' to the peer, used by the OctoFarm side"""
+        with self._condition:
+            stream = TunnelStream(self, self._next_stream_id, self.window)
+            self._next_stream_id += 1
+            self._streams[stream.stream_id] = stream
+            self._counters["streams"] += 1
+        stream.send_request(request)
+        return stream
+
+    def _remove_stream(self, stream):
+        with self._condition:
+            # After a session reset the id may belong to a stream of the new session
+            if self._streams.get(stream.stream_id) is stream:
+                del self._streams[stream.stream_id]
+
+    def stats(self):
+        with self._send_lock, self._condition:
+            return dict(self._counters, open_streams=len(self._streams), replay_bytes=self._replay_bytes,
+                        connected=self._transport is not None, session_id=self.session_id)
+
+
+class TunnelClient:
+    """Keeps one multiplexed WebSocket open to OctoFarm and proxies the API requests OctoFarm sends over it to the
+    local OctoPrint server, so OctoFarm reaches printers behind Docker, VPN or NAT without knowing their address.
+
+    'get_connection' returns the WebSocket URL and headers, or None while no access token is available. Lost
+    connections are re-established with the backoff scheduler and resume the session. 'on_session' is called when
+    a new session started instead, OctoFarm lost everything sent over the previous one.
+    """
+
+    def __init__(self, get_connection, local_base_url, identity=None, max_streams=Config.default_tunnel_max_streams,
+                 allowed_prefixes=Config.tunnel_allowed_path_prefixes, logger=None,
+                 window=Config.tunnel_stream_window_bytes, reconnect_secs=Config.tunnel_reconnect_secs,
+                 on_session=None, connect=websocket.create_connection):
+        self.local_base_url = local_base_url.rstrip("/")
+        self.allowed_prefixes = tuple(allowed_prefixes)
+        self.identity = identity or {}
+        self.session = TunnelSession(on_open=self._on_open, window=window)
+        self._get_connection = get_connection
+        self._on_session = on_session
+        self._connect = connect
+        self._logger = logger
+        self._http = requests.Session()
+        self._workers = ThreadPoolExecutor(max_workers=max_streams, thread_name_prefix="OctoFarmCompanionTunnel")
+        self._websocket = None
+        self._lock = Lock()
+        self._running = False
+        # A dropped connection is resumed after 'reconnect_secs', failed connects back off up to a minute
+        self._scheduler = BackoffScheduler(self.serve_once, reconnect_secs, base_delay=reconnect_secs,
+                                           max_delay=Config.tunnel_reconnect_max_secs, initial_delay_max=0)
+
+    def start(self):
+        self._running = True
+        self._scheduler.start()
+
+    def stop(self):
+        self._running = False
+        self._scheduler.stop()
+        with self._lock:
+            connection = self._websocket
+        if connection is not None:
+            connection.close()
+        self.session.reset(None)
+        self._workers.shutdown(wait=False)
+        self._http.close()
+
+    def serve_once(self):
+        """Connects, performs the handshake and proxies until the connection drops. Returns False when no
+        connection could be established, so the scheduler backs off."""
+        connection = self._get_connection()
+        if connection is None or not self._running:
+            return False
+        url, headers = connection
+        try:
+            connection = self._connect(url, header=[f"{key}: {value}" for key, value in headers.items()],
+                                       timeout=Config.tunnel_ping_interval_secs, enable_multithread=True)
+            connection.send_binary(self.session.hello(self.identity))
+            opcode, data = connection.recv_data()
+            welcome = TunnelSession.parse_control(data, WELCOME)
+        except (websocket.WebSocketException, OSError, ValueError) as e:
+            self._log_error(f"{type(e).__name__}: OctoFarm tunnel could not be established")
+            return False
+
+        with self._lock:
+            self._websocket = connection
+        try:
+            if not welcome["resumed"]:
+                self.session.reset(welcome["sessionId"])
+            self.session.connect(connection.send_binary, welcome["received"], resumed=welcome["resumed"])
+            if not welcome["resumed"] and self._on_session is not None:
+                self._on_session()
+            while self._running:
+                try:
+                    opcode, data = connection.recv_data()
+                except websocket.WebSocketTimeoutException:
+                    connection.ping()
+                    continue
+                if opcode == websocket.ABNF.OPCODE_CLOSE:
+                    break
+                if opcode == websocket.ABNF.OPCODE_BINARY:
+                    self.session.feed(data)
+        except (websocket.WebSocketException, OSError) as e:
+            self._log_error(f"{type(e).__name__}: OctoFarm tunnel connection was lost, resuming")
+        finally:
+            self.session.detach()
+            with self._lock:
+                self._websocket = None
+            connection.close()
+        return True
+
+    def push_state(self, document):
+        """Returns False while disconnected, the caller keeps the state until the tunnel is back"""
+        if not self.session.connected:
+            return False
+        self.session.send_state(document)
+        return True
+
+    def _on_open(self, stream):
+        self._workers.submit(self._proxy, stream)
+
+    def _request_body(self, stream):
+        while True:
+            chunk = stream.read()
+            if not chunk:
+                return
+            yield chunk
+
+    def _proxy(self, stream):
+        request = stream.request
+        path = request.get("path", "")
+        try:
+            if not path.startswith(self.allowed_prefixes):
+                stream.send_response(403, {})
+                stream.end()
+                return
+            body = self._request_body(stream) if request.get("body") else None
+            try:
+                response = self._http.request(request.get("method", "GET"), self.local_base_url + path,
+                                              headers=forwarded_headers(request.get("headers", {})), data=body,
+                                              stream=True, allow_redirects=False,
+                                              timeout=Config.tunnel_stream_timeout_secs)
+            except requests.exceptions.RequestException as e:
+                self._log_error(f"{type(e).__name__}: tunneled request to OctoPrint failed")
+                stream.send_response(502, {})
+                stream.end()
+                return
+            with response:
+                stream.send_response(response.status_code, forwarded_headers(response.headers))
+                # Forwarded as received, a compressed body stays compressed
+                for chunk in response.raw.stream(stream.session.max_frame, decode_content=False):
+                    stream.write(chunk)
+            stream.end()
+        except (TunnelStreamReset, TunnelTimeoutError):
+            stream.abort()
+        except Exception as e:
+            self._log_error(f"{type(e).__name__}: tunneled request to OctoPrint failed. Exception: " + str(e))
+            stream.abort()
+        finally:
+            stream.close()
+
+    def _log_error(self, message):
+        if self._logger is not None:
+            self._logger.error(message)
+
+    def stats(self):
+        return dict(self.session.stats(), failures=self._scheduler.failures)
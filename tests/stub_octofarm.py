@@ -0,0 +1,228 @@
+import base64
+import hashlib
+import json
+import re
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from random import choice
+from string import ascii_uppercase
+
+from octofarm_companion.constants import Config
+from tests.utils import create_jwk, create_jwt
+
+_authorized_routes = ("octoprint/announce", "octoprint/heartbeat", "octoprint/telemetry")
+_files_route = "/octoprint/files/"
+_range = re.compile(r"bytes=(\d+)-(\d*)")
+
+
+class StubOctoFarmHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        self.server.count_connection()
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return self.rfile.read(length) if length else b""
+
+    def _send_json(self, status, data):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _inject_faults(self):
+        """Sleeps the configured latency, returns True when an error response was sent instead of the route"""
+        latency = self.server.latency
+        if latency:
+            time.sleep(latency)
+        if self.server.should_fail():
+            self._send_json(self.server.error_status, {"error": "injected"})
+            return True
+        return False
+
+    def do_GET(self):
+        self.server.count_request(self.path)
+        if self._inject_faults():
+            return
+        if self.path.rstrip("/").endswith("serverChecks/version"):
+            return self._send_json(200, {"version": self.server.version})
+        if self.path.endswith("oidc/jwks") and self.server.signing_key is not None:
+            return self._send_json(200, {"keys": [create_jwk(self.server.signing_key, "stub-key")]})
+        if self.path.startswith(_files_route):
+            return self._send_file(self.path[len(_files_route):])
+        return self._send_json(404, {})
+
+    def _send_file(self, sha256):
+        authorization = self.headers.get("Authorization", "")
+        if not self.server.is_valid_token(authorization[len("Bearer "):]):
+            return self._send_json(401, {"error": "invalid_token"})
+        data = self.server.files.get(sha256)
+        if data is None:
+            return self._send_json(404, {})
+        match = _range.fullmatch(self.headers.get("Range", ""))
+        if match is None:
+            status, body = 200, data
+        else:
+            start = int(match.group(1))
+            end = min(int(match.group(2) or len(data) - 1), len(data) - 1)
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{len(data)}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            status, body = 206, data[start:end + 1]
+        self.send_response(status)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(len(body)))
+        if status == 206:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{len(data)}")
+        self.end_headers()
+        self.server.count_file_bytes(len(body))
+        self.server.pace_upload(len(body))
+        self.wfile.write(body)
+
+    def do_POST(self):
+        self._read_body()
+        self.server.count_request(self.path)
+        if self._inject_faults():
+            return
+        if self.path.endswith("oidc/token"):
+            authorization = self.headers.get("Authorization", "")
+            client_id = None
+            if authorization.startswith("Basic "):
+                client_id = base64.b64decode(authorization[len("Basic "):]).decode("utf-8").partition(":")[0]
+            return self._send_json(200, dict(self.server.issue_token(client_id), token_type="Bearer"))
+        if self.path.endswith(_authorized_routes):
+            authorization = self.headers.get("Authorization", "")
+            if not self.server.is_valid_token(authorization[len("Bearer "):]):
+                return self._send_json(401, {"error": "invalid_token"})
+            if self.path.endswith("octoprint/announce"):
+                return self._send_json(200, {"announced": True})
+            return self._send_json(200, {})
+        return self._send_json(404, {})
+
+
+class StubOctoFarmServer(ThreadingHTTPServer):
+    """Minimal OctoFarm imitation serving the routes used by the companion. It counts accepted TCP connections,
+    which equals the number of TLS handshakes a real HTTPS deployment would perform.
+
+    'files' maps the SHA-256 of G-code files to their content, served with Range support at 'octoprint/files/<sha256>',
+    all downloads share an uplink of 'upload_rate' bytes per second when set. With a 'signing_key' (see
+    tests.utils.create_rsa_key) the access tokens are JWTs signed with it for the requesting client id with
+    'token_scope', its public key is served at 'oidc/jwks', and 'issue_grant' hands out peer grants.
+    Faults can be injected while it runs: 'latency' delays every response by that many seconds, a share of
+    'error_rate' requests is answered with 'error_status' and issued tokens are rejected with a 401 once
+    'token_expires_in' seconds passed or after 'expire_tokens'.
+    """
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, host="127.0.0.1", port=0, version="stub-version", token_expires_in=3600, latency=0.0,
+                 error_rate=0.0, error_status=503, seed=None, upload_rate=None, signing_key=None):
+        super().__init__((host, port), StubOctoFarmHandler)
+        self.version = version
+        self.token_expires_in = token_expires_in
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.connections = 0
+        self.files = dict()
+        self.file_bytes = 0
+        self.upload_rate = upload_rate
+        self.signing_key = signing_key
+        self.token_scope = "companion:read companion:write companion:files"
+        self._upload_free_at = 0.0
+        self.requests = dict()
+        self._random = random.Random(seed)
+        # access_token -> monotonic expiry
+        self._tokens = dict()
+        self._counter_lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def count_connection(self):
+        with self._counter_lock:
+            self.connections += 1
+
+    def count_request(self, path):
+        with self._counter_lock:
+            self.requests[path] = self.requests.get(path, 0) + 1
+
+    def count_file_bytes(self, size):
+        with self._counter_lock:
+            self.file_bytes += size
+
+    def pace_upload(self, size):
+        """Sleeps until the shared uplink sent 'size' more bytes after the ones already queued"""
+        if not self.upload_rate:
+            return
+        with self._counter_lock:
+            self._upload_free_at = max(self._upload_free_at, time.monotonic()) + size / self.upload_rate
+            done_at = self._upload_free_at
+        time.sleep(max(0.0, done_at - time.monotonic()))
+
+    def add_file(self, data):
+        sha256 = hashlib.sha256(data).hexdigest()
+        self.files[sha256] = data
+        return sha256
+
+    def total_requests(self):
+        with self._counter_lock:
+            return sum(self.requests.values())
+
+    def should_fail(self):
+        if not self.error_rate:
+            return False
+        with self._counter_lock:
+            return self._random.random() < self.error_rate
+
+    def issue_token(self, client_id=None):
+        token = ''.join(choice(ascii_uppercase) for i in range(Config.access_token_length))
+        if self.signing_key is not None:
+            claims = dict(sub=token, aud=client_id, scope=self.token_scope,
+                          exp=int(time.time()) + self.token_expires_in)
+            token = create_jwt(self.signing_key, claims, "stub-key")
+        with self._counter_lock:
+            self._tokens[token] = time.monotonic() + self.token_expires_in
+        return dict(access_token=token, expires_in=self.token_expires_in)
+
+    def issue_grant(self, sha256, peers, audience):
+        """Peer grant for the file with 'sha256': its seed list 'peers', accepted by the companions with the client
+        ids in 'audience'"""
+        claims = dict(sub="peer-grant", aud=list(audience), scope="companion:peer", sha256=sha256, peers=list(peers),
+                      exp=int(time.time()) + self.token_expires_in)
+        return create_jwt(self.signing_key, claims, "stub-key")
+
+    def is_valid_token(self, token):
+        with self._counter_lock:
+            expires_at = self._tokens.get(token)
+        return expires_at is not None and time.monotonic() < expires_at
+
+    def expire_tokens(self):
+        """Rejects every issued token from now on, like an OctoFarm restart with a new signing key"""
+        with self._counter_lock:
+            self._tokens.clear()
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,86 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+
+class StubOctoPrintHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_body(self):
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(b";")[0], 16)
+                if size == 0:
+                    self.rfile.readline()
+                    return b"".join(chunks)
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+        length = int(self.headers.get("Content-Length", 0))
+        return self.rfile.read(length) if length else b""
+
+    def _send(self, status, body, content_type="application/json"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        self.server.count_request(url.path)
+        if url.path == "/api/version":
+            return self._send(200, json.dumps({"server": "1.9.0", "api": "0.1"}).encode("utf-8"))
+        if url.path == "/api/files/blob":
+            size = int(parse_qs(url.query).get("size", ["0"])[0])
+            return self._send(200, self.server.blob(size), "application/octet-stream")
+        if url.path == "/private":
+            return self._send(200, b"{}")
+        return self._send(404, b"{}")
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        body = self._read_body()
+        self.server.count_request(url.path)
+        if url.path == "/api/echo":
+            return self._send(200, body, self.headers.get("Content-Type", "application/octet-stream"))
+        return self._send(404, b"{}")
+
+
+class StubOctoPrintServer(ThreadingHTTPServer):
+    """Local OctoPrint imitation behind the tunnel, serving a version route, binary blobs and an echo route"""
+    daemon_threads = True
+
+    def __init__(self, host="127.0.0.1", port=0):
+        super().__init__((host, port), StubOctoPrintHandler)
+        self.requests = dict()
+        self._blobs = dict()
+        self._lock = threading.Lock()
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def count_request(self, path):
+        with self._lock:
+            self.requests[path] = self.requests.get(path, 0) + 1
+
+    def blob(self, size):
+        with self._lock:
+            if size not in self._blobs:
+                self._blobs[size] = bytes(i % 251 for i in range(size))
+            return self._blobs[size]
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,149 @@
+import asyncio
+import threading
+import uuid
+
+import tornado.httpserver
+import tornado.netutil
+import tornado.web
+import tornado.websocket
+
+from octofarm_companion.tunnel import HELLO, TunnelSession
+
+
+class StubTunnelHandler(tornado.websocket.WebSocketHandler):
+    def initialize(self, server):
+        self.stub = server
+        self.greeted = False
+        self.rejected = False
+
+    def open(self):
+        if self.stub.token is not None and self.request.headers.get("Authorization") != "Bearer " + self.stub.token:
+            self.rejected = True
+            self.close(code=4001)
+            return
+        self.stub.connections += 1
+
+    def on_message(self, message):
+        if self.rejected:
+            return
+        if not self.greeted:
+            self.greeted = True
+            self.stub.attach(self, TunnelSession.parse_control(message, HELLO))
+            return
+        self.stub.session.feed(message)
+
+    def on_close(self):
+        self.stub.detach(self)
+
+
+class StubTunnelServer:
+    """OctoFarm side of the tunnel: accepts the companion's WebSocket and sends HTTP requests through it.
+
+    'request' may be called from any thread and concurrently, 'drop_connection' closes the WebSocket to exercise
+    session resumption.
+    """
+
+    def __init__(self, host="127.0.0.1", token=None, window=None):
+        self.token = token
+        # State messages pushed by the companion
+        self.states = []
+        self.session = TunnelSession(on_state=self.states.append) if window is None else \
+            TunnelSession(window=window, on_state=self.states.append)
+        self.connections = 0
+        self.hellos = []
+        self._handler = None
+        self._sockets = tornado.netutil.bind_sockets(0, host)
+        self._loop = asyncio.new_event_loop()
+        self._ready = threading.Event()
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._sockets[0].getsockname()[:2]
+        return f"ws://{host}:{port}/octoprint/tunnel"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        self._ready.wait(5)
+        return self
+
+    async def _listen(self):
+        application = tornado.web.Application([(r"/octoprint/tunnel", StubTunnelHandler, dict(server=self))])
+        self._http_server = tornado.httpserver.HTTPServer(application)
+        self._http_server.add_sockets(self._sockets)
+
+    def _run(self):
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_until_complete(self._listen())
+        self._ready.set()
+        self._loop.run_forever()
+
+    def _transport(self, handler):
+        def write(frame):
+            self._loop.call_soon_threadsafe(self._write, handler, frame)
+
+        return write
+
+    @staticmethod
+    def _write(handler, frame):
+        try:
+            handler.write_message(frame, binary=True)
+        except tornado.websocket.WebSocketClosedError:
+            pass
+
+    def attach(self, handler, hello):
+        self.hellos.append(hello)
+        resumed = bool(hello["resumable"]) and hello["sessionId"] == self.session.session_id and \
+            self.session.resumable
+        if not resumed:
+            self.session.reset(str(uuid.uuid4()))
+        handler.write_message(self.session.welcome(resumed), binary=True)
+        self._handler = handler
+        self.session.connect(self._transport(handler), hello["received"] if resumed else 0, resumed=resumed)
+
+    def detach(self, handler):
+        if handler is self._handler:
+            self._handler = None
+            self.session.detach()
+
+    def wait_connected(self, timeout=5):
+        waited = threading.Event()
+        for i in range(int(timeout * 100)):
+            if self.session.connected:
+                return True
+            waited.wait(0.01)
+        return False
+
+    def drop_connection(self):
+        handler = self._handler
+        if handler is not None:
+            self._loop.call_soon_threadsafe(handler.close)
+
+    def request(self, method, path, headers=None, body=None, timeout=10):
+        """Sends an HTTP request through the tunnel, returns (status, headers, body)"""
+        stream = self.session.open_stream(dict(method=method, path=path, headers=headers or {}, body=bool(body)))
+        try:
+            if body:
+                stream.write(body, timeout=timeout)
+            stream.end()
+            response = stream.wait_response(timeout)
+            chunks = []
+            while True:
+                chunk = stream.read(timeout)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+            return response["status"], response["headers"], b"".join(chunks)
+        finally:
+            stream.close()
+
+    def stop(self):
+        def shutdown():
+            self._http_server.stop()
+            if self._handler is not None:
+                self._handler.close()
+            self._loop.stop()
+
+        self._loop.call_soon_threadsafe(shutdown)
+        self._thread.join(5)
@@ -0,0 +1,50 @@
+import unittest
+
+from octofarm_companion.announcement import AnnouncementTracker, fingerprint
+from octofarm_companion.constants import Config
+from tests.utils import FakeClock
+
+
+class TestAnnouncementTracker(unittest.TestCase):
+    @classmethod
+    def setUp(cls):
+        cls.clock = FakeClock()
+        cls.tracker = AnnouncementTracker(max_silence=300, clock=cls.clock)
+
+    def test_fingerprint_is_order_independent(self):
+        first = fingerprint({"host": "127.0.0.1", "port": 5000})
+        assert first == fingerprint({"port": 5000, "host": "127.0.0.1"})
+        assert first != fingerprint({"port": 5001, "host": "127.0.0.1"})
+        assert len(first) == Config.announce_fingerprint_length
+
+    def test_full_until_accepted(self):
+        assert self.tracker.next_action("abc") == AnnouncementTracker.FULL
+        assert self.tracker.next_action("abc") == AnnouncementTracker.FULL
+
+        self.tracker.mark_sent("abc")
+        assert self.tracker.next_action("abc") == AnnouncementTracker.SKIP
+        assert self.tracker.next_action("def") == AnnouncementTracker.FULL
+
+    def test_heartbeat_after_max_silence(self):
+        self.tracker.mark_sent("abc")
+        self.clock.now += 299
+        assert self.tracker.next_action("abc") == AnnouncementTracker.SKIP
+
+        self.clock.now += 1
+        assert self.tracker.next_action("abc") == AnnouncementTracker.HEARTBEAT
+        self.tracker.mark_heartbeat()
+        assert self.tracker.next_action("abc") == AnnouncementTracker.SKIP
+
+    def test_reset(self):
+        self.tracker.mark_sent("abc")
+        self.tracker.reset()
+
+        assert self.tracker.next_action("abc") == AnnouncementTracker.FULL
+
+    def test_stats(self):
+        self.tracker.mark_sent("abc")
+        self.tracker.next_action("abc")
+        self.tracker.next_action("abc")
+        self.tracker.mark_heartbeat()
+
+        assert self.tracker.stats() == dict(sent=1, skipped=2, heartbeat=1, fingerprint="abc")
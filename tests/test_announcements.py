@@ -9,7 +9,9 @@ import pytest
 
 from octofarm_companion import OctoFarmCompanionPlugin
 from octofarm_companion.constants import Errors, Config, State
-from tests.utils import mock_settings_get, mock_settings_global_get, mock_settings_custom, create_fake_at
+from octofarm_companion.targets import OctoFarmTarget
+from tests.utils import mock_settings_get, mock_settings_global_get, mock_settings_custom, create_fake_at, \
+    mock_settings_get_int, mock_settings_get_float
 
 
 class TestPluginAnnouncing(unittest.TestCase):
@@ -22,6 +24,9 @@ class TestPluginAnnouncing(unittest.TestCase):
         cls.plugin._settings = cls.settings
         cls.plugin._settings.get = mock_settings_get
         cls.plugin._settings.get = mock_settings_global_get
+        cls.plugin._settings.global_get = mock_settings_global_get
+        cls.plugin._settings.get_int = mock_settings_get_int
+        cls.plugin._settings.get_float = mock_settings_get_float
         cls.plugin._write_persisted_data = lambda *args: None
         cls.plugin._logger = cls.logger
         cls.plugin._logger.info = print
@@ -29,33 +34,39 @@ class TestPluginAnnouncing(unittest.TestCase):
         # Nice way to test persisted data
         cls.plugin._data_folder = "test_data/announcements"
 
+    def tearDown(self):
+        self.plugin.on_shutdown()
+
+    def target(self):
+        return self.plugin._get_targets()[0]
+
     def assert_state(self, state):
-        assert self.plugin._state is state
+        assert self.target().state is state
 
     def test_call_mocked_announcement_improperly(self):
         """Call the query announcement, make sure it validates 'access_token'"""
 
-        self.assert_state(State.BOOT)
+        target = OctoFarmTarget("test", "asd", None, None)
 
         with pytest.raises(Exception) as e:
-            self.plugin._query_announcement("asd", "asd")
+            self.plugin._query_announcement(target, "asd")
 
         assert e.value.args[0] == Errors.access_token_too_short
-        self.assert_state(State.CRASHED)
+        assert target.state is State.CRASHED
 
     def test_announcement_without_baseurl(self):
         """Call the query announcement, make sure it doesnt crash"""
 
         fake_token = create_fake_at()
-        self.assert_state(State.BOOT)
+        target = OctoFarmTarget("test", None, None, None)
 
         with pytest.raises(Exception) as e:
-            self.plugin._query_announcement(None, access_token=fake_token)
+            self.plugin._query_announcement(target, access_token=fake_token)
 
         assert e.value.args[0] == Errors.base_url_not_provided
-        self.assert_state(State.CRASHED)
+        assert target.state is State.CRASHED
 
-    # This method will be used by the mock to replace requests.get
+    # This method will be used by the mock to replace requests.Session.post
     def mocked_requests_post(*args, **kwargs):
         class MockResponse:
             def __init__(self, status_code, text):
@@ -67,19 +78,18 @@ class TestPluginAnnouncing(unittest.TestCase):
             return MockResponse(200, json.dumps({"access_token": fake_token, "expires_in": 100}))
         return MockResponse(404, "{}")
 
-    @mock.patch('requests.post', side_effect=mocked_requests_post)
+    @mock.patch('requests.Session.post', side_effect=mocked_requests_post)
     def test_announcement_with_proper_data(self, mock_post):
         """Call the query announcement properly"""
 
         fake_token = create_fake_at()
-        url = "testwrong_url"
-        self.assert_state(State.BOOT)
+        target = OctoFarmTarget("test", "testwrong_url", None, None)
 
         # TODO wrong url is not prevented
-        self.plugin._query_announcement(url, fake_token)
+        self.plugin._query_announcement(target, fake_token)
 
         # assert e.value.args[0] == Errors.base_url_not_provided
-        self.assert_state(State.SLEEP)
+        assert target.state is State.SLEEP
 
     def test_check_octofarm(self):
         with pytest.raises(Exception) as e:
@@ -97,7 +107,7 @@ class TestPluginAnnouncing(unittest.TestCase):
         # TODO We are crashed with a connection error being caught. Save the reason
         self.assert_state(State.CRASHED)
 
-    @mock.patch('requests.post', side_effect=mocked_requests_post)
+    @mock.patch('requests.Session.post', side_effect=mocked_requests_post)
     def test_check_octofarm_reachable_settings(self, mock_request):
         self.plugin._settings.get = mock_settings_custom
         self.assert_state(State.BOOT)
@@ -105,24 +115,86 @@ class TestPluginAnnouncing(unittest.TestCase):
         self.plugin._check_octofarm()
         self.assert_state(State.SLEEP)
 
-    @mock.patch('requests.post', side_effect=mocked_requests_post)
+    @mock.patch('requests.Session.post', side_effect=mocked_requests_post)
     def test_check_octofarm_reachable_settings_expired(self, mock_request):
         self.plugin._settings.get = mock_settings_custom
-        self.plugin._persisted_data["requested_at"] = datetime.datetime.utcnow().timestamp()
-        self.plugin._persisted_data["expires"] = -100
+        self.target().token_manager.load(dict(
+            access_token=create_fake_at(),
+            requested_at=datetime.datetime.utcnow().timestamp(),
+            expires_in=-100
+        ))
         self.assert_state(State.BOOT)
 
         self.plugin._check_octofarm()
 
+        assert mock_request.call_count == 2
         self.assert_state(State.SLEEP)
 
-    @mock.patch('requests.post', side_effect=mocked_requests_post)
+    @mock.patch('requests.Session.post', side_effect=mocked_requests_post)
     def test_check_octofarm_reachable_settings_unexpired(self, mock_request):
         self.plugin._settings.get = mock_settings_custom
-        self.plugin._persisted_data["requested_at"] = datetime.datetime.utcnow().timestamp()
-        self.plugin._persisted_data["expires"] = 10000000
-        self.plugin._persisted_data["access_token"] = create_fake_at()
+        self.target().token_manager.load(dict(
+            access_token=create_fake_at(),
+            requested_at=datetime.datetime.utcnow().timestamp(),
+            expires_in=10000000
+        ))
 
         self.assert_state(State.BOOT)
-        self.plugin._check_octofarm() # We skip querying the access_token
+        self.plugin._check_octofarm()  # We skip querying the access_token
+        assert mock_request.call_count == 1
+        self.assert_state(State.SLEEP)
+
+    @mock.patch('requests.Session.post', side_effect=mocked_requests_post)
+    def test_check_octofarm_keeps_token_in_memory(self, mock_request):
+        self.plugin._settings.get = mock_settings_custom
+        self.plugin._write_new_access_token = mock.MagicMock()
+        self.target().announcement_tracker.max_silence = 0
+
+        self.plugin._check_octofarm()
+        self.plugin._check_octofarm()
+
+        # One token request and two announcements, the token is persisted once
+        assert mock_request.call_count == 3
+        assert self.plugin._write_new_access_token.call_count == 1
+        self.assert_state(State.SLEEP)
+
+    @mock.patch('requests.Session.post', side_effect=mocked_requests_post)
+    def test_check_octofarm_skips_unchanged_announcement(self, mock_request):
+        self.plugin._settings.get = mock_settings_custom
+        self.plugin._get_device_uuid = lambda: "device-uuid"
+
+        self.plugin._check_octofarm()
+        self.plugin._check_octofarm()
+        self.plugin._check_octofarm()
+
+        # One token request and one full announcement, the rest is skipped within the max silence interval
+        assert mock_request.call_count == 2
+        stats = self.plugin.get_announcement_stats()[Config.default_target_name]
+        assert stats["sent"] == 1
+        assert stats["skipped"] == 2
+        assert stats["heartbeat"] == 0
         self.assert_state(State.SLEEP)
+
+    @mock.patch('requests.Session.post', side_effect=mocked_requests_post)
+    def test_check_octofarm_heartbeat_after_max_silence(self, mock_request):
+        self.plugin._settings.get = mock_settings_custom
+        self.plugin._get_device_uuid = lambda: "device-uuid"
+        self.target().announcement_tracker.max_silence = 0
+
+        self.plugin._check_octofarm()
+        self.plugin._check_octofarm()
+
+        assert mock_request.call_count == 3
+        assert mock_request.call_args[0][0].endswith("octoprint/heartbeat")
+        assert set(mock_request.call_args[1]["json"].keys()) == {"deviceUuid", "persistenceUuid", "fingerprint"}
+        assert self.plugin.get_announcement_stats()[Config.default_target_name]["heartbeat"] == 1
+
+    @mock.patch('requests.Session.post')
+    def test_token_response_without_expiry(self, mock_request):
+        mock_request.return_value = mock.MagicMock(status_code=200, text=json.dumps({"access_token": create_fake_at()}))
+        self.plugin._settings.get = mock_settings_custom
+
+        with pytest.raises(Exception) as e:
+            self.plugin._query_access_token(self.target())
+
+        assert "'expires_in' not received" in e.value.args[0]
@@ -0,0 +1,103 @@
+import unittest
+import unittest.mock as mock
+
+from octoprint.events import Events
+
+from octofarm_companion.coalescer import EventCoalescer
+from tests.utils import mock_plugin
+
+
+class TestEventCoalescer(unittest.TestCase):
+    def setUp(self):
+        self.emit = mock.MagicMock()
+        self.coalescer = EventCoalescer(self.emit, max_keys=4)
+
+    def emitted(self, message):
+        return self.emit.call_args_list[message][0][0]
+
+    def test_numeric_series_are_summarized(self):
+        for value in (200.0, 201.5, 199.0, 200.5):
+            self.coalescer.record("temperature.tool0.actual", value)
+        self.coalescer.record("temperature.tool0.target", 200.0)
+        self.coalescer.flush()
+
+        assert self.emitted(0) == {
+            "temperature.tool0.actual": dict(min=199.0, max=201.5, last=200.5, count=4),
+            "temperature.tool0.target": 200.0
+        }
+
+    def test_only_changes_are_emitted(self):
+        self.coalescer.record("temperature.bed.target", 60.0)
+        self.coalescer.record("temperature.bed.actual", 59.0)
+        self.coalescer.flush()
+        self.coalescer.record("temperature.bed.target", 60.0)
+        self.coalescer.record("temperature.bed.actual", 60.0)
+        self.coalescer.flush()
+        self.coalescer.record("temperature.bed.target", 60.0)
+        self.coalescer.flush()
+        self.coalescer.flush()
+
+        assert self.emit.call_count == 2
+        assert self.emitted(1) == {"temperature.bed.actual": 60.0}
+        assert self.coalescer.stats()["messages"] == 2
+
+    def test_other_values_keep_the_latest(self):
+        self.coalescer.record("position.t", 0)
+        self.coalescer.record("mode", "relative")
+        self.coalescer.record("mode", "absolute")
+        self.coalescer.record("enabled", True)
+        self.coalescer.record("enabled", False)
+        self.coalescer.flush()
+
+        assert self.emitted(0) == {"position.t": 0, "mode": "absolute", "enabled": False}
+
+    def test_memory_is_bounded_by_keys(self):
+        for i in range(1000):
+            self.coalescer.record(f"key{i % 10}", i)
+
+        stats = self.coalescer.stats()
+        assert stats["keys"] == 4
+        assert stats["pending"] == 4
+        assert stats["dropped"] == 600
+        assert stats["events"] == 1000
+
+    def test_record_all_skips_unset_values(self):
+        self.coalescer.record_all("position", dict(x=10.0, y=None, z=0.2, reason="pause"), ("x", "y", "z"))
+        self.coalescer.flush()
+
+        assert self.emitted(0) == {"position.x": 10.0, "position.z": 0.2}
+
+
+class TestPluginCoalescing(unittest.TestCase):
+    def setUp(self):
+        self.plugin = mock_plugin()
+
+    def test_samples_reach_telemetry_per_window(self):
+        for i in range(20):
+            parsed = {"T0": (200.0 + i % 3, 210.0), "B": (60.0, 60.0), "C": (None, None)}
+            assert self.plugin.temperatures_received_hook(None, parsed) is parsed
+            self.plugin.on_event(Events.POSITION_UPDATE, dict(reason="m114", x=float(i), y=5.0, z=0.2, e=None,
+                                                              f=1500, t=0))
+        self.plugin.on_event(Events.Z_CHANGE, dict(new=0.4, old=0.2))
+        self.plugin._coalescer.flush()
+
+        events = self.plugin._telemetry.drain()
+        assert len(events) == 1
+        assert events[0]["type"] == "samples"
+        assert events[0]["data"] == {
+            "temperature.T0.actual": dict(min=200.0, max=202.0, last=201.0, count=20),
+            "temperature.T0.target": 210.0,
+            "temperature.B.actual": 60.0,
+            "temperature.B.target": 60.0,
+            "position.x": dict(min=0.0, max=19.0, last=19.0, count=20),
+            "position.y": 5.0,
+            "position.z": 0.2,
+            "position.f": 1500,
+            "position.t": 0,
+            "z": 0.4
+        }
+
+    def test_high_frequency_events_do_not_touch_the_state(self):
+        self.plugin.on_event(Events.Z_CHANGE, dict(new=0.4, old=0.2))
+
+        assert self.plugin._state_publisher.state() == dict()
@@ -1,30 +1,40 @@
+import shutil
+import subprocess
+import sys
+import tempfile
 import unittest
 import unittest.mock as mock
 from datetime import datetime
 
 from octofarm_companion import OctoFarmCompanionPlugin, __plugin_version__
 from octofarm_companion.constants import Config, Keys, Errors
-from tests.utils import mock_settings_get, mock_settings_get_int
+from tests.utils import mock_settings_get, mock_settings_get_int, mock_settings_get_float
 
 
 class TestPluginConfiguration(unittest.TestCase):
     @classmethod
-    @mock.patch('octofarm_companion.RepeatedTimer')
-    def setUp(cls, mock_repeated_timer):
+    @mock.patch('octofarm_companion.BackoffScheduler')
+    def setUp(cls, mock_scheduler):
         cls.settings = mock.MagicMock()  # Replace or refine with set/get
         cls.settings.get = mock_settings_get
         cls.settings.get_int = mock_settings_get_int
+        cls.settings.get_float = mock_settings_get_float
         cls.logger = mock.MagicMock()
 
-        cls.mock_repeated_timer = mock_repeated_timer
-        cls.mock_repeated_timer.start = lambda *args: None
+        cls.mock_scheduler = mock_scheduler
+        cls.mock_scheduler.start = lambda *args: None
 
         cls.plugin = OctoFarmCompanionPlugin()
         cls.plugin._settings = cls.settings
         cls.plugin._write_persisted_data = lambda *args: None
         cls.plugin._logger = cls.logger
-        # Nice way to test persisted data
-        cls.plugin._data_folder = "test_data/configuration"
+        # Nice way to test persisted data, initialize also creates the ledger and job history there
+        cls.folder = tempfile.mkdtemp(prefix="test_data_configuration")
+        cls.plugin._data_folder = cls.folder
+
+    def tearDown(self):
+        self.plugin.on_shutdown()
+        shutil.rmtree(self.folder)
 
     def test_initialize(self):
         self.plugin.initialize()
@@ -33,8 +43,11 @@ class TestPluginConfiguration(unittest.TestCase):
 
     def test_excludes_hook(self):
         excludes = self.plugin.additional_excludes_hook(None)
-        assert len(excludes) == 1
+        assert len(excludes) == 4
         assert excludes[0] == Config.persisted_data_file
+        assert excludes[1] == Config.persisted_data_file + ".bak"
+        assert excludes[2] == Config.outbox_folder
+        assert excludes[3] == Config.file_cache_folder
 
     def test_persisted_data(self):
         # State has already been set
@@ -45,15 +58,30 @@ class TestPluginConfiguration(unittest.TestCase):
 
         assert device_uuid is not None
         assert ".json" in Config.persisted_data_file
-        assert Config.persisted_data_file in data_path and "test_data" in data_path
+        assert Config.persisted_data_file in data_path and data_path.startswith(self.folder)
         assert len(persistence_uuid) > 20
 
     def test_startup_with_ping_worker(self):
-        self.plugin._ping_worker = self.mock_repeated_timer
+        self.plugin._ping_worker = self.mock_scheduler
         self.plugin.on_after_startup()
 
         assert not self.logger.error.called
 
+    @mock.patch("requests.Session.post")
+    def test_startup_defers_network_work(self, post):
+        self.plugin._ping_worker = self.mock_scheduler
+        self.plugin.on_after_startup()
+
+        assert not post.called
+        assert self.plugin._environment.stats()["probes"] == 0
+
+    def test_import_defers_the_tunnel(self):
+        loaded = subprocess.run(
+            [sys.executable, "-c", "import sys, octofarm_companion; print('websocket' in sys.modules)"],
+            capture_output=True, text=True, check=True).stdout.strip()
+
+        assert loaded == "False"
+
     def test_startup_without_ping_setting(self):
         self.plugin._ping_worker = None
 
@@ -71,6 +99,9 @@ class TestPluginConfiguration(unittest.TestCase):
         assert self.plugin._settings.get_int(["ping"]) == Config.default_ping_secs
         assert Config.default_ping_secs == 120
         assert self.plugin._ping_worker is not None
+        assert self.plugin._ping_worker.interval == Config.default_ping_secs
+        assert self.plugin._ping_worker.is_running()
+        self.plugin._ping_worker.stop()
 
     def test_on_settings_cleanup(self):
         """Tests that after cleanup only minimal config is left in storage."""
@@ -108,6 +139,20 @@ class TestPluginConfiguration(unittest.TestCase):
         }
         self.settings.set.assert_called_once_with([], expected)
 
+    def test_on_settings_save_keeps_components(self):
+        self.settings.get_all_data.return_value = {}
+        network = self.plugin._network
+        target = self.plugin._get_targets()[0]
+        telemetry = self.plugin._telemetry
+        self.plugin._get_http_client()
+
+        self.plugin.on_settings_save({"ping": 300})
+
+        assert self.plugin._http_client is None
+        assert self.plugin._network is network
+        assert self.plugin._get_targets()[0] is target
+        assert self.plugin._telemetry is telemetry
+
     def test_settings_default(self):
         defaults = self.plugin.get_settings_defaults()
         assert defaults["octofarm_host"] is None
@@ -174,6 +219,3 @@ class TestPluginConfiguration(unittest.TestCase):
     def test_plugin_version_compared_setup(self):
         """ Make sure the installation version equals the plugin version """
         assert __plugin_version__ == "0.1.0-rc1-build3"
-
-    def assert_state(self, state):
-        assert self.plugin._state is state
@@ -1,4 +1,5 @@
 import json
+import time
 import unittest
 import unittest.mock as mock
 
@@ -6,6 +7,7 @@ import pytest
 from werkzeug.exceptions import BadRequest
 
 from octofarm_companion import OctoFarmCompanionPlugin, State
+from tests.utils import mock_settings_get_int, mock_settings_get_float
 
 
 class TestPluginConnection(unittest.TestCase):
@@ -16,6 +18,8 @@ class TestPluginConnection(unittest.TestCase):
 
         cls.plugin = OctoFarmCompanionPlugin()
         cls.plugin._settings = cls.settings
+        cls.plugin._settings.get_int = mock_settings_get_int
+        cls.plugin._settings.get_float = mock_settings_get_float
         cls.plugin._logger = cls.logger
         cls.plugin._logger.info = print
         cls.plugin._logger.error = print
@@ -23,10 +27,11 @@ class TestPluginConnection(unittest.TestCase):
         cls.plugin._data_folder = "test_data/connection"
         cls.plugin._write_persisted_data = lambda *args: None
 
-    def assert_state(self, state):
-        assert self.plugin._state is state
+    def tearDown(self):
+        self.plugin._diagnostics.shutdown()
+        self.plugin._network.shutdown()
 
-    # This method will be used by the mock to replace requests.get
+    # This method will be used by the mock to replace requests.Session.get
     def mocked_requests_get(*args, **kwargs):
         class MockResponse:
             def __init__(self, json_data, status_code, text):
@@ -39,7 +44,7 @@ class TestPluginConnection(unittest.TestCase):
 
         return MockResponse({"version": "test-version"}, 200, json.dumps({"version": "test-version"}))
 
-    @mock.patch('requests.get', side_effect=mocked_requests_get)
+    @mock.patch('requests.Session.get', side_effect=mocked_requests_get)
     def test_octofarm_connection_test(self, mocked_requests_get):
         """Call the OctoFarm connection test properly"""
 
@@ -50,11 +55,39 @@ class TestPluginConnection(unittest.TestCase):
             # somefile.method_called_from_route()
             response = self.plugin.test_octofarm_connection()
             assert response["version"] == "test-version"
+            assert response["ok"]
+            assert not response["cached"]
+
+    @mock.patch('requests.Session.get', side_effect=lambda *args, **kwargs: time.sleep(1))
+    def test_octofarm_connection_test_deadline(self, mocked_requests_get):
+        """Call the OctoFarm connection test against a hanging OctoFarm"""
+
+        self.plugin._network.deadline = 0.1
+        m = mock.MagicMock()
+        m.data = json.dumps({"url": "http://127.0.0.1"})
+        with mock.patch("octofarm_companion.request", m):
+            start = time.monotonic()
+            report, status = self.plugin.test_octofarm_connection()
+            assert time.monotonic() - start < 1
+            assert status == 504
+            assert report["stages"]["version"]["status"] == "timeout"
+
+    @mock.patch('requests.Session.get', return_value=mock.MagicMock(status_code=200, text="<html>proxy</html>"))
+    def test_octofarm_connection_test_not_json(self, mocked_requests_get):
+        """Call the OctoFarm connection test against a server which is not OctoFarm"""
+
+        m = mock.MagicMock()
+        m.data = json.dumps({"url": "http://127.0.0.1"})
+        with mock.patch("octofarm_companion.request", m):
+            report, status = self.plugin.test_octofarm_connection()
+            assert status == 502
+            assert report["stages"]["version"]["status"] == "failed"
+            assert report["version"] is None
 
     def _assert_bad_request_parameter(self, exception_info, param):
         assert str(exception_info.value) == f"400 Bad Request: Expected '{param}' parameter"
 
-    @mock.patch('requests.get', side_effect=mocked_requests_get)
+    @mock.patch('requests.Session.get', side_effect=mocked_requests_get)
     def test_octofarm_connection_test_validation(self, mocked_requests_get):
         """Call the OctoFarm connection test with faulty input"""
 
@@ -65,7 +98,7 @@ class TestPluginConnection(unittest.TestCase):
                 self.plugin.test_octofarm_connection()
             self._assert_bad_request_parameter(e, "url")
 
-    @mock.patch('requests.post', side_effect=mocked_requests_get)
+    @mock.patch('requests.Session.post', side_effect=mocked_requests_get)
     def test_octofarm_openid_validation(self, mocked_requests_get):
         """Call the OctoFarm OpenID connection test with faulty input"""
 
@@ -97,7 +130,7 @@ class TestPluginConnection(unittest.TestCase):
                 self.plugin.test_octofarm_openid()
             self._assert_bad_request_parameter(e, "client_secret")
 
-    # This method will be used by the mock to replace requests.get
+    # This method will be used by the mock to replace requests.Session.get
     def mocked_openid_response_notfound(*args, **kwargs):
         class MockResponse:
             def __init__(self, status_code, text):
@@ -106,18 +139,17 @@ class TestPluginConnection(unittest.TestCase):
 
         return MockResponse({}, 404)
 
-    @mock.patch('requests.post', side_effect=mocked_openid_response_notfound)
+    @mock.patch('requests.Session.post', side_effect=mocked_openid_response_notfound)
     def test_octofarm_openid_bug_response(self, mocked_requests_get):
         """Call the OctoFarm OpenID connection test with a not found error"""
 
         m = mock.MagicMock()
         m.data = json.dumps({"url": "http://127.0.0.1", "client_id": "asd", "client_secret": "ok"})
         with mock.patch("octofarm_companion.request", m):
-            self.assert_state(State.BOOT)
-            self.plugin.test_octofarm_openid()
-            self.assert_state(State.CRASHED)
+            response = self.plugin.test_octofarm_openid()
+            assert response["state"] is State.CRASHED
 
-    # This method will be used by the mock to replace requests.get or requests.post
+    # This method will be used by the mock to replace requests.Session.get or requests.Session.post
     def mocked_openid_response_maximal(*args, **kwargs):
         class MockResponse:
             def __init__(self, status_code, text):
@@ -127,7 +159,7 @@ class TestPluginConnection(unittest.TestCase):
         return MockResponse(200, json.dumps({"access_token": "test-token", "expires_in": 600, "token_type": "Bearer",
                                              "scope": "openid profile email pincode bank_id"}))
 
-    # This method will be used by the mock to replace requests.get or requests.post
+    # This method will be used by the mock to replace requests.Session.get or requests.Session.post
     def mocked_openid_response_minimal(*args, **kwargs):
         class MockResponse:
             def __init__(self, status_code, text):
@@ -137,18 +169,17 @@ class TestPluginConnection(unittest.TestCase):
         return MockResponse(200,
                             json.dumps({"access_token": "test-token", "expires_in": 600}))
 
-    @mock.patch('requests.post', side_effect=mocked_openid_response_maximal)
+    @mock.patch('requests.Session.post', side_effect=mocked_openid_response_maximal)
     def test_octofarm_openid_success_maximal(self, mocked_requests_get):
         """Call the OctoFarm OpenID connection test properly with maximum property set"""
 
         m = mock.MagicMock()
         m.data = json.dumps({"url": "http://127.0.0.1", "client_id": "asd", "client_secret": "ok"})
         with mock.patch("octofarm_companion.request", m):
-            self.assert_state(State.BOOT)
-            self.plugin.test_octofarm_openid()
-            self.assert_state(State.SUCCESS)
+            response = self.plugin.test_octofarm_openid()
+            assert response["state"] is State.SUCCESS
 
-    @mock.patch('requests.post', side_effect=mocked_openid_response_minimal)
+    @mock.patch('requests.Session.post', side_effect=mocked_openid_response_minimal)
     def test_octofarm_openid_success_minimal(self, mocked_requests_get):
         """Call the OctoFarm OpenID connection test properly with missing response properties 'scope' and
         'token_type' """
@@ -156,6 +187,5 @@ class TestPluginConnection(unittest.TestCase):
         m = mock.MagicMock()
         m.data = json.dumps({"url": "http://127.0.0.1", "client_id": "asd", "client_secret": "ok"})
         with mock.patch("octofarm_companion.request", m):
-            self.assert_state(State.BOOT)
-            self.plugin.test_octofarm_openid()
-            self.assert_state(State.SUCCESS)
+            response = self.plugin.test_octofarm_openid()
+            assert response["state"] is State.SUCCESS
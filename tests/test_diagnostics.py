@@ -0,0 +1,191 @@
+import json
+import socket
+import ssl
+import threading
+import time
+import unittest
+import unittest.mock as mock
+
+from octofarm_companion.diagnostics import ConnectionDiagnostics
+from octofarm_companion.network import NetworkTimeoutError
+from tests.utils import FakeClock
+
+
+def response(status_code, body):
+    return mock.MagicMock(status_code=status_code, text=body if isinstance(body, str) else json.dumps(body))
+
+
+class TestConnectionDiagnostics(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.fetch_version = mock.MagicMock(return_value=response(200, {"version": "1.2.0"}))
+        self.fetch_token = mock.MagicMock(return_value=response(200, {"access_token": "secret", "expires_in": 3600}))
+        self.resolve = mock.MagicMock(return_value=[(socket.AF_INET, socket.SOCK_STREAM, 6, "", ("10.0.0.2", 4000))])
+        self.connect = mock.MagicMock()
+        self.diagnostics = ConnectionDiagnostics(self.fetch_version, self.fetch_token, ttl=30, failure_ttl=3,
+                                                 resolve=self.resolve, connect=self.connect, clock=self.clock)
+
+    def tearDown(self):
+        self.diagnostics.shutdown()
+
+    def test_all_stages(self):
+        report = self.diagnostics.run("http://farm:4000/", "client", "secret")
+
+        assert report["ok"]
+        assert report["version"] == "1.2.0"
+        assert not report["cached"]
+        assert list(report["stages"]) == ["dns", "tcp", "tls", "version", "token"]
+        assert {name: stage["status"] for name, stage in report["stages"].items()} == dict(
+            dns="ok", tcp="ok", tls="skipped", version="ok", token="ok")
+        assert report["stages"]["dns"]["detail"] == "10.0.0.2"
+        assert report["stages"]["tcp"]["detail"] == "10.0.0.2:4000"
+        assert "secret" not in json.dumps(report["stages"]["token"])
+        self.fetch_token.assert_called_once_with("http://farm:4000/", "client", "secret")
+
+    def test_token_is_skipped_without_credentials(self):
+        report = self.diagnostics.run("http://farm:4000/")
+
+        assert report["ok"]
+        assert report["stages"]["token"]["status"] == "skipped"
+        self.fetch_token.assert_not_called()
+
+    def test_repeated_runs_are_cached(self):
+        self.diagnostics.run("http://farm:4000/")
+        self.clock.now += 29
+        report = self.diagnostics.run("http://farm:4000/")
+
+        assert report["cached"]
+        assert self.fetch_version.call_count == 1
+        assert self.diagnostics.stats() == dict(runs=1, hits=1, joined=0, cached=1)
+
+        self.clock.now += 1
+        self.diagnostics.run("http://farm:4000/")
+        assert self.fetch_version.call_count == 2
+
+    def test_cache_is_per_url_and_credentials(self):
+        self.diagnostics.run("http://farm:4000/")
+        self.diagnostics.run("http://other:4000/")
+        self.diagnostics.run("http://farm:4000/", "client", "secret")
+
+        assert self.fetch_version.call_count == 3
+
+    def test_failures_expire_sooner(self):
+        self.fetch_version.return_value = response(503, "Service Unavailable")
+        self.diagnostics.run("http://farm:4000/")
+        self.clock.now += 3
+        self.fetch_version.return_value = response(200, {"version": "1.2.0"})
+
+        assert self.diagnostics.run("http://farm:4000/")["ok"]
+
+    def test_concurrent_runs_join_the_one_in_flight(self):
+        release = threading.Event()
+
+        def slow_version(url):
+            release.wait(2)
+            return response(200, {"version": "1.2.0"})
+
+        self.fetch_version.side_effect = slow_version
+        reports = []
+        threads = [threading.Thread(target=lambda: reports.append(self.diagnostics.run("http://farm:4000/")))
+                   for i in range(3)]
+        for thread in threads:
+            thread.start()
+        while self.diagnostics.stats()["joined"] < 2:
+            time.sleep(0.01)
+        release.set()
+        for thread in threads:
+            thread.join(2)
+
+        assert self.fetch_version.call_count == 1
+        assert [report["version"] for report in reports] == ["1.2.0"] * 3
+
+    def test_non_json_version(self):
+        self.fetch_version.return_value = response(200, "<html>Welcome to nginx</html>")
+
+        report = self.diagnostics.run("http://farm:4000/")
+        assert not report["ok"]
+        assert report["version"] is None
+        assert report["stages"]["version"] == dict(status="failed", durationMs=mock.ANY,
+                                                   detail="HTTP 200 without a JSON version")
+
+    def test_version_timeout(self):
+        self.fetch_version.side_effect = NetworkTimeoutError("deadline")
+
+        report = self.diagnostics.run("http://farm:4000/")
+        assert not report["ok"]
+        assert report["stages"]["version"]["status"] == "timeout"
+
+    def test_rejected_credentials(self):
+        self.fetch_token.return_value = response(401, "Unauthorized")
+
+        report = self.diagnostics.run("http://farm:4000/", "client", "wrong")
+        assert not report["ok"]
+        assert report["stages"]["token"]["detail"] == "HTTP 401"
+
+    def test_dns_failure_skips_connect(self):
+        self.resolve.side_effect = socket.gaierror(-2, "Name or service not known")
+        self.fetch_version.side_effect = ConnectionError("unreachable")
+
+        stages = self.diagnostics.run("http://nofarm:4000/")["stages"]
+        assert stages["dns"]["status"] == "failed"
+        assert stages["tcp"]["status"] == "skipped"
+        assert stages["version"]["detail"] == "ConnectionError: unreachable"
+        self.connect.assert_not_called()
+
+    def test_refused_connection(self):
+        self.connect.side_effect = ConnectionRefusedError(111, "Connection refused")
+
+        stages = self.diagnostics.run("http://farm:4000/")["stages"]
+        assert stages["tcp"]["status"] == "failed"
+
+    def test_self_signed_certificate_is_a_warning(self):
+        context = mock.MagicMock()
+        error = ssl.SSLCertVerificationError("certificate verify failed")
+        error.verify_message = "self signed certificate"
+        context.wrap_socket.side_effect = error
+        self.diagnostics._tls_context = context
+
+        report = self.diagnostics.run("https://farm/")
+        assert report["stages"]["tls"] == dict(status="warning", durationMs=mock.ANY, detail="self signed certificate")
+        assert report["ok"]
+        assert self.resolve.call_args[0][:2] == ("farm", 443)
+
+    def test_invalid_url(self):
+        report = self.diagnostics.run("farm:4000")
+
+        assert not report["ok"]
+        assert report["stages"]["dns"]["status"] == "failed"
+        self.fetch_version.assert_not_called()
+
+    def test_hanging_stage_does_not_hang_the_report(self):
+        release = threading.Event()
+        self.resolve.side_effect = lambda *args, **kwargs: release.wait(5)
+        diagnostics = ConnectionDiagnostics(self.fetch_version, self.fetch_token, deadline=0.2,
+                                            resolve=self.resolve, connect=self.connect)
+        try:
+            started = time.monotonic()
+            report = diagnostics.run("http://farm:4000/")
+            assert time.monotonic() - started < 1
+        finally:
+            release.set()
+            diagnostics.shutdown()
+
+        assert [report["stages"][name]["status"] for name in ("dns", "tcp", "tls")] == ["timeout"] * 3
+        assert report["ok"]
+
+    def test_stages_run_concurrently(self):
+        def slow(*args, **kwargs):
+            time.sleep(0.2)
+            return response(200, {"version": "1.2.0", "access_token": "secret"})
+
+        self.fetch_version.side_effect = slow
+        self.fetch_token.side_effect = slow
+        self.resolve.side_effect = lambda *args, **kwargs: slow() and [(0, 0, 0, "", ("10.0.0.2", 4000))]
+        diagnostics = ConnectionDiagnostics(self.fetch_version, self.fetch_token, resolve=self.resolve,
+                                            connect=self.connect)
+        try:
+            started = time.monotonic()
+            assert diagnostics.run("http://farm:4000/", "client", "secret")["ok"]
+            assert time.monotonic() - started < 0.5
+        finally:
+            diagnostics.shutdown()
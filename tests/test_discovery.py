@@ -0,0 +1,85 @@
+import unittest
+import unittest.mock as mock
+
+from octofarm_companion.discovery import AddressDiscovery, address_score, interface_addresses
+from octofarm_companion.targets import OctoFarmTarget
+from tests.utils import FakeClock, create_fake_at, mock_plugin
+
+interfaces = [
+    ("lo", "127.0.0.1"),
+    ("docker0", "172.17.0.1"),
+    ("wg0", "10.8.0.3"),
+    ("eth0", "192.168.1.20"),
+    ("eth1", "169.254.10.2"),
+]
+
+
+class TestAddressScore(unittest.TestCase):
+    def test_default_route_ranks_first(self):
+        scores = {interface: address_score(interface, address, "192.168.1.20") for interface, address in interfaces}
+
+        assert sorted(scores, key=scores.get, reverse=True) == ["eth0", "wg0", "docker0", "eth1", "lo"]
+
+
+class TestAddressDiscovery(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.interfaces = mock.MagicMock(return_value=interfaces)
+        self.discovery = AddressDiscovery(ttl=300, interfaces=self.interfaces, default_address=lambda: "192.168.1.20",
+                                          clock=self.clock)
+
+    def test_ranked_candidates(self):
+        candidates = self.discovery.candidates(80)
+
+        assert [candidate["host"] for candidate in candidates] == [
+            "192.168.1.20", "10.8.0.3", "172.17.0.1", "169.254.10.2", "127.0.0.1"
+        ]
+        assert candidates[0] == dict(host="192.168.1.20", port=80, interface="eth0")
+
+    def test_candidates_are_cached_for_the_ttl(self):
+        first = self.discovery.candidates(5000)
+        self.clock.now += 299
+        assert self.discovery.candidates(5000) is first
+        assert self.interfaces.call_count == 1
+
+        self.clock.now += 1
+        self.discovery.candidates(5000)
+        assert self.interfaces.call_count == 2
+        assert self.discovery.stats()["discoveries"] == 2
+
+    def test_port_change_and_invalidate_rediscover(self):
+        self.discovery.candidates(5000)
+        self.discovery.candidates(5001)
+        self.discovery.invalidate()
+        self.discovery.candidates(5001)
+
+        assert self.discovery.stats()["discoveries"] == 3
+
+    def test_limited_amount_of_candidates(self):
+        discovery = AddressDiscovery(max_candidates=2, interfaces=lambda: interfaces,
+                                     default_address=lambda: "192.168.1.20")
+
+        assert len(discovery.candidates(5000)) == 2
+
+    def test_no_interfaces(self):
+        assert AddressDiscovery(interfaces=lambda: [], default_address=lambda: None).candidates(5000) == []
+
+    def test_interface_addresses_include_loopback(self):
+        assert "127.0.0.1" in [address for interface, address in interface_addresses()]
+
+
+class TestPluginDiscovery(unittest.TestCase):
+    @mock.patch("requests.Session.post")
+    def test_announcement_carries_candidates(self, post):
+        plugin = mock_plugin("test_data/discovery")
+        plugin._discovery = AddressDiscovery(interfaces=lambda: interfaces, default_address=lambda: "192.168.1.20")
+        post.return_value = mock.MagicMock(status_code=200, text="{}")
+        try:
+            plugin._query_announcement(OctoFarmTarget("test", "http://farm", None, None), create_fake_at())
+            plugin._query_announcement(OctoFarmTarget("test", "http://farm", None, None), create_fake_at())
+        finally:
+            plugin.on_shutdown()
+
+        candidates = post.call_args[1]["json"]["candidates"]
+        assert candidates[0] == dict(host="192.168.1.20", port=5000, interface="eth0")
+        assert plugin._discovery.stats()["discoveries"] == 1
@@ -0,0 +1,148 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import unittest.mock as mock
+
+from octoprint.events import Events
+
+from octofarm_companion.environment import EnvironmentSnapshot, detect_container, lan_addresses
+from octofarm_companion.targets import OctoFarmTarget
+from tests.utils import create_fake_at, mock_plugin
+
+
+class TestDetectContainer(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def write(self, path, content=""):
+        path = os.path.join(self.root, path.lstrip("/"))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(content)
+
+    def test_bare_host(self):
+        self.write("/proc/self/cgroup", "12:cpuset:/\n11:memory:/user.slice\n")
+
+        assert detect_container(self.root, {}) == dict(docker=False, podman=False, kubernetes=False, runtime=None,
+                                                       cgroupVersion=1)
+
+    def test_docker_with_cgroup_v1(self):
+        self.write("/proc/self/cgroup", "12:cpuset:/docker/3f4e1a\n")
+
+        environment = detect_container(self.root, {})
+        assert environment["docker"]
+        assert environment["runtime"] == "docker"
+
+    def test_docker_with_cgroup_v2(self):
+        self.write("/sys/fs/cgroup/cgroup.controllers", "cpu io memory")
+        self.write("/proc/self/cgroup", "0::/\n")
+        self.write("/proc/self/mountinfo", "522 500 254:1 /var/lib/docker/containers/3f4e1a/hostname /etc/hostname rw\n")
+
+        environment = detect_container(self.root, {})
+        assert environment["docker"]
+        assert environment["cgroupVersion"] == 2
+
+    def test_podman(self):
+        self.write("/run/.containerenv")
+
+        environment = detect_container(self.root, {"container": "podman"})
+        assert environment["podman"]
+        assert environment["runtime"] == "podman"
+
+    def test_kubernetes_wins_over_the_container_runtime(self):
+        self.write("/.dockerenv")
+
+        environment = detect_container(self.root, {"KUBERNETES_SERVICE_HOST": "10.96.0.1"})
+        assert environment["docker"]
+        assert environment["runtime"] == "kubernetes"
+
+    def test_lan_addresses_exclude_loopback(self):
+        assert not any(address.startswith("127.") for address in lan_addresses())
+
+
+class TestEnvironmentSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.settings = dict(host="0.0.0.0", port=5000, port_override=None, allow_cross_origin=False)
+        self.read_settings = mock.MagicMock(side_effect=lambda: dict(self.settings))
+        self.detect = mock.MagicMock(return_value=dict(docker=True, runtime="docker"))
+        self.addresses = mock.MagicMock(return_value=["192.168.1.20", "10.8.0.3"])
+        self.snapshot = EnvironmentSnapshot(self.read_settings, detect=self.detect, addresses=self.addresses)
+
+    def test_probes_once(self):
+        for i in range(10):
+            environment = self.snapshot.get()
+
+        assert environment == dict(docker=True, runtime="docker", host="192.168.1.20", port=5000, listenPort=5000,
+                                   allowCrossOrigin=False, lanAddresses=["192.168.1.20", "10.8.0.3"])
+        assert self.read_settings.call_count == 1
+        assert self.addresses.call_count == 1
+        assert self.snapshot.stats() == dict(probes=1, hits=9, cached=True)
+
+    def test_invalidate_reprobes_settings_but_not_the_container(self):
+        self.snapshot.get()
+        self.settings["port_override"] = 80
+        self.settings["host"] = "octopi.local"
+        self.snapshot.invalidate()
+
+        environment = self.snapshot.get()
+        assert environment["host"] == "octopi.local"
+        assert environment["port"] == 80
+        assert environment["listenPort"] == 5000
+        assert self.read_settings.call_count == 2
+        assert self.detect.call_count == 1
+
+    def test_unroutable_host_without_addresses_is_kept(self):
+        self.addresses.return_value = []
+
+        assert self.snapshot.get()["host"] == "0.0.0.0"
+
+
+class TestPluginEnvironment(unittest.TestCase):
+    def setUp(self):
+        self.plugin = mock_plugin("test_data/environment")
+        self.plugin._settings.global_get = mock.MagicMock(side_effect=self.global_get)
+        self.plugin._environment._detect = lambda: dict(docker=False, podman=True, kubernetes=False,
+                                                        runtime="podman", cgroupVersion=2)
+        self.port = 5000
+
+    def tearDown(self):
+        self.plugin.on_shutdown()
+
+    def global_get(self, accessor):
+        if accessor == ["server", "host"]:
+            return "octopi.local"
+        if accessor == ["server", "port"]:
+            return self.port
+        return None
+
+    def announce(self, post):
+        post.return_value = mock.MagicMock(status_code=200, text="{}")
+        self.plugin._query_announcement(OctoFarmTarget("test", "http://farm", None, None), create_fake_at())
+        return json.loads(json.dumps(post.call_args[1]["json"]))
+
+    @mock.patch("requests.Session.post")
+    def test_pings_do_not_reread_settings(self, post):
+        announced = self.announce(post)
+        calls = self.plugin._settings.global_get.call_count
+        for i in range(5):
+            self.announce(post)
+
+        assert announced["host"] == "octopi.local"
+        assert announced["port"] == 5000
+        assert announced["container"] == "podman"
+        assert announced["docker"] is False
+        assert self.plugin._settings.global_get.call_count == calls
+
+    @mock.patch("requests.Session.post")
+    def test_settings_events_refresh_the_announcement(self, post):
+        self.announce(post)
+        self.port = 5001
+        assert self.announce(post)["port"] == 5000
+
+        self.plugin.on_event(Events.SETTINGS_UPDATED, {})
+        assert self.announce(post)["port"] == 5001
@@ -0,0 +1,399 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+import unittest.mock as mock
+
+import flask
+import pytest
+from werkzeug.exceptions import BadRequest
+from werkzeug.serving import make_server
+
+import octofarm_companion
+from octofarm_companion.file_cache import FileCache, FileHashMismatch, PeerRanges
+from tests.stub_octofarm import StubOctoFarmServer
+from tests.utils import create_jwt, create_rsa_key, mock_plugin
+
+content = b"".join(f"G1 X{i % 200} Y{i % 150} E{i * 0.01:.2f}\n".encode() for i in range(2000))
+sha256 = hashlib.sha256(content).hexdigest()
+signing_key = create_rsa_key(seed=3)
+
+
+class FakeResponse:
+    def __init__(self, status_code, content=b"", headers=None, fail_after=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = dict(headers or {}, **{"Content-Length": str(len(content))})
+        self.fail_after = fail_after
+        self.read = 0
+        self.closed = False
+
+    def iter_content(self, chunk_size):
+        for start in range(0, len(self.content), chunk_size):
+            if self.fail_after is not None and self.read >= self.fail_after:
+                raise ConnectionError()
+            block = self.content[start:start + chunk_size]
+            self.read += len(block)
+            yield block
+
+    def close(self):
+        self.closed = True
+
+
+def serve(data, fail_after=None, ranges=True):
+    """get_range over 'data', raising a ConnectionError on the request after 'fail_after' requests"""
+    requests = []
+
+    def get_range(start, end):
+        if fail_after is not None and len(requests) >= fail_after:
+            raise ConnectionError()
+        requests.append((start, end))
+        if not ranges:
+            return FakeResponse(200, data)
+        if start >= len(data):
+            return FakeResponse(416)
+        body = data[start:end + 1]
+        return FakeResponse(206, body, {"Content-Range": f"bytes {start}-{start + len(body) - 1}/{len(data)}"})
+
+    get_range.requests = requests
+    return get_range
+
+
+class TestFileCache(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.cache = FileCache(self.folder, max_size=len(content) * 2, chunk_size=10000)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_download_in_ranges(self):
+        get_range = serve(content)
+        path = self.cache.fetch(sha256, get_range)
+
+        with open(path, "rb") as f:
+            assert f.read() == content
+        assert get_range.requests[:2] == [(0, 9999), (10000, 19999)]
+        assert len(get_range.requests) == -(-len(content) // 10000)
+
+    def test_cached_file_costs_no_transfer(self):
+        self.cache.fetch(sha256, serve(content))
+        get_range = serve(content)
+
+        assert self.cache.fetch(sha256, get_range) == self.cache.path(sha256)
+        assert get_range.requests == []
+        assert self.cache.stats()["hits"] == 1
+
+    def test_interrupted_download_resumes(self):
+        with pytest.raises(ConnectionError):
+            self.cache.fetch(sha256, serve(content, fail_after=2))
+        assert self.cache.path(sha256) is None
+
+        # After a restart
+        self.cache = FileCache(self.folder, max_size=len(content) * 2, chunk_size=10000)
+        get_range = serve(content)
+        self.cache.fetch(sha256, get_range)
+
+        assert get_range.requests[0] == (20000, 29999)
+        assert self.cache.stats()["downloaded_bytes"] == len(content) - 20000
+        assert self.cache.stats()["resumed"] == 1
+
+    def test_mismatch_is_discarded(self):
+        with pytest.raises(FileHashMismatch):
+            self.cache.fetch(sha256, serve(content[:-1] + b"X"))
+
+        assert os.listdir(self.folder) == []
+        assert self.cache.stats()["mismatches"] == 1
+
+    def test_server_without_ranges(self):
+        get_range = serve(content, ranges=False)
+
+        assert self.cache.fetch(sha256, get_range) is not None
+        assert len(get_range.requests) == 1
+
+    def test_too_large_file_is_refused_before_its_body(self):
+        response = FakeResponse(200, content)
+        self.cache.max_size = 100
+        with pytest.raises(Exception):
+            self.cache.fetch(sha256, lambda start, end: response)
+
+        assert (response.read, response.closed) == (0, True)
+        # Without Content-Length the body is read up to the limit only
+        del response.headers["Content-Length"]
+        with pytest.raises(Exception):
+            self.cache.fetch(sha256, lambda start, end: response)
+
+        assert response.read <= 100 + 1024 * 1024
+        assert os.listdir(self.folder) == []
+
+    def test_least_recently_used_is_evicted(self):
+        files = [content[:len(content) // 2 + i] for i in range(3)]
+        hashes = [hashlib.sha256(data).hexdigest() for data in files]
+        self.cache.max_size = len(content) + 10
+        self.cache.fetch(hashes[0], serve(files[0]))
+        self.cache.fetch(hashes[1], serve(files[1]))
+        # Printed again, the second file is the least recently used now
+        self.cache.fetch(hashes[0], serve(files[0]))
+        self.cache.fetch(hashes[2], serve(files[2]))
+
+        assert [self.cache.path(h) is not None for h in hashes[:3]] == [True, False, True]
+        assert self.cache.stats()["bytes"] <= self.cache.max_size
+        assert FileCache(self.folder).stats()["files"] == 2
+
+    def test_file_larger_than_the_cache(self):
+        self.cache.max_size = 100
+        with pytest.raises(Exception):
+            self.cache.fetch(sha256, serve(content))
+
+        assert os.listdir(self.folder) == []
+
+
+class TestPeerRanges(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.cache = FileCache(self.folder, chunk_size=10000)
+        self.server = serve(content)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_ranges_spread_over_peers(self):
+        peers = dict(a=serve(content), b=serve(content))
+        ranges = PeerRanges(["a", "b"], lambda peer, start, end: peers[peer](start, end), self.server)
+        self.cache.fetch(sha256, ranges)
+
+        assert len(peers["a"].requests) == len(peers["b"].requests) == len(content) // 20000 + 1
+        assert (ranges.peer_bytes, ranges.server_bytes, self.server.requests) == (len(content), 0, [])
+
+    def test_peer_without_the_file_is_kept(self):
+        peers = dict(empty=lambda start, end: FakeResponse(404), broken=serve(content, fail_after=0))
+        ranges = PeerRanges(["empty", "broken"], lambda peer, start, end: peers[peer](start, end), self.server)
+        self.cache.fetch(sha256, ranges)
+
+        assert ranges.peers == ["empty"]
+        assert (ranges.failed_peers, ranges.server_bytes) == (1, len(content))
+
+    def test_peer_with_a_transient_failure_is_kept(self):
+        peer = serve(content)
+        failures = []
+
+        def flaky(start, end):
+            if not failures:
+                failures.append(start)
+                raise ConnectionError()
+            return peer(start, end)
+
+        ranges = PeerRanges(["flaky"], lambda name, start, end: flaky(start, end), self.server)
+        self.cache.fetch(sha256, ranges)
+
+        assert ranges.peers == ["flaky"]
+        assert ranges.failed_peers == 0
+        assert len(self.server.requests) == 1
+
+
+class CompanionTestCase(unittest.TestCase):
+    """Companions against one stub OctoFarm, 'create_companion' serves a plugin's blueprint on localhost"""
+
+    def setUp(self):
+        self.server = StubOctoFarmServer(**self.server_options()).start()
+        self.server.add_file(content)
+        self.folders = []
+        self.plugins = []
+        self.http_servers = []
+        self.app = flask.Flask(__name__)
+
+    def tearDown(self):
+        for http_server in self.http_servers:
+            http_server.shutdown()
+        for plugin in self.plugins:
+            plugin.on_shutdown()
+        self.server.stop()
+        for folder in self.folders:
+            shutil.rmtree(folder)
+
+    def server_options(self):
+        return dict()
+
+    def settings(self, path):
+        return dict(octofarm_host="http://127.0.0.1", octofarm_port=self.server.server_address[1],
+                    oidc_client_id="client", oidc_client_secret="secret").get(path[0])
+
+    def create_plugin(self):
+        folder = tempfile.mkdtemp()
+        self.folders.append(folder)
+        plugin = mock_plugin(folder, self.settings)
+        plugin._identifier = "octofarm_companion"
+        plugin._basefolder = os.path.dirname(octofarm_companion.__file__)
+        plugin._file_manager = mock.MagicMock()
+        plugin.initialize()
+        self.plugins.append(plugin)
+        return plugin
+
+    def create_companion(self):
+        """Returns a plugin and the URL other companions reach it at"""
+        plugin = self.create_plugin()
+        app = flask.Flask(__name__)
+        app.register_blueprint(plugin.get_blueprint(), url_prefix="/plugin/octofarm_companion")
+        http_server = make_server("127.0.0.1", 0, app, threaded=True)
+        threading.Thread(target=http_server.serve_forever, args=(0.05,), daemon=True).start()
+        self.http_servers.append(http_server)
+        return plugin, f"http://127.0.0.1:{http_server.server_port}/plugin/octofarm_companion/"
+
+    def fetch(self, plugin, sha256=sha256, path="farm/cube.gcode", **extra):
+        data = json.dumps(dict(sha256=sha256, path=path, **extra))
+        with self.app.test_request_context("/fetch_file", method="POST", data=data):
+            return plugin.fetch_file()
+
+    def wait_for_downloads(self, plugin):
+        plugin._download_workers.shutdown(wait=True)
+        plugin._download_workers = None
+
+    def stored(self, plugin):
+        return [(call[0][1], call[0][2].path) for call in plugin._file_manager.add_file.call_args_list]
+
+
+class TestPluginFileFetch(CompanionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.plugin = self.create_plugin()
+
+    def fetch(self, sha256=sha256, path="farm/cube.gcode", **extra):
+        return super().fetch(self.plugin, sha256, path, **extra)
+
+    def wait_for_downloads(self):
+        super().wait_for_downloads(self.plugin)
+
+    def stored(self):
+        return super().stored(self.plugin)
+
+    def test_fetch_by_hash(self):
+        assert self.fetch() == (dict(sha256=sha256, path="farm/cube.gcode", state="downloading"), 202)
+        self.wait_for_downloads()
+
+        cache_path = self.plugin._file_cache.path(sha256)
+        assert self.stored() == [("farm/cube.gcode", cache_path)]
+        assert self.server.file_bytes == len(content)
+        assert self.plugin._telemetry.drain()[-1]["data"]["downloadedBytes"] == len(content)
+
+    def test_known_file_is_stored_without_transfer(self):
+        self.fetch()
+        self.wait_for_downloads()
+
+        assert self.fetch(path="farm/cube-again.gcode")["state"] == "stored"
+        assert self.stored()[-1][0] == "farm/cube-again.gcode"
+        assert self.server.file_bytes == len(content)
+        assert self.plugin.get_file_cache()["hits"] == 1
+
+    def test_unknown_file_is_reported(self):
+        self.fetch(sha256=hashlib.sha256(b"unknown").hexdigest())
+        self.wait_for_downloads()
+
+        assert self.stored() == []
+        assert "404" in self.plugin._telemetry.drain()[-1]["data"]["error"]
+
+
+class TestPeerDistribution(CompanionTestCase):
+    def server_options(self):
+        return dict(signing_key=signing_key)
+
+    def grant(self, peers, sha256=sha256):
+        return self.server.issue_grant(sha256, peers, audience=["client"])
+
+    def test_file_leaves_octofarm_once(self):
+        seed, seed_url = self.create_companion()
+        self.fetch(seed)
+        self.wait_for_downloads(seed)
+        peers = [self.create_companion()[0] for i in range(3)]
+        for peer in peers:
+            assert self.fetch(peer, grant=self.grant([seed_url]))[1] == 202
+        for peer in peers:
+            self.wait_for_downloads(peer)
+
+        assert self.server.file_bytes == len(content)
+        for peer in peers:
+            event = peer._telemetry.drain()[-1]["data"]
+            assert (event["peerBytes"], event["serverBytes"]) == (len(content), 0)
+            assert self.stored(peer) == [("farm/cube.gcode", peer._file_cache.path(sha256))]
+
+    def test_cached_files_are_announced(self):
+        seed = self.create_plugin()
+        self.fetch(seed)
+        self.wait_for_downloads(seed)
+        target = seed._get_targets()[0]
+        seed._query_access_token(target)
+        with mock.patch.object(seed, "_http_post", wraps=seed._http_post) as post:
+            seed._query_announcement(target, target.token_manager.access_token)
+
+        assert post.call_args[1]["json"]["cachedFiles"] == [sha256]
+
+    def test_corrupt_peer_falls_back_to_octofarm(self):
+        seed, seed_url = self.create_companion()
+        self.fetch(seed)
+        self.wait_for_downloads(seed)
+        with open(seed._file_cache.path(sha256), "r+b") as f:
+            f.write(b"M104 S999\n")
+        peer = self.create_companion()[0]
+        self.fetch(peer, grant=self.grant([seed_url]))
+        self.wait_for_downloads(peer)
+
+        assert peer._file_cache.path(sha256) is not None
+        assert peer._telemetry.drain()[-1]["data"]["serverBytes"] == len(content)
+
+    def test_broken_off_peer_falls_back_to_octofarm(self):
+        peer = self.create_companion()[0]
+        broken = FakeResponse(206, content, {"Content-Range": f"bytes 0-{len(content) - 1}/{len(content)}"},
+                              fail_after=0)
+        with mock.patch.object(peer, "_get_peer_range", return_value=broken):
+            self.fetch(peer, grant=self.grant(["http://seed.invalid/"]))
+            self.wait_for_downloads(peer)
+
+        assert broken.closed
+        assert peer._file_cache.path(sha256) is not None
+        assert peer._telemetry.drain()[-1]["data"]["serverBytes"] == len(content)
+
+    def test_peer_route(self):
+        seed, seed_url = self.create_companion()
+        self.fetch(seed)
+        self.wait_for_downloads(seed)
+        peer = self.create_companion()[0]
+
+        response = peer._get_peer_range(seed_url, sha256, self.grant([seed_url]), 100, 199)
+        assert (response.status_code, response.content) == (206, content[100:200])
+        assert peer._get_peer_range(seed_url, "0" * 64, self.grant([seed_url], "0" * 64), 0, 99).status_code == 404
+        # A grant is good for its file only
+        assert peer._get_peer_range(seed_url, sha256, self.grant([seed_url], "0" * 64), 0, 99).status_code == 403
+        # Companion access tokens do not grant peer downloads
+        access_token = self.server.issue_token("client")["access_token"]
+        assert peer._get_peer_range(seed_url, sha256, access_token, 0, 99).status_code == 403
+        response = peer._http_get(seed_url + "files/" + sha256, headers={"Authorization": "Bearer a.b.c"})
+        assert response.status_code == 401
+
+    def test_peers_get_the_grant_only(self):
+        seed, seed_url = self.create_companion()
+        self.fetch(seed)
+        self.wait_for_downloads(seed)
+        peer = self.create_companion()[0]
+        grant = self.grant([seed_url])
+        with mock.patch.object(peer, "_http_get", wraps=peer._http_get) as get:
+            self.fetch(peer, grant=grant)
+            self.wait_for_downloads(peer)
+
+        headers = [call[1]["headers"]["Authorization"] for call in get.call_args_list
+                   if call[1]["operation"] == "peer_download"]
+        assert headers and set(headers) == {"Bearer " + grant}
+        assert self.server.file_bytes == len(content)
+
+    def test_seed_lists_need_a_grant(self):
+        peer = self.create_plugin()
+        forged = create_jwt(create_rsa_key(seed=4), dict(scope="companion:peer", sha256=sha256, aud=["client"],
+                                                         peers=["http://attacker.invalid/"], exp=2 ** 31), "stub-key")
+        for extra in (dict(peers=["http://attacker.invalid/"]), dict(grant=forged),
+                      dict(grant=self.grant(["http://attacker.invalid/"], "0" * 64)),
+                      dict(grant=self.grant(["file:///etc/passwd"]))):
+            with pytest.raises(BadRequest):
+                self.fetch(peer, **extra)
+
+        assert peer._download_workers is None
@@ -0,0 +1,163 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import unittest.mock as mock
+
+import pytest
+from octoprint.events import Events
+from octoprint.filemanager.util import DiskFileWrapper, StreamWrapper
+from werkzeug.exceptions import BadRequest, NotFound
+
+from octofarm_companion.gcode_index import GcodeIndexStore, index_buffer, index_file, is_sha256
+from tests.utils import mock_plugin
+
+gcode = b"""; generated by a slicer
+G90
+M82
+G92 E0
+G1 Z0.2 F600
+G1 X10 Y0 E1.0 F1200 ; first layer
+G1 X10 Y10 E2.0
+G1 Z0.6 ; hop, no layer
+G1 Z0.4
+G1 X0 Y10 E3.0
+T1
+G92 E0
+G1 X0 Y0 E0.5
+M83
+G1 Z0.6 F600
+G4 P500
+G1 X10 E0.25 F1200
+"""
+
+
+class TestGcodeIndex(unittest.TestCase):
+    def test_layers_tools_and_time(self):
+        index = index_buffer(gcode)
+
+        assert index["lines"] == 16
+        assert index["tools"] == {"0": 3.0, "1": 0.75}
+        assert index["layers"]["z"] == [0.2, 0.4, 0.6]
+        # Each layer starts at the line moving to its height
+        assert [gcode[offset:].split(b"\n")[0] for offset in index["layers"]["offsets"]] == [
+            b"G1 Z0.2 F600", b"G1 Z0.4", b"G1 Z0.6 F600"]
+        assert index["layers"]["time"] == [1.0, 1.0, 1.0]
+        assert index["estimatedTime"] == 3.1
+        assert index["sha256"] == hashlib.sha256(gcode).hexdigest()
+        assert index["size"] == len(gcode)
+
+    def test_slices_do_not_change_the_index(self):
+        assert index_buffer(gcode, chunk_size=7) == index_buffer(gcode)
+        assert index_buffer(gcode.rstrip(b"\n"), chunk_size=5)["layers"] == index_buffer(gcode)["layers"]
+
+    def test_mapped_file(self):
+        folder = tempfile.mkdtemp()
+        try:
+            path = os.path.join(folder, "cube.gcode")
+            with open(path, "wb") as f:
+                f.write(gcode)
+            assert index_file(path) == index_buffer(gcode)
+
+            open(path, "wb").close()
+            assert index_file(path)["sha256"] == hashlib.sha256(b"").hexdigest()
+        finally:
+            shutil.rmtree(folder)
+
+    def test_is_sha256(self):
+        assert is_sha256(hashlib.sha256(b"").hexdigest())
+        assert not is_sha256("../" + hashlib.sha256(b"").hexdigest()[3:])
+        assert not is_sha256(hashlib.sha256(b"").hexdigest().upper())
+
+
+class TestGcodeIndexStore(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.store = GcodeIndexStore(self.folder)
+        self.index = index_buffer(gcode)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def index_files(self):
+        return sorted(name for name in os.listdir(self.folder) if is_sha256(name[:-len(".json")]))
+
+    def test_same_content_shares_the_index(self):
+        self.store.put("cube.gcode", self.index)
+        self.store.put("copies/cube.gcode", self.index)
+
+        assert json.loads(self.store.get(self.index["sha256"])) == self.index
+        assert self.store.stats() == dict(indexed=1, reused=1, failed=0, files=1)
+
+        self.store.remove("cube.gcode")
+        assert self.index_files() == [self.index["sha256"] + ".json"]
+        self.store.remove("copies/cube.gcode")
+        assert self.index_files() == []
+        assert self.store.get(self.index["sha256"]) is None
+
+    def test_paths_survive_restart(self):
+        self.store.put("cube.gcode", self.index)
+        self.store.move("cube.gcode", "done/cube.gcode")
+
+        assert GcodeIndexStore(self.folder).paths() == {"done/cube.gcode": self.index["sha256"]}
+
+    def test_overwritten_file_replaces_its_index(self):
+        self.store.put("cube.gcode", self.index)
+        self.store.put("cube.gcode", index_buffer(gcode + b"G1 X1\n"))
+
+        assert len(self.index_files()) == 1
+        assert self.store.get(self.index["sha256"]) is None
+
+
+class TestPluginGcodeIndex(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.plugin = mock_plugin(self.folder)
+        self.plugin.initialize()
+
+    def tearDown(self):
+        self.plugin.on_shutdown()
+        shutil.rmtree(self.folder)
+
+    def upload(self, name, content=gcode):
+        upload = os.path.join(self.folder, "upload.tmp")
+        with open(upload, "wb") as f:
+            f.write(content)
+        file_object = DiskFileWrapper(name, upload)
+        assert self.plugin.gcode_preprocessor_hook(name, file_object) is file_object
+        # OctoPrint moves the upload into the storage right after the hook
+        file_object.save(os.path.join(self.folder, name))
+        self.plugin._index_worker.submit(lambda: None).result()
+
+    def test_upload_is_indexed_in_the_background(self):
+        self.upload("cube.gcode")
+
+        sha256 = hashlib.sha256(gcode).hexdigest()
+        assert self.plugin.get_gcode_indexes()["paths"] == {"cube.gcode": sha256}
+        assert next(iter(self.plugin._index_worker._threads)).name.startswith("OctoFarmCompanionIndex")
+        with mock.patch("octofarm_companion.flask.Response") as response:
+            self.plugin.get_gcode_index(sha256)
+        assert json.loads(response.call_args[0][0])["tools"] == {"0": 3.0, "1": 0.75}
+        assert self.plugin._telemetry.drain()[-1]["type"] == "gcodeIndex"
+
+    def test_other_uploads_are_passed_through(self):
+        stream = StreamWrapper("cube.gcode", mock.MagicMock())
+        assert self.plugin.gcode_preprocessor_hook("cube.gcode", stream) is stream
+        model = DiskFileWrapper("cube.stl", os.path.join(self.folder, "cube.stl"))
+        assert self.plugin.gcode_preprocessor_hook("cube.stl", model) is model
+
+        assert self.plugin._index_worker is None
+
+    def test_removed_file_drops_its_index(self):
+        self.upload("cube.gcode")
+        self.plugin.on_event(Events.FILE_REMOVED, dict(storage="local", path="cube.gcode", type=["machinecode"]))
+
+        assert self.plugin.get_gcode_indexes()["paths"] == {}
+        with pytest.raises(NotFound):
+            self.plugin.get_gcode_index(hashlib.sha256(gcode).hexdigest())
+
+    def test_invalid_hash_is_rejected(self):
+        with pytest.raises(BadRequest):
+            self.plugin.get_gcode_index("paths")
@@ -0,0 +1,64 @@
+import unittest
+
+from octofarm_companion.constants import Config
+from octofarm_companion.http_client import OctoFarmHttpClient, get_base_url
+from tests.stub_octofarm import StubOctoFarmServer
+
+
+class TestOctoFarmHttpClient(unittest.TestCase):
+    @classmethod
+    def setUp(cls):
+        cls.server = StubOctoFarmServer().start()
+        cls.client = OctoFarmHttpClient(pool_size=2, connect_timeout=1, read_timeout=2, retries=0)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+
+    def test_base_url(self):
+        assert get_base_url("HTTPS://Farm.net:443/oidc/token") == "https://farm.net:443"
+        assert get_base_url("http://127.0.0.1:4000") == "http://127.0.0.1:4000"
+
+    def test_session_per_base_url(self):
+        session = self.client.session("http://127.0.0.1:4000/oidc/token")
+        assert session is self.client.session("http://127.0.0.1:4000/octoprint/announce")
+        assert session is not self.client.session("http://127.0.0.1:4001/octoprint/announce")
+
+    def test_defaults(self):
+        client = OctoFarmHttpClient()
+        assert client.timeout == (Config.default_http_connect_timeout, Config.default_http_read_timeout)
+        assert client.pool_size == Config.default_http_pool_size
+
+    def test_keep_alive_reuses_connection(self):
+        headers = {"Authorization": "Bearer " + self.server.issue_token()["access_token"]}
+        for i in range(5):
+            response = self.client.post(self.server.base_url + "/octoprint/announce", json={"ping": i},
+                                        headers=headers)
+            assert response.status_code == 200
+        response = self.client.get(self.server.base_url + "/serverChecks/version")
+        assert response.json()["version"] == "stub-version"
+
+        assert self.server.connections == 1
+        assert self.server.requests["/octoprint/announce"] == 5
+
+    def test_close_drops_sessions(self):
+        self.client.get(self.server.base_url + "/serverChecks/version")
+        self.client.close()
+        self.client.get(self.server.base_url + "/serverChecks/version")
+
+        assert self.server.connections == 2
+
+    def test_only_idempotent_requests_are_retried(self):
+        client = OctoFarmHttpClient(retries=2)
+        self.server.error_rate = 1.0
+        self.server.error_status = 502
+        headers = {"Authorization": "Bearer " + self.server.issue_token()["access_token"]}
+        try:
+            response = client.post(self.server.base_url + "/octoprint/announce", json={}, headers=headers)
+            assert response.status_code == 502
+            assert client.get(self.server.base_url + "/serverChecks/version").status_code == 502
+        finally:
+            client.close()
+
+        assert self.server.requests["/octoprint/announce"] == 1
+        assert self.server.requests["/serverChecks/version"] == 3
@@ -0,0 +1,140 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import flask
+import pytest
+from octoprint.events import Events
+from werkzeug.exceptions import BadRequest
+
+from octofarm_companion.gcode_index import index_buffer
+from octofarm_companion.job_history import JobHistory, DONE, FAILED, INTERRUPTED
+from tests.utils import FakeClock, mock_plugin
+
+sha256 = hashlib.sha256(b"G1 X1\n").hexdigest()
+
+
+class TestJobHistory(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.clock = FakeClock(1700000000)
+        self.history = JobHistory(os.path.join(self.folder, "jobs.db"), clock=self.clock)
+
+    def tearDown(self):
+        self.history.close()
+        shutil.rmtree(self.folder)
+
+    def reopen(self, **kwargs):
+        self.history.close()
+        self.history = JobHistory(os.path.join(self.folder, "jobs.db"), clock=self.clock, **kwargs)
+
+    def test_job_lifecycle(self):
+        self.history.start("job-1", name="cube.gcode", path="parts/cube.gcode", origin="local", sha256=sha256)
+        self.clock.now += 600
+        self.history.finish("job-1", DONE, print_time=598.5, extruded_mm=1234.5)
+
+        page = self.history.export()
+        assert page == dict(cursor=2, more=False, jobs=[dict(
+            revision=2, jobId="job-1", name="cube.gcode", path="parts/cube.gcode", origin="local", sha256=sha256,
+            state=DONE, reason=None, startedAt=1700000000, endedAt=1700000600, printTime=598.5, extrudedMm=1234.5)])
+
+    def test_cursor_pages_through_changes(self):
+        for i in range(5):
+            self.history.start(f"job-{i}")
+        self.history.finish("job-0", FAILED, reason="cancelled")
+
+        first = self.history.export(limit=4)
+        assert [job["jobId"] for job in first["jobs"]] == ["job-1", "job-2", "job-3", "job-4"]
+        assert first["more"]
+        second = self.history.export(first["cursor"], limit=4)
+        assert [(job["jobId"], job["state"]) for job in second["jobs"]] == [("job-0", FAILED)]
+        assert not second["more"]
+        assert self.history.export(second["cursor"]) == dict(jobs=[], cursor=second["cursor"], more=False)
+
+    def test_filter_by_file(self):
+        self.history.start("job-1", sha256=sha256)
+        self.history.start("job-2")
+
+        assert [job["jobId"] for job in self.history.export(sha256=sha256)["jobs"]] == ["job-1"]
+
+    def test_etag_changes_with_every_change(self):
+        etags = {self.history.etag()}
+        self.history.start("job-1")
+        etags.add(self.history.etag())
+        self.history.finish("job-1", DONE)
+        etags.add(self.history.etag())
+
+        assert len(etags) == 3
+        etag = self.history.etag()
+        self.reopen()
+        assert self.history.etag() == etag
+
+    def test_oldest_jobs_are_pruned(self):
+        self.reopen(max_jobs=3)
+        for i in range(5):
+            self.clock.now += 1
+            self.history.start(f"job-{i}")
+
+        assert [job["jobId"] for job in self.history.export()["jobs"]] == ["job-2", "job-3", "job-4"]
+
+    def test_unfinished_job_is_interrupted_after_restart(self):
+        self.history.start("job-1")
+        self.reopen()
+
+        job = self.history.export(1)["jobs"][0]
+        assert (job["state"], job["revision"]) == (INTERRUPTED, 2)
+        self.history.start("job-2")
+        assert self.history.stats() == dict(jobs=2, revision=3)
+
+    def test_write_ahead_log(self):
+        assert self.history._db.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+        plan = self.history._db.execute("EXPLAIN QUERY PLAN SELECT * FROM jobs WHERE sha256 = ? AND revision > ? "
+                                        "ORDER BY revision", (sha256, 0)).fetchall()
+        assert "jobs_sha256" in str(plan)
+
+
+class TestPluginJobHistory(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.plugin = mock_plugin(self.folder)
+        self.plugin.initialize()
+        self.app = flask.Flask(__name__)
+
+    def tearDown(self):
+        self.plugin.on_shutdown()
+        shutil.rmtree(self.folder)
+
+    def get_jobs(self, query="", headers=None):
+        with self.app.test_request_context(f"/jobs{query}", headers=headers):
+            return self.plugin.get_jobs()
+
+    def test_print_events_are_recorded(self):
+        self.plugin._gcode_index.put("cube.gcode", index_buffer(b"G1 X1\n"))
+        payload = dict(name="cube.gcode", path="cube.gcode", origin="local")
+        self.plugin.on_event(Events.PRINT_STARTED, payload)
+        self.plugin.gcode_sent_hook(None, "sent", "M83", None, "M83")
+        self.plugin.gcode_sent_hook(None, "sent", "G1 E5", None, "G1")
+        self.plugin.on_event(Events.PRINT_DONE, dict(payload, time=12.5))
+
+        response = self.get_jobs()
+        job = json.loads(response.get_data())["jobs"][0]
+        assert (job["state"], job["sha256"], job["printTime"], job["extrudedMm"]) == (DONE, sha256, 12.5, 5.0)
+        assert job["jobId"] == self.plugin._telemetry.drain()[0]["data"]["jobId"]
+
+    def test_unchanged_export_is_not_modified(self):
+        self.plugin.on_event(Events.PRINT_STARTED, dict(name="cube.gcode", path="cube.gcode", origin="local"))
+        etag = self.get_jobs().headers["ETag"]
+
+        assert self.get_jobs(headers={"If-None-Match": etag}).status_code == 304
+        self.plugin.on_event(Events.PRINT_FAILED, dict(name="cube.gcode", reason="cancelled"))
+        response = self.get_jobs("?after=1", headers={"If-None-Match": etag})
+        assert response.status_code == 200
+        assert json.loads(response.get_data())["jobs"][0]["reason"] == "cancelled"
+
+    def test_invalid_cursor_is_rejected(self):
+        for query in ("?after=x", "?after=-1", "?limit=0", "?sha256=cube.gcode"):
+            with pytest.raises(BadRequest):
+                self.get_jobs(query)
@@ -0,0 +1,181 @@
+import base64
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import unittest.mock as mock
+
+from octoprint.events import Events
+
+from octofarm_companion.ledger import UsageLedger, record_size
+from tests.utils import FakeClock, create_fake_at, mock_plugin
+
+job_id = "0b6f3c55-8a8e-4d4e-9d1f-3c1a7e5b2f10"
+
+
+class TestUsageLedger(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.clock = FakeClock(1700000000)
+        self.ledger = UsageLedger(self.folder, clock=self.clock)
+
+    def tearDown(self):
+        self.ledger.close()
+        shutil.rmtree(self.folder)
+
+    def ledger_files(self):
+        return sorted(name for name in os.listdir(self.folder) if name.endswith(".bin"))
+
+    def reopen(self):
+        self.ledger.close()
+        self.ledger = UsageLedger(self.folder, clock=self.clock)
+
+    def test_fixed_width_records(self):
+        self.ledger.append({"pla-red": 12.5, "tool1": 0.75}, job_id)
+        self.ledger.append({"pla-red": 3.0})
+
+        data, start, end = self.ledger.read(0)
+        assert (start, end) == (0, 3)
+        assert len(data) == 3 * record_size == 78
+        assert self.ledger.decode(data) == [
+            dict(timestamp=1700000000, spool_id="pla-red", extruded_mm=12.5, job_id=job_id),
+            dict(timestamp=1700000000, spool_id="tool1", extruded_mm=0.75, job_id=job_id),
+            dict(timestamp=1700000000, spool_id="pla-red", extruded_mm=3.0, job_id=None),
+        ]
+        assert self.ledger.totals() == {"pla-red": 15.5, "tool1": 0.75}
+
+    def test_pending_ranges_until_acknowledged(self):
+        for i in range(5):
+            self.ledger.append({"pla-red": 1.0})
+
+        assert self.ledger.pending(limit=2)[1:] == (0, 2)
+        self.ledger.ack(2)
+        assert self.ledger.pending(limit=10)[1:] == (2, 5)
+        self.ledger.ack(5)
+        assert self.ledger.pending() == (b"", 5, 5)
+
+    def test_compaction_keeps_totals_and_offsets(self):
+        for i in range(10):
+            self.ledger.append({"pla-red": 1.0, "petg-blue": 0.5})
+        self.ledger.ack(15)
+
+        assert not self.ledger.compact(min_records=16)
+        assert self.ledger.compact(min_records=10)
+        assert self.ledger.compacted_totals() == {"pla-red": 8.0, "petg-blue": 3.5}
+        assert self.ledger.totals() == {"pla-red": 10.0, "petg-blue": 5.0}
+        assert self.ledger.stats()["records"] == 5
+        assert self.ledger_files() == ["ledger-000000000015.bin"]
+
+        data, start, end = self.ledger.read(0)
+        assert (start, end) == (15, 20)
+        self.ledger.append({"pla-red": 1.0})
+        assert self.ledger.pending()[1:] == (15, 21)
+
+    def test_survives_restart(self):
+        self.ledger.append({"pla-red": 1.0, "petg-blue": 2.0})
+        self.ledger.ack(1)
+        self.ledger.compact(min_records=1)
+        self.reopen()
+
+        assert self.ledger.totals() == {"pla-red": 1.0, "petg-blue": 2.0}
+        assert self.ledger.pending()[1:] == (1, 2)
+        self.ledger.append({"tool0": 1.0})
+        assert self.ledger.spools() == ["pla-red", "petg-blue", "tool0"]
+
+    def test_torn_record_is_truncated(self):
+        self.ledger.append({"pla-red": 1.0})
+        self.ledger.close()
+        with open(os.path.join(self.folder, self.ledger_files()[0]), "ab") as f:
+            f.write(b"\x01\x02\x03")
+        self.reopen()
+
+        assert self.ledger.stats()["records"] == 1
+        self.ledger.append({"pla-red": 2.0})
+        assert self.ledger.totals() == {"pla-red": 3.0}
+
+    def test_interrupted_compaction_is_discarded(self):
+        self.ledger.append({"pla-red": 1.0})
+        self.ledger.close()
+        # Written before the state referencing it
+        with open(os.path.join(self.folder, "ledger-000000000001.bin"), "wb") as f:
+            f.write(b"")
+        self.reopen()
+
+        assert self.ledger_files() == ["ledger-000000000000.bin"]
+        assert self.ledger.totals() == {"pla-red": 1.0}
+
+    def test_size_cap_folds_the_oldest_records(self):
+        ledger = UsageLedger(os.path.join(self.folder, "capped"), max_size=10 * record_size, clock=self.clock)
+        for i in range(11):
+            ledger.append({"pla-red": 1.0})
+
+        assert ledger.stats()["records"] == 6
+        assert ledger.stats()["dropped"] == 5
+        assert ledger.pending()[1:] == (5, 11)
+        assert ledger.totals() == {"pla-red": 11.0}
+        ledger.close()
+
+    def test_one_fsync_per_append(self):
+        self.ledger.append({"pla-red": 1.0, "petg-blue": 1.0, "tool2": 1.0})
+        with mock.patch("os.fsync") as fsync:
+            self.ledger.append({"pla-red": 1.0, "petg-blue": 1.0, "tool2": 1.0})
+
+        assert fsync.call_count == 1
+
+
+class TestPluginLedger(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.plugin = mock_plugin(self.folder)
+        self.plugin._get_device_uuid = lambda: "device-uuid"
+        self.plugin.initialize()
+
+    def tearDown(self):
+        self.plugin.on_shutdown()
+        shutil.rmtree(self.folder)
+
+    def extrude(self, *lines):
+        for line in lines:
+            self.plugin.gcode_sent_hook(None, "sent", line, None, line.split()[0])
+
+    def test_job_usage_is_recorded(self):
+        self.extrude("M83", "G1 E5")
+        self.plugin.on_event(Events.PRINT_STARTED, dict(name="cube.gcode"))
+        self.extrude("G1 X1 E10")
+        self.plugin.on_event(Events.PRINT_DONE, dict(name="cube.gcode"))
+
+        records = self.plugin._ledger.decode(self.plugin._ledger.read(0)[0])
+        assert [record["extruded_mm"] for record in records] == [5.0, 10.0]
+        assert records[0]["job_id"] is None
+        assert len(records[1]["job_id"]) == 36
+        assert self.plugin.get_filament_usage()["ledger"]["totals"] == {"tool0": 15.0}
+
+    def test_bulk_sync(self):
+        self.extrude("M83", "G1 E5")
+        self.plugin._record_usage()
+        self.extrude("G1 E2")
+        self.plugin._record_usage()
+        self.plugin._get_targets()[0].token_manager.update(dict(access_token=create_fake_at(), expires_in=600))
+
+        with mock.patch('requests.Session.post', return_value=mock.MagicMock(status_code=200)) as post:
+            self.plugin._sync_usage()
+
+        assert post.call_count == 1
+        assert post.call_args[0][0].endswith("octoprint/usage")
+        document = json.loads(gzip.decompress(post.call_args[1]["data"]))
+        assert (document["from"], document["to"]) == (0, 2)
+        assert document["spools"] == ["tool0"]
+        assert len(base64.b64decode(document["records"])) == 2 * record_size
+        assert self.plugin._ledger.pending()[1:] == (2, 2)
+
+    def test_failed_sync_is_retried(self):
+        self.extrude("M83", "G1 E5")
+        self.plugin._record_usage()
+        self.plugin._get_targets()[0].token_manager.update(dict(access_token=create_fake_at(), expires_in=600))
+
+        with mock.patch('requests.Session.post', return_value=mock.MagicMock(status_code=503)):
+            self.plugin._sync_usage()
+
+        assert self.plugin._ledger.pending()[1:] == (0, 1)
@@ -0,0 +1,124 @@
+import json
+import threading
+import unittest
+import unittest.mock as mock
+
+import pytest
+
+from octofarm_companion.metrics import MetricsRegistry, Histogram, outcome_for_status
+from octofarm_companion.network import NetworkTimeoutError
+from tests.utils import FakeClock, mock_plugin
+
+
+class TestMetricsRegistry(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock(0.0)
+        self.metrics = MetricsRegistry(buckets=(0.1, 1.0), clock=self.clock)
+
+    def test_histogram_buckets(self):
+        histogram = Histogram((0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 2.0):
+            histogram.observe(value)
+
+        assert histogram.counts == [2, 1, 1]
+        assert list(histogram.cumulative_counts()) == [2, 3, 4]
+        assert histogram.count == 4
+        assert histogram.sum == pytest.approx(2.65)
+
+    def test_concurrent_observations_are_counted(self):
+        def record():
+            for i in range(10000):
+                self.metrics.observe("announce", "success", 0.5)
+
+        threads = [threading.Thread(target=record) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        histogram = self.metrics.histogram("announce", "success")
+        assert histogram.count == 40000
+        assert histogram.sum == 20000.0
+
+    def test_outcome_for_status(self):
+        assert outcome_for_status(204) == "success"
+        assert outcome_for_status(401) == "rejected"
+
+    def test_time_records_outcome(self):
+        with self.metrics.time("announce"):
+            self.clock.now += 0.5
+        with self.metrics.time("announce") as timing:
+            timing.outcome = "rejected"
+        with pytest.raises(ValueError):
+            with self.metrics.time("announce"):
+                raise ValueError()
+
+        assert self.metrics.histogram("announce", "success").sum == 0.5
+        assert self.metrics.histogram("announce", "rejected").count == 1
+        assert self.metrics.histogram("announce", "error").count == 1
+
+    def test_render_prometheus_text(self):
+        self.metrics.observe("token", "success", 0.05)
+        self.metrics.observe("token", "success", 3.0)
+        self.metrics.increment("announcements", "Announcement decisions by action", (("action", "skip"),))
+
+        lines = self.metrics.render().splitlines()
+
+        assert "# TYPE octofarm_companion_duration_seconds histogram" in lines
+        assert 'octofarm_companion_duration_seconds_bucket{operation="token",outcome="success",le="0.1"} 1' in lines
+        assert 'octofarm_companion_duration_seconds_bucket{operation="token",outcome="success",le="1.0"} 1' in lines
+        assert 'octofarm_companion_duration_seconds_bucket{operation="token",outcome="success",le="+Inf"} 2' in lines
+        assert 'octofarm_companion_duration_seconds_count{operation="token",outcome="success"} 2' in lines
+        assert "# TYPE octofarm_companion_announcements_total counter" in lines
+        assert 'octofarm_companion_announcements_total{action="skip"} 1' in lines
+
+
+class TestPluginMetrics(unittest.TestCase):
+    def setUp(self):
+        self.plugin = mock_plugin("test_data/metrics")
+        self.plugin._get_device_uuid = lambda: "device-uuid"
+        self.plugin._persisted_data["persistence_uuid"] = "persistence-uuid"
+
+    def tearDown(self):
+        self.plugin.on_shutdown()
+
+    @staticmethod
+    def mocked_requests_post(url, **kwargs):
+        if url.endswith("oidc/token"):
+            text = json.dumps({"access_token": "secret-token-" + "x" * 40, "expires_in": 600})
+            return mock.MagicMock(status_code=200, text=text)
+        return mock.MagicMock(status_code=400, text="{}")
+
+    @mock.patch('requests.Session.post', side_effect=mocked_requests_post)
+    def test_check_is_measured(self, mock_post):
+        self.plugin._check_octofarm()
+        self.plugin._check_octofarm()
+
+        metrics = self.plugin._metrics
+        assert metrics.histogram("token", "success").count == 1
+        assert metrics.histogram("announce", "rejected").count == 2
+        assert 'octofarm_companion_announcements_total{action="full"} 2' in metrics.render()
+
+    @mock.patch('requests.Session.post', side_effect=mocked_requests_post)
+    def test_access_token_is_not_logged(self, mock_post):
+        self.plugin._check_octofarm()
+
+        logged = str(self.plugin._logger.mock_calls)
+        assert "secret-token" not in logged
+
+    def test_timeout_outcome(self):
+        with mock.patch.object(self.plugin._network, "call", side_effect=NetworkTimeoutError()):
+            with pytest.raises(NetworkTimeoutError):
+                self.plugin._http_get("http://127.0.0.1", operation="test_connection")
+
+        assert self.plugin._metrics.histogram("test_connection", "timeout").count == 1
+
+    def test_metrics_route(self):
+        self.plugin._metrics.observe("announce", "success", 0.01)
+
+        with mock.patch("octofarm_companion.flask.Response") as response:
+            self.plugin.get_metrics()
+
+        body = response.call_args[0][0]
+        assert 'octofarm_companion_duration_seconds_count{operation="announce",outcome="success"} 1' in body
+        assert response.call_args[1]["mimetype"].startswith("text/plain")
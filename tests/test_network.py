@@ -0,0 +1,72 @@
+import threading
+import time
+import unittest
+
+import pytest
+
+from octofarm_companion.network import NetworkEngine, NetworkTimeoutError, NetworkStoppedError
+
+
+class TestNetworkEngine(unittest.TestCase):
+    @classmethod
+    def setUp(cls):
+        cls.engine = NetworkEngine(workers=2, deadline=0.2)
+        cls.release = threading.Event()
+
+    def tearDown(self):
+        self.release.set()
+        self.engine.shutdown()
+
+    def test_call_runs_off_caller_thread(self):
+        caller = threading.current_thread()
+
+        worker = self.engine.call(threading.current_thread)
+
+        assert worker is not caller
+        assert worker.name.startswith("OctoFarmCompanionNetwork")
+
+    def test_call_passes_arguments(self):
+        assert self.engine.call(lambda a, b=1: a + b, 1, b=2) == 3
+
+    def test_call_raises_task_exception(self):
+        def fail():
+            raise ValueError("OctoFarm said no")
+
+        with pytest.raises(ValueError):
+            self.engine.call(fail)
+
+    def test_deadline_exceeded(self):
+        start = time.monotonic()
+        with pytest.raises(NetworkTimeoutError):
+            self.engine.call(self.release.wait, 10)
+
+        assert time.monotonic() - start < 1
+
+    def test_custom_deadline(self):
+        assert self.engine.call(time.sleep, 0.3, deadline=1) is None
+
+    def test_shutdown_cancels_pending_calls(self):
+        future = self.engine.submit(self.release.wait, 10)
+        start = time.monotonic()
+
+        self.engine.shutdown()
+
+        with pytest.raises(NetworkStoppedError):
+            self.engine.result(future, 10)
+        assert time.monotonic() - start < 1
+
+    def test_abandoned_call_result_is_dropped(self):
+        future = self.engine.submit(self.release.wait, 10)
+        with pytest.raises(NetworkTimeoutError):
+            self.engine.result(future, 0.1)
+
+        self.release.set()
+        time.sleep(0.1)
+        assert future.cancelled()
+        assert self.engine._pending == set()
+
+    def test_rejects_calls_after_shutdown(self):
+        self.engine.shutdown()
+
+        with pytest.raises(NetworkStoppedError):
+            self.engine.call(time.time)
@@ -0,0 +1,194 @@
+import os
+import shutil
+import tempfile
+import unittest
+import unittest.mock as mock
+
+import requests
+
+from octofarm_companion.outbox import DurableOutbox, RateLimiter
+from tests.utils import FakeClock, create_fake_at, mock_plugin
+
+
+class TestDurableOutbox(unittest.TestCase):
+    @classmethod
+    def setUp(cls):
+        cls.folder = tempfile.mkdtemp()
+        cls.clock = FakeClock()
+        cls.outbox = DurableOutbox(cls.folder, segment_size=200, max_size=10000, fsync_every=5, clock=cls.clock)
+
+    def tearDown(self):
+        self.outbox.close()
+        shutil.rmtree(self.folder)
+
+    def segments(self):
+        return sorted(name for name in os.listdir(self.folder) if name.endswith(".seg"))
+
+    def test_read_in_order_and_ack(self):
+        for n in range(30):
+            self.outbox.append({"n": n})
+        assert len(self.segments()) > 1
+
+        records, position = self.outbox.read(10)
+        assert [record["n"] for record in records] == list(range(10))
+        # Nothing is delivered before the ack
+        assert self.outbox.read(10)[0] == records
+
+        self.outbox.ack(position)
+        records, position = self.outbox.read(100)
+        assert [record["n"] for record in records] == list(range(10, 30))
+
+        self.outbox.ack(position)
+        assert self.outbox.read(100)[0] == []
+        assert self.outbox.pending_bytes() == 0
+        assert len(self.segments()) == 1
+
+    def test_survives_restart(self):
+        for n in range(10):
+            self.outbox.append({"n": n})
+        records, position = self.outbox.read(4)
+        self.outbox.ack(position)
+        self.outbox.close()
+
+        self.outbox = DurableOutbox(self.folder, segment_size=200, clock=self.clock)
+        self.outbox.append({"n": 10})
+
+        assert [record["n"] for record in self.outbox.read(100)[0]] == list(range(4, 11))
+
+    def test_skips_torn_record(self):
+        self.outbox.append({"n": 1})
+        self.outbox.close()
+        with open(os.path.join(self.folder, self.segments()[-1]), "ab") as f:
+            f.write(b'{"n": 2, "broken')
+
+        self.outbox = DurableOutbox(self.folder, clock=self.clock)
+        self.outbox.append({"n": 3})
+
+        assert [record["n"] for record in self.outbox.read(100)[0]] == [1, 3]
+        assert self.outbox.stats()["corrupt"] == 1
+
+    def test_size_cap_drops_oldest_segments(self):
+        self.outbox.max_size = 600
+        for n in range(100):
+            self.outbox.append({"n": n})
+
+        stats = self.outbox.stats()
+        assert stats["bytes"] <= 600 + 200
+        assert stats["dropped_segments"] > 0
+        records = self.outbox.read(1000)[0]
+        assert records[-1]["n"] == 99
+        assert records[0]["n"] > 0
+        assert [record["n"] for record in records] == list(range(records[0]["n"], 100))
+
+    @mock.patch('octofarm_companion.outbox.os.fsync')
+    def test_fsync_batching(self, mock_fsync):
+        outbox = DurableOutbox(self.folder, segment_size=100000, fsync_every=5, fsync_interval=10,
+                               clock=self.clock)
+        for n in range(12):
+            outbox.append({"n": n})
+        assert mock_fsync.call_count == 2
+
+        self.clock.now += 10
+        outbox.append({"n": 12})
+        assert mock_fsync.call_count == 3
+        outbox.close()
+
+
+class TestRateLimiter(unittest.TestCase):
+    def test_paces_acquisitions(self):
+        clock = FakeClock()
+        sleeps = []
+
+        def sleep(seconds):
+            sleeps.append(seconds)
+            clock.now += seconds
+
+        limiter = RateLimiter(2, burst=2, clock=clock, sleep=sleep)
+        for i in range(6):
+            limiter.acquire()
+
+        assert sleeps == [0.5, 0.5, 0.5, 0.5]
+
+        clock.now += 10
+        limiter.acquire()
+        limiter.acquire()
+        assert len(sleeps) == 4
+
+
+class TestPluginOutbox(unittest.TestCase):
+    @classmethod
+    def setUp(cls):
+        cls.folder = tempfile.mkdtemp()
+        cls.plugin = mock_plugin(cls.folder)
+        cls.plugin._get_device_uuid = lambda: "device-uuid"
+        cls.plugin.initialize()
+        cls.plugin._replay_limiter = RateLimiter(1000)
+
+    def tearDown(self):
+        self.plugin.on_shutdown()
+        shutil.rmtree(self.folder)
+
+    def test_only_the_latest_failed_announcement_is_kept(self):
+        target = self.plugin._get_targets()[0]
+        with mock.patch('requests.Session.post', side_effect=requests.exceptions.ConnectionError()):
+            for i in range(3):
+                self.plugin._query_announcement(target, create_fake_at())
+
+        assert len(self.plugin._pending_announcements) == 1
+        assert self.plugin._outbox.read(10)[0] == []
+
+        target.token_manager.update(dict(access_token=create_fake_at(), expires_in=600))
+        with mock.patch('requests.Session.post', return_value=mock.MagicMock(status_code=200)) as mock_post:
+            self.plugin._replay_outbox()
+
+        assert mock_post.call_count == 1
+        assert self.plugin._pending_announcements == {}
+
+    def test_failed_announcement_survives_shutdown(self):
+        with mock.patch('requests.Session.post', side_effect=requests.exceptions.ConnectionError()):
+            self.plugin._query_announcement(self.plugin._get_targets()[0], create_fake_at())
+        self.plugin.on_shutdown()
+
+        outbox = DurableOutbox(self.plugin._outbox.folder)
+        records = outbox.read(10)[0]
+        outbox.close()
+        assert records[0]["type"] == "announcement"
+        assert records[0]["data"]["deviceUuid"] == "device-uuid"
+
+    def test_spilled_events_are_on_disk(self):
+        self.plugin._spill_to_outbox([{"type": "job", "data": {"n": n}} for n in range(3)])
+
+        # Read by a second instance, which only sees what was written to the files
+        outbox = DurableOutbox(self.plugin._outbox.folder)
+        assert len(outbox.read(10)[0]) == 3
+        outbox.close()
+
+    def test_failed_telemetry_is_spilled_and_replayed(self):
+        for n in range(3):
+            self.plugin._telemetry.emit("job", {"n": n})
+        self.plugin._telemetry.flush(force=True)
+        assert self.plugin._telemetry.stats()["spilled"] == 3
+        assert self.plugin._telemetry.pending() == 0
+
+        self.plugin._get_targets()[0].token_manager.update(dict(access_token=create_fake_at(), expires_in=600))
+        with mock.patch('requests.Session.post', return_value=mock.MagicMock(status_code=200)) as mock_post:
+            self.plugin._replay_outbox()
+
+        assert mock_post.call_count == 1
+        assert self.plugin._outbox.read(10)[0] == []
+
+    def test_replay_stops_on_failure(self):
+        self.plugin._spill_to_outbox([{"type": "job", "data": {}}])
+        self.plugin._get_targets()[0].token_manager.update(dict(access_token=create_fake_at(), expires_in=600))
+        with mock.patch('requests.Session.post', return_value=mock.MagicMock(status_code=503)):
+            self.plugin._replay_outbox()
+
+        assert len(self.plugin._outbox.read(10)[0]) == 1
+
+    def test_shutdown_persists_pending_events(self):
+        self.plugin._telemetry.emit("job", {"n": 1})
+        self.plugin.on_shutdown()
+
+        outbox = DurableOutbox(self.plugin._outbox.folder)
+        assert outbox.read(10)[0][0]["data"] == {"n": 1}
+        outbox.close()
@@ -0,0 +1,98 @@
+import unittest
+import unittest.mock as mock
+
+from octoprint.events import Events
+from octoprint.util.comm import gcode_command_for_cmd
+
+from octofarm_companion import OctoFarmCompanionPlugin
+from octofarm_companion.pedometer import FilamentPedometer
+
+
+class TestFilamentPedometer(unittest.TestCase):
+    @classmethod
+    def setUp(cls):
+        cls.pedometer = FilamentPedometer()
+
+    def send(self, *lines):
+        for line in lines:
+            self.pedometer.on_gcode_sent(gcode_command_for_cmd(line), line)
+
+    def test_absolute_extrusion(self):
+        self.send("G92 E0", "G1 X10 Y10 E1.5", "G1 X20 E3", "G1 E2.2 F2400", "G1 E3 F2400", "G0 X0 Y0")
+
+        assert self.pedometer.spool_usage() == {"tool0": 3.0}
+
+    def test_relative_extrusion(self):
+        self.send("M83", "G1 X10 E1.5", "G1 X20 E1.5", "G1 E-.8", "G1 E.8")
+
+        assert self.pedometer.spool_usage() == {"tool0": 3.0}
+        assert self.pedometer.relative_extrusion
+
+    def test_mode_switches(self):
+        self.send("G91", "G1 E5", "G90", "G1 E7", "M83", "G1 E1", "M82", "G1 E10")
+
+        assert self.pedometer.spool_usage() == {"tool0": 10.0}
+        assert not self.pedometer.relative_extrusion
+
+    def test_g92_resets(self):
+        self.send("G1 E100", "G92 E0", "G1 E10", "G92 E5", "G1 E6", "G1 X1 Y1 Z1 E8", "G92", "G1 E1")
+
+        assert self.pedometer.spool_usage() == {"tool0": 114.0}
+
+    def test_ignores_non_extruding_lines(self):
+        self.send("G28", "G1 X10 Y10 Z0.2 F3000", "M104 S210", "M117 Extruding E10", "G1 X10 F1200")
+
+        assert self.pedometer.spool_usage() == {}
+
+    def test_tool_changes_attribute_spools(self):
+        self.pedometer.spool_ids = {1: "petg-blue"}
+        self.send("M83", "G1 E5", "T1", "G1 E3", "T0", "G1 E1")
+
+        assert self.pedometer.spool_usage() == {"tool0": 6.0, "petg-blue": 3.0}
+        assert self.pedometer.tool == 0
+
+    def test_job_usage(self):
+        self.send("M83", "G1 E5")
+        self.pedometer.start_job("job-1")
+        self.send("G1 E10", "G1 E2.5")
+
+        assert self.pedometer.usage()["job"] == dict(job_id="job-1", extruded_mm=12.5)
+        assert self.pedometer.finish_job() == dict(job_id="job-1", extruded_mm=12.5)
+        assert self.pedometer.finish_job() is None
+        assert self.pedometer.spool_usage() == {"tool0": 17.5}
+
+    def test_take_spool_usage(self):
+        self.pedometer.spool_ids = {1: "petg-blue"}
+        self.send("M83", "G1 E5", "T1", "G1 E3")
+        assert self.pedometer.take_spool_usage() == {"tool0": 5.0, "petg-blue": 3.0}
+
+        self.send("G1 E0.0004")
+        assert self.pedometer.take_spool_usage() == {}
+        self.send("G1 E2")
+        assert self.pedometer.take_spool_usage() == {"petg-blue": 2.0004}
+        assert self.pedometer.spool_usage() == {"tool0": 5.0, "petg-blue": 5.0}
+
+
+class TestPluginPedometer(unittest.TestCase):
+    @classmethod
+    def setUp(cls):
+        cls.plugin = OctoFarmCompanionPlugin()
+        cls.plugin._settings = mock.MagicMock()
+        cls.plugin._settings.get = lambda accessor: ["pla-red", None, "petg-blue"]
+        cls.plugin._logger = mock.MagicMock()
+
+    def test_gcode_hook_and_events(self):
+        self.plugin._apply_spool_ids()
+        self.plugin.on_event(Events.PRINT_STARTED, dict(name="cube.gcode"))
+        self.plugin.gcode_sent_hook(None, "sent", "M83", None, "M83")
+        self.plugin.gcode_sent_hook(None, "sent", "G1 X1 E4", None, "G1")
+        self.plugin.gcode_sent_hook(None, "sent", "T2", None, "T")
+        self.plugin.gcode_sent_hook(None, "sent", "G1 X1 E1", None, "G1")
+
+        usage = self.plugin.get_filament_usage()
+        assert usage["spools"] == {"pla-red": 4.0, "petg-blue": 1.0}
+        assert usage["job"]["extruded_mm"] == 5.0
+
+        self.plugin.on_event(Events.PRINT_DONE, dict(name="cube.gcode"))
+        assert self.plugin.get_filament_usage()["job"] is None
+        assert self.plugin._logger.info.called
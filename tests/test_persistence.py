@@ -0,0 +1,122 @@
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import unittest.mock as mock
+
+from octofarm_companion import OctoFarmCompanionPlugin
+from octofarm_companion.constants import Config, Keys
+from octofarm_companion.persistence import JsonFileStore, atomic_write
+
+
+class TestJsonFileStore(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, "data.json")
+        self.store = JsonFileStore(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def write_raw(self, path, text):
+        with io.open(path, "w", encoding="utf-8") as f:
+            f.write(text)
+
+    def test_missing_file(self):
+        assert self.store.load() is None
+
+    def test_save_and_load(self):
+        self.store.save({"persistence_uuid": "a"})
+
+        assert JsonFileStore(self.path).load() == {"persistence_uuid": "a"}
+        assert not os.path.exists(self.path + ".tmp")
+
+    def test_keeps_previous_generation(self):
+        self.store.save({"generation": 1})
+        self.store.save({"generation": 2})
+
+        with io.open(self.store.backup_path, "r", encoding="utf-8") as f:
+            assert json.load(f) == {"generation": 1}
+        assert JsonFileStore(self.path).load() == {"generation": 2}
+
+    def test_recovers_corrupt_file_from_previous_generation(self):
+        self.store.save({"generation": 1})
+        self.store.save({"generation": 2})
+        # Torn write of the old in-place writer
+        self.write_raw(self.path, '{"generati')
+
+        store = JsonFileStore(self.path)
+        assert store.load() == {"generation": 1}
+        # The restored generation is written back, a later load reads it directly
+        assert JsonFileStore(self.path).load() == {"generation": 1}
+
+    def test_recovers_after_crash_between_renames(self):
+        self.store.save({"generation": 1})
+        self.store.save({"generation": 2})
+        os.remove(self.path)
+
+        assert JsonFileStore(self.path).load() == {"generation": 1}
+        assert os.path.exists(self.path)
+
+    def test_corrupt_file_without_previous_generation(self):
+        self.write_raw(self.path, "not json")
+
+        with self.assertRaises(ValueError):
+            self.store.load()
+
+    def test_cached_load_only_stats(self):
+        self.store.save({"persistence_uuid": "a"})
+
+        with mock.patch("octofarm_companion.persistence.io.open") as mocked_open:
+            assert self.store.load() == {"persistence_uuid": "a"}
+            assert self.store.load() == {"persistence_uuid": "a"}
+        mocked_open.assert_not_called()
+
+    def test_reloads_changed_file(self):
+        self.store.save({"persistence_uuid": "a"})
+        self.store.load()
+
+        self.write_raw(self.path, json.dumps({"persistence_uuid": "changed"}))
+        stat = os.stat(self.path)
+        os.utime(self.path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000))
+
+        assert self.store.load() == {"persistence_uuid": "changed"}
+
+    def test_atomic_write_leaves_old_file_on_failure(self):
+        atomic_write(self.path, b"old")
+
+        with mock.patch("octofarm_companion.persistence.os.fsync", side_effect=OSError("disk full")):
+            with self.assertRaises(OSError):
+                atomic_write(self.path, b"new")
+
+        with io.open(self.path, "rb") as f:
+            assert f.read() == b"old"
+
+
+class TestPluginPersistence(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.plugin = OctoFarmCompanionPlugin()
+        self.plugin._logger = mock.Mock()
+        self.plugin._data_folder = self.folder
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_keeps_persistence_uuid_after_torn_write(self):
+        self.plugin._fetch_persisted_data()
+        persistence_uuid = self.plugin._persisted_data[Keys.persistence_uuid_key]
+        data_path = os.path.join(self.folder, Config.persisted_data_file)
+        self.plugin._write_new_access_token(data_path, {"access_token": "token", "expires_in": 3600})
+
+        with io.open(data_path, "w", encoding="utf-8") as f:
+            f.write('{"persistence_uu')
+
+        plugin = OctoFarmCompanionPlugin()
+        plugin._logger = mock.Mock()
+        plugin._data_folder = self.folder
+        plugin._fetch_persisted_data()
+
+        assert plugin._persisted_data[Keys.persistence_uuid_key] == persistence_uuid
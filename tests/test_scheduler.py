@@ -0,0 +1,108 @@
+import random
+import unittest
+import unittest.mock as mock
+
+from octofarm_companion.scheduler import BackoffScheduler
+from tests.utils import FakeClock
+
+
+class FakeWait:
+    """Advances the fake clock instead of sleeping, stopping the scheduler after 'runs' waits."""
+
+    def __init__(self, clock, runs):
+        self.clock = clock
+        self.runs = runs
+        self.delays = []
+
+    def __call__(self, delay):
+        self.delays.append(delay)
+        self.clock.now += delay
+        return len(self.delays) > self.runs
+
+
+class TestBackoffScheduler(unittest.TestCase):
+    @classmethod
+    def setUp(cls):
+        cls.clock = FakeClock()
+        cls.task = mock.MagicMock(return_value=True)
+
+    def create_scheduler(self, wait=None, seed=42):
+        return BackoffScheduler(self.task, 120, base_delay=5, max_delay=300, initial_delay_max=30,
+                                clock=self.clock, wait=wait, rng=random.Random(seed))
+
+    def test_initial_delay_is_spread(self):
+        delays = {self.create_scheduler(seed=seed).initial_delay() for seed in range(20)}
+
+        assert len(delays) == 20
+        assert all(0 <= delay <= 30 for delay in delays)
+
+    def test_success_keeps_interval(self):
+        scheduler = self.create_scheduler()
+
+        assert scheduler.run_once() == 120
+        assert scheduler.next_run_at == self.clock.now + 120
+        assert scheduler.failures == 0
+
+    def test_failures_back_off_with_jitter_and_cap(self):
+        self.task.return_value = False
+        scheduler = self.create_scheduler()
+
+        delays = [scheduler.run_once() for i in range(30)]
+
+        assert scheduler.failures == 30
+        assert all(5 <= delay <= 300 for delay in delays)
+        assert delays[0] <= 15
+
+    def test_failures_back_off_exponentially(self):
+        self.task.return_value = False
+        upper_bound_rng = mock.MagicMock()
+        upper_bound_rng.uniform = lambda low, high: high
+        scheduler = BackoffScheduler(self.task, 120, base_delay=5, max_delay=300, rng=upper_bound_rng)
+
+        assert [scheduler.run_once() for i in range(5)] == [15, 45, 135, 300, 300]
+
+    def test_exceptions_count_as_failure(self):
+        self.task.side_effect = Exception("OctoFarm down")
+        scheduler = self.create_scheduler()
+
+        assert scheduler.run_once() < 120
+        assert scheduler.failures == 1
+
+    def test_success_resets_backoff(self):
+        self.task.return_value = False
+        scheduler = self.create_scheduler()
+        for i in range(10):
+            scheduler.run_once()
+
+        self.task.return_value = True
+        assert scheduler.run_once() == 120
+        assert scheduler.failures == 0
+
+        self.task.return_value = False
+        assert scheduler.run_once() <= 15
+
+    def test_jitter_decorrelates_farm(self):
+        self.task.return_value = False
+        schedulers = [self.create_scheduler(seed=seed) for seed in range(10)]
+
+        delays = {round(scheduler.run_once(), 3) for scheduler in schedulers}
+
+        assert len(delays) == 10
+
+    def test_run_with_injected_clock(self):
+        wait = FakeWait(self.clock, runs=3)
+        scheduler = self.create_scheduler(wait=wait)
+
+        scheduler.run()
+
+        assert self.task.call_count == 3
+        assert wait.delays[0] <= 30
+        assert wait.delays[1:] == [120, 120, 120]
+
+    def test_start_stop(self):
+        scheduler = BackoffScheduler(self.task, 120, initial_delay_max=0)
+        scheduler.start()
+        assert scheduler.is_running()
+
+        scheduler.stop()
+        assert not scheduler.is_running()
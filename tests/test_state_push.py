@@ -0,0 +1,170 @@
+import threading
+import time
+import unittest
+import unittest.mock as mock
+
+from octoprint.events import Events
+
+from octofarm_companion.state_push import StatePublisher
+from octofarm_companion.tunnel import TunnelClient
+from tests.stub_octoprint import StubOctoPrintServer
+from tests.stub_tunnel import StubTunnelServer
+from tests.utils import FakeClock, mock_plugin
+
+
+class TestStatePublisher(unittest.TestCase):
+    def setUp(self):
+        self.send = mock.MagicMock(return_value=True)
+        self.publisher = StatePublisher(self.send, wall_clock=FakeClock(1600000000.0))
+
+    def sent(self, message):
+        return self.send.call_args_list[message][0][0]
+
+    def test_first_message_carries_the_full_state(self):
+        assert not self.publisher.publish_pending()
+
+        self.publisher.update("state", "OPERATIONAL")
+        self.publisher.update("connection", "connected")
+        assert self.publisher.publish_pending()
+        assert self.sent(0) == dict(type="state", timestamp=1600000000.0, full=True,
+                                    state=dict(state="OPERATIONAL", connection="connected"))
+
+        self.publisher.update("state", "PRINTING")
+        assert self.publisher.publish_pending()
+        assert self.sent(1)["full"] is False
+        assert self.sent(1)["state"] == dict(state="PRINTING")
+
+    def test_changes_are_coalesced_per_key(self):
+        self.publisher.publish_pending()
+        for progress in range(0, 100, 5):
+            self.publisher.update("progress", progress)
+        self.publisher.update("state", "PRINTING")
+
+        assert self.publisher.publish_pending()
+        assert self.send.call_count == 1
+        assert self.sent(0)["state"] == dict(progress=95, state="PRINTING")
+        assert self.publisher.stats()["coalesced"] == 19
+
+    def test_unchanged_values_are_not_sent(self):
+        self.publisher.update("state", "PRINTING")
+        self.publisher.publish_pending()
+        self.publisher.update("state", "PRINTING")
+
+        assert not self.publisher.publish_pending()
+        assert self.publisher.stats()["updates"] == 1
+
+    def test_failed_message_is_retried_with_newer_values(self):
+        self.publisher.update("state", "PRINTING")
+        self.publisher.publish_pending()
+        self.send.return_value = False
+        self.publisher.update("state", "PAUSED")
+        self.publisher.update("progress", 40)
+        assert not self.publisher.publish_pending()
+
+        self.send.return_value = True
+        self.publisher.update("progress", 45)
+        assert self.publisher.publish_pending()
+        assert self.sent(2)["state"] == dict(state="PAUSED", progress=45)
+        assert self.publisher.stats()["failed"] == 1
+
+    def test_resync_sends_the_full_state(self):
+        self.publisher.update("state", "PRINTING")
+        self.publisher.update("progress", 10)
+        self.publisher.publish_pending()
+        self.publisher.resync()
+
+        assert self.publisher.publish_pending()
+        assert self.sent(1)["full"] is True
+        assert self.sent(1)["state"] == dict(state="PRINTING", progress=10)
+
+    def test_messages_are_rate_limited(self):
+        publisher = StatePublisher(self.send, rate=10)
+        publisher.start()
+        try:
+            started = time.monotonic()
+            while time.monotonic() - started < 0.5:
+                publisher.update("progress", time.monotonic())
+                time.sleep(0.001)
+            time.sleep(0.15)
+        finally:
+            publisher.stop()
+
+        stats = publisher.stats()
+        # A token per 100ms over half a second, plus the initial burst
+        assert 3 <= self.send.call_count <= 7
+        assert stats["updates"] > 50
+        assert stats["pending"] == 0
+
+
+class TestPluginStatePush(unittest.TestCase):
+    def setUp(self):
+        self.plugin = mock_plugin()
+
+    def test_events_map_to_state(self):
+        self.plugin.on_event(Events.CONNECTED, dict(port="/dev/ttyACM0", baudrate=115200))
+        self.plugin.on_event(Events.PRINTER_STATE_CHANGED, dict(state_id="PRINTING", state_string="Printing"))
+        self.plugin.on_event(Events.PRINT_STARTED, dict(name="cube.gcode", origin="local"))
+        for progress in range(0, 38):
+            self.plugin.on_print_progress("local", "cube.gcode", progress)
+        self.plugin.on_event(Events.ERROR, dict(error="Thermal runaway"))
+
+        assert self.plugin._state_publisher.state() == dict(
+            connection="connected",
+            state="PRINTING",
+            job=dict(event="started", name="cube.gcode", origin="local"),
+            progress=35,
+            error="Thermal runaway"
+        )
+
+    def test_new_job_clears_the_error(self):
+        self.plugin.on_event(Events.ERROR, dict(error="Thermal runaway"))
+        self.plugin.on_event(Events.PRINT_STARTED, dict(name="cube.gcode", origin="local"))
+
+        assert self.plugin._state_publisher.state()["error"] is None
+
+    def test_nothing_is_pushed_without_tunnel(self):
+        self.plugin.on_event(Events.CONNECTED, None)
+
+        assert not self.plugin._state_publisher.publish_pending()
+        assert self.plugin._state_publisher.stats()["pending"] == 1
+
+
+class TestStatePushOverTunnel(unittest.TestCase):
+    def test_state_reaches_octofarm_and_resyncs_on_new_session(self):
+        octoprint = StubOctoPrintServer().start()
+        farm = StubTunnelServer().start()
+        publisher = StatePublisher(None, rate=100)
+        client = TunnelClient(lambda: (farm.url, {}), octoprint.base_url, reconnect_secs=0.05,
+                              on_session=publisher.resync)
+        publisher._send = client.push_state
+        publisher.update("state", "OPERATIONAL")
+        publisher.start()
+        client.start()
+        try:
+            assert self.wait_for(lambda: farm.states)
+            assert farm.states[0]["full"] is True
+            assert farm.states[0]["state"] == dict(state="OPERATIONAL")
+
+            publisher.update("state", "PRINTING")
+            assert self.wait_for(lambda: len(farm.states) == 2)
+            assert farm.states[1]["state"] == dict(state="PRINTING")
+
+            # OctoFarm restarted and lost the session, it gets the full state again
+            farm.session.reset("forgotten")
+            farm.drop_connection()
+            assert self.wait_for(lambda: len(farm.states) == 3)
+            assert farm.states[2] == dict(farm.states[2], full=True, state=dict(state="PRINTING"))
+        finally:
+            publisher.stop()
+            client.stop()
+            farm.stop()
+            octoprint.stop()
+
+    @staticmethod
+    def wait_for(predicate, timeout=5):
+        waited = threading.Event()
+        for i in range(int(timeout * 100)):
+            if predicate():
+                return True
+            waited.wait(0.01)
+        return False
@@ -0,0 +1,91 @@
+import logging
+import shutil
+import tempfile
+import unittest
+import unittest.mock as mock
+
+from benchmarks.load import create_plugin, run_load
+from octofarm_companion.constants import State
+from octofarm_companion.scheduler import BackoffScheduler
+from tests.stub_octofarm import StubOctoFarmServer
+
+
+class TestPluginAgainstStub(unittest.TestCase):
+    """Runs the companion over real HTTP against the stub OctoFarm instead of patched requests"""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.server = StubOctoFarmServer().start()
+        self.plugin = create_plugin(0, self.server.base_url, self.folder, max_silence=0,
+                                    logger=logging.getLogger("octofarm_companion.test"))
+        self.target = self.plugin._get_targets()[0]
+
+    def tearDown(self):
+        self.plugin.on_shutdown()
+        self.server.stop()
+        shutil.rmtree(self.folder)
+
+    def test_announce_and_heartbeat(self):
+        assert self.plugin._run_periodic_check()
+        assert self.plugin._run_periodic_check()
+
+        assert self.server.requests == {"/oidc/token": 1, "/octoprint/announce": 1, "/octoprint/heartbeat": 1}
+        assert self.target.state == State.SLEEP
+
+    def test_expired_token_is_replaced(self):
+        self.plugin._run_periodic_check()
+        self.server.expire_tokens()
+
+        # OctoFarm rejects the token, the announcement is repeated with a new token on the next check
+        self.plugin._run_periodic_check()
+        assert self.target.token_manager.access_token is None
+        self.plugin._run_periodic_check()
+
+        assert self.server.requests["/oidc/token"] == 2
+        assert self.server.requests["/octoprint/announce"] == 2
+        assert self.target.announcement_tracker.stats()["sent"] == 2
+
+    def test_injected_errors_force_full_announcement(self):
+        self.plugin._run_periodic_check()
+        self.server.error_rate = 1.0
+
+        self.plugin._run_periodic_check()
+
+        # A POST is not retried on a 503, OctoFarm may have processed it
+        assert self.server.requests["/octoprint/heartbeat"] == 1
+        assert self.target.announcement_tracker.stats()["fingerprint"] is None
+
+    def test_server_errors_back_off(self):
+        upper_bound_rng = mock.MagicMock()
+        upper_bound_rng.uniform = lambda low, high: high
+        scheduler = BackoffScheduler(self.plugin._run_periodic_check, 120, base_delay=5, max_delay=300,
+                                     rng=upper_bound_rng)
+        assert scheduler.run_once() == 120
+        self.server.error_rate = 1.0
+
+        # OctoFarm restarting behind a proxy answers 503, the companion backs off instead of pinging every interval
+        with mock.patch.object(self.plugin, "_replay_outbox") as replay:
+            assert [scheduler.run_once() for i in range(3)] == [15, 45, 135]
+        assert self.target.state == State.RETRY
+        replay.assert_not_called()
+
+    def test_injected_latency_hits_deadline(self):
+        self.plugin._network.deadline = 0.2
+        self.server.latency = 0.5
+
+        assert not self.plugin._run_periodic_check()
+        assert self.target.state == State.CRASHED
+
+
+class TestLoadHarness(unittest.TestCase):
+    def test_report(self):
+        report = run_load(instances=3, rounds=2, concurrency=3)
+
+        assert report["checks"] == 6
+        assert report["failed_checks"] == 0
+        # Token and announce calls use separate keep-alive pools per instance, reused every round
+        assert report["connections"] == 6
+        assert report["latency"]["oidc/token"]["count"] == 3
+        assert report["latency"]["octoprint/announce"]["count"] == 3
+        assert report["latency"]["octoprint/heartbeat"]["count"] == 3
+        assert report["latency"]["octoprint/heartbeat"]["p99"] >= report["latency"]["octoprint/heartbeat"]["p50"]
@@ -0,0 +1,127 @@
+import json
+import time
+import unittest
+import unittest.mock as mock
+
+import requests
+
+from octofarm_companion import OctoFarmCompanionPlugin
+from octofarm_companion.constants import Config, Keys, State
+from tests.utils import create_fake_at, mock_plugin
+
+targets = [
+    {"name": "production", "host": "https://production.farm", "port": 443, "oidc_client_id": "production-id",
+     "oidc_client_secret": "production-secret"},
+    {"name": "staging", "host": "https://staging.farm", "port": 443, "oidc_client_id": "staging-id",
+     "oidc_client_secret": "staging-secret"},
+]
+
+
+class MockResponse:
+    def __init__(self, status_code, text):
+        self.status_code = status_code
+        self.text = text
+
+
+class TestOctoFarmTargets(unittest.TestCase):
+    def setUp(self):
+        self.targets = [dict(target) for target in targets]
+        self.plugin = mock_plugin("test_data/targets", self.settings_get)
+        self.plugin._get_device_uuid = lambda: "device-uuid"
+        self.plugin._persisted_data[Keys.persistence_uuid_key] = "persistence-uuid"
+
+    def tearDown(self):
+        self.plugin.on_shutdown()
+
+    def settings_get(self, accessor):
+        if accessor[0] == "octofarm_targets":
+            return self.targets
+        return None
+
+    @staticmethod
+    def mocked_requests_post(url, **kwargs):
+        if "staging" in url:
+            time.sleep(0.3)
+            raise requests.exceptions.ConnectionError()
+        if url.endswith("oidc/token"):
+            return MockResponse(200, json.dumps({"access_token": create_fake_at(), "expires_in": 600}))
+        return MockResponse(200, "{}")
+
+    def test_targets_from_settings(self):
+        production, staging = self.plugin._get_targets()
+
+        assert production.name == "production" and production.primary
+        assert production.base_url == "https://production.farm:443"
+        assert staging.oidc_client_id == "staging-id" and not staging.primary
+        # Unchanged targets keep their token and state
+        assert self.plugin._get_targets()[1] is staging
+
+    def test_changed_target_is_recreated(self):
+        production, staging = self.plugin._get_targets()
+        self.targets[1]["oidc_client_secret"] = "rotated-secret"
+
+        assert self.plugin._get_targets()[0] is production
+        assert self.plugin._get_targets()[1] is not staging
+
+    def test_legacy_single_target(self):
+        self.targets = []
+        target, = self.plugin._get_targets()
+
+        assert target.name == Config.default_target_name
+        assert target.base_url is None
+
+    def test_duplicate_names_are_ignored(self):
+        self.targets.append(dict(self.targets[0]))
+
+        assert len(self.plugin._get_targets()) == 2
+
+    @mock.patch('requests.Session.post', side_effect=mocked_requests_post)
+    def test_fan_out_is_concurrent(self, mock_post):
+        self.targets.append(dict(self.targets[1], name="staging2"))
+
+        started_at = time.monotonic()
+        assert self.plugin._run_periodic_check()
+        duration = time.monotonic() - started_at
+
+        # Both staging servers time out in parallel, production is announced meanwhile
+        assert duration < 0.55
+        production, staging, staging2 = self.plugin._get_targets()
+        assert production.state == State.SLEEP
+        assert staging.state == State.CRASHED and staging2.state == State.CRASHED
+        stats = self.plugin.get_announcement_stats()
+        assert stats["production"]["sent"] == 1
+        assert stats["staging"]["sent"] == 0
+
+    @mock.patch('requests.Session.post', side_effect=mocked_requests_post)
+    def test_backs_off_when_all_targets_fail(self, mock_post):
+        self.targets = self.targets[1:]
+
+        assert not self.plugin._run_periodic_check()
+
+    def test_tokens_persisted_per_target(self):
+        production, staging = self.plugin._get_targets()
+        production.token_manager.update(dict(access_token="production-token", expires_in=600))
+        staging.token_manager.update(dict(access_token="staging-token", expires_in=600))
+
+        persisted_targets = self.plugin._persisted_data[Keys.targets_key]
+        assert persisted_targets["production"]["access_token"] == "production-token"
+        assert persisted_targets["staging"]["access_token"] == "staging-token"
+        assert "access_token" not in self.plugin._persisted_data
+
+        # A restart restores each token for its own target
+        plugin = OctoFarmCompanionPlugin()
+        plugin._settings = self.plugin._settings
+        plugin._persisted_data = self.plugin._persisted_data
+        restored_production, restored_staging = plugin._get_targets()
+        assert restored_production.token_manager.access_token == "production-token"
+        assert restored_staging.token_manager.access_token == "staging-token"
+        plugin.on_shutdown()
+
+    @mock.patch('requests.Session.post')
+    def test_telemetry_goes_to_primary_target(self, mock_post):
+        mock_post.return_value = MockResponse(200, "{}")
+        production, staging = self.plugin._get_targets()
+        production.token_manager.update(dict(access_token=create_fake_at(), expires_in=600))
+
+        assert self.plugin._send_telemetry_batch([{"type": "job", "data": {}}])
+        assert mock_post.call_args[0][0] == "https://production.farm:443/octoprint/telemetry"
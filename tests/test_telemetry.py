@@ -0,0 +1,139 @@
+import gzip
+import json
+import unittest
+import unittest.mock as mock
+
+from octoprint.events import Events
+
+from octofarm_companion.telemetry import TelemetryUplink, compress_batch
+from tests.utils import FakeClock, create_fake_at, mock_plugin
+
+
+class TestTelemetryUplink(unittest.TestCase):
+    @classmethod
+    def setUp(cls):
+        cls.clock = FakeClock()
+        cls.send = mock.MagicMock(return_value=True)
+        cls.uplink = TelemetryUplink(cls.send, capacity=5, batch_size=3, max_age=10,
+                                     clock=cls.clock, wall_clock=FakeClock(1600000000.0))
+
+    def sent(self, batch):
+        return self.send.call_args_list[batch][0][0]
+
+    def test_flush_on_batch_size(self):
+        self.uplink.emit("job", {"n": 1})
+        self.uplink.emit("job", {"n": 2})
+        assert not self.uplink.flush()
+
+        self.uplink.emit("job", {"n": 3})
+        assert self.uplink.flush()
+        assert [event["data"]["n"] for event in self.sent(0)] == [1, 2, 3]
+        assert self.uplink.pending() == 0
+
+    def test_flush_on_age(self):
+        self.uplink.emit("job", {"n": 1})
+        self.clock.now += 9
+        assert not self.uplink.flush()
+
+        self.clock.now += 1
+        assert self.uplink.flush()
+        assert self.sent(0)[0]["timestamp"] == 1600000000.0
+
+    def test_coalesce_keyed_events(self):
+        self.uplink.emit("printerState", {"state": "OPERATIONAL"}, key="printerState")
+        self.uplink.emit("printerState", {"state": "PRINTING"}, key="printerState")
+
+        assert self.uplink.pending() == 1
+        assert self.uplink.flush(force=True)
+        assert self.sent(0)[0]["data"]["state"] == "PRINTING"
+        assert self.uplink.stats()["coalesced"] == 1
+
+    def test_overflow_drops_oldest(self):
+        for n in range(7):
+            self.uplink.emit("job", {"n": n})
+
+        stats = self.uplink.stats()
+        assert stats["dropped"] == 2
+        assert stats["pending"] == 5
+        assert [event["data"]["n"] for event in self.uplink.drain()] == [2, 3, 4, 5, 6]
+
+    def test_failed_batch_is_requeued_and_held_off(self):
+        self.send.return_value = False
+        for n in range(4):
+            self.uplink.emit("job", {"n": n})
+
+        assert not self.uplink.flush()
+        assert self.uplink.pending() == 4
+        # Nothing is retried before the hold-off expired
+        assert not self.uplink.flush()
+        assert self.send.call_count == 1
+
+        self.send.return_value = True
+        self.clock.now += 10
+        assert self.uplink.flush()
+        assert [event["data"]["n"] for event in self.sent(1)] == [0, 1, 2]
+        assert self.uplink.stats()["failed_batches"] == 1
+
+    def test_send_exception_is_failure(self):
+        uplink = TelemetryUplink(mock.MagicMock(side_effect=Exception("down")), batch_size=1)
+        uplink.emit("job", {})
+
+        assert not uplink.flush()
+        assert uplink.pending() == 1
+
+    def test_compress_batch(self):
+        document = {"events": [{"type": "job", "data": {"n": n}} for n in range(100)]}
+        body = compress_batch(document)
+
+        assert json.loads(gzip.decompress(body)) == document
+        assert len(body) < len(json.dumps(document)) / 5
+
+
+class TestPluginTelemetry(unittest.TestCase):
+    @classmethod
+    def setUp(cls):
+        cls.plugin = mock_plugin("test_data/telemetry")
+        cls.plugin._persisted_data["persistence_uuid"] = "persistence-uuid"
+        cls.plugin._get_device_uuid = lambda: "device-uuid"
+
+    def tearDown(self):
+        self.plugin.on_shutdown()
+
+    def test_events_are_queued(self):
+        self.plugin.on_event(Events.PRINTER_STATE_CHANGED, dict(state_id="OPERATIONAL"))
+        self.plugin.on_event(Events.PRINT_STARTED, dict(name="cube.gcode", origin="local"))
+        self.plugin.on_event(Events.PRINTER_STATE_CHANGED, dict(state_id="PRINTING"))
+        self.plugin.on_event(Events.PRINT_DONE, dict(name="cube.gcode", origin="local", time=10.5))
+
+        events = self.plugin._telemetry.drain()
+        assert [event["type"] for event in events] == ["printerState", "job", "job", "filament"]
+        assert events[0]["data"]["state"] == "PRINTING"
+        assert events[1]["data"]["jobId"] == events[3]["data"]["jobId"]
+
+    def test_send_without_token(self):
+        assert not self.plugin._send_telemetry_batch([{"type": "job"}])
+
+    @mock.patch('requests.Session.post')
+    def test_send_compressed_batch(self, mock_post):
+        mock_post.return_value = mock.MagicMock(status_code=200)
+        access_token = create_fake_at()
+        self.plugin._get_targets()[0].token_manager.update(dict(access_token=access_token, expires_in=600))
+
+        assert self.plugin._send_telemetry_batch([{"type": "job", "data": {}}])
+
+        url = mock_post.call_args[0][0]
+        kwargs = mock_post.call_args[1]
+        assert url == "https://farm123asdasdasdasd.net:443/octoprint/telemetry"
+        assert kwargs["headers"]["Authorization"] == "Bearer " + access_token
+        assert kwargs["headers"]["Content-Encoding"] == "gzip"
+        document = json.loads(gzip.decompress(kwargs["data"]))
+        assert document["deviceUuid"] == "device-uuid"
+        assert document["events"] == [{"type": "job", "data": {}}]
+
+    @mock.patch('requests.Session.post')
+    def test_send_unauthorized_invalidates_token(self, mock_post):
+        mock_post.return_value = mock.MagicMock(status_code=401)
+        self.plugin._get_targets()[0].token_manager.update(dict(access_token=create_fake_at(), expires_in=600))
+
+        assert not self.plugin._send_telemetry_batch([{"type": "job", "data": {}}])
+        assert self.plugin._get_targets()[0].token_manager.access_token is None
@@ -0,0 +1,89 @@
+import unittest
+import unittest.mock as mock
+
+from octofarm_companion.token_manager import AccessTokenManager
+from tests.utils import create_fake_at, FakeClock
+
+
+class TestAccessTokenManager(unittest.TestCase):
+    @classmethod
+    def setUp(cls):
+        cls.clock = FakeClock()
+        cls.wall_clock = FakeClock(1600000000.0)
+        cls.refresh = mock.MagicMock()
+        cls.persist = mock.MagicMock()
+        cls.manager = AccessTokenManager(cls.refresh, cls.persist, refresh_margin=60,
+                                         clock=cls.clock, wall_clock=cls.wall_clock)
+
+    def tearDown(self):
+        self.manager.shutdown()
+
+    def test_empty(self):
+        assert self.manager.access_token is None
+        assert self.manager.expires_in is None
+        assert self.manager.needs_refresh()
+
+    def test_update_tracks_monotonic_expiry(self):
+        token = create_fake_at()
+        self.manager.update(dict(access_token=token, expires_in=600))
+
+        assert self.manager.access_token == token
+        assert not self.manager.needs_refresh()
+
+        self.clock.now += 550
+        assert self.manager.access_token == token
+        assert self.manager.needs_refresh()
+
+        self.clock.now += 50
+        assert self.manager.access_token is None
+
+    def test_wall_clock_skew_is_ignored(self):
+        token = create_fake_at()
+        self.manager.update(dict(access_token=token, expires_in=600))
+        self.wall_clock.now += 100000
+
+        assert self.manager.access_token == token
+
+    def test_persists_only_changed_token(self):
+        token = create_fake_at()
+        assert self.manager.update(dict(access_token=token, expires_in=600))
+        assert not self.manager.update(dict(access_token=token, expires_in=600))
+        assert self.manager.update(dict(access_token=create_fake_at(), expires_in=600))
+
+        assert self.persist.call_count == 2
+
+    def test_persists_changed_expiry(self):
+        token = create_fake_at()
+        self.manager.update(dict(access_token=token, expires_in=600))
+        self.clock.now += 300
+
+        assert self.manager.update(dict(access_token=token, expires_in=600))
+        assert self.persist.call_count == 2
+
+    def test_load_persisted_token(self):
+        token = create_fake_at()
+        assert self.manager.load(dict(access_token=token, expires_in=600, requested_at=self.wall_clock.now - 100))
+        assert self.manager.access_token == token
+        assert self.manager.expires_in == 500
+
+        assert not self.manager.load(dict(access_token=token, expires_in=600,
+                                          requested_at=self.wall_clock.now - 700))
+        assert self.manager.access_token is None
+
+        assert not self.manager.load(dict())
+        self.persist.assert_not_called()
+
+    def test_invalidate(self):
+        self.manager.update(dict(access_token=create_fake_at(), expires_in=600))
+        self.manager.invalidate()
+
+        assert self.manager.access_token is None
+
+    @mock.patch('octofarm_companion.token_manager.Timer')
+    def test_refresh_scheduled_ahead_of_expiry(self, mock_timer):
+        self.manager.update(dict(access_token=create_fake_at(), expires_in=600))
+        mock_timer.assert_called_with(540, self.refresh)
+
+        # Short lived tokens are refreshed halfway
+        self.manager.update(dict(access_token=create_fake_at(), expires_in=100))
+        mock_timer.assert_called_with(50, self.refresh)
@@ -0,0 +1,217 @@
+import os
+import shutil
+import tempfile
+import unittest
+import unittest.mock as mock
+
+import flask
+import pytest
+from octoprint.server.util import corsRequestHandler
+
+import octofarm_companion
+from octofarm_companion.token_verifier import TokenVerifier, TokenVerificationError, has_scope
+from tests.utils import FakeClock, create_jwk, create_jwt, create_rsa_key, mock_settings_custom, mock_plugin
+
+key = create_rsa_key(seed=1)
+rotated_key = create_rsa_key(seed=2)
+now = 1700000000
+
+
+def claims(**overrides):
+    return dict(dict(iss="https://farm.example", aud="octoprint", sub="octofarm", exp=now + 300, iat=now,
+                     scope="companion:read companion:write"), **overrides)
+
+
+class TestTokenVerifier(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock(now)
+        self.jwks = dict(keys=[create_jwk(key, "key-1")])
+        self.fetch = mock.MagicMock(side_effect=lambda: self.jwks)
+        self.verifier = TokenVerifier(self.fetch, issuer="https://farm.example", audience="octoprint",
+                                      clock=self.clock)
+
+    def rejects(self, token, reason):
+        with pytest.raises(TokenVerificationError) as e:
+            self.verifier.verify(token)
+        assert str(e.value) == reason
+
+    def test_valid_token_is_verified_once(self):
+        token = create_jwt(key, claims(), "key-1")
+
+        assert self.verifier.verify(token)["sub"] == "octofarm"
+        assert self.verifier.verify(token)["sub"] == "octofarm"
+        assert self.fetch.call_count == 1
+        assert self.verifier.stats() == dict(verified=1, memoized=1, rejected=0, fetches=1, fetch_errors=0, keys=1,
+                                             memo=1)
+
+    def test_memoized_until_expiry(self):
+        token = create_jwt(key, claims(exp=now + 60), "key-1")
+        self.verifier.verify(token)
+        self.clock.now += 60 + self.verifier.leeway
+
+        self.rejects(token, octofarm_companion.Errors.token_expired)
+
+    def test_invalid_tokens(self):
+        header, payload, signature = create_jwt(key, claims(), "key-1").split(".")
+        other = create_jwt(key, claims(sub="admin"), "key-1").split(".")[1]
+        self.rejects(f"{header}.{other}.{signature}", octofarm_companion.Errors.token_signature_invalid)
+        self.rejects(create_jwt(rotated_key, claims(), "key-1"), octofarm_companion.Errors.token_signature_invalid)
+        self.rejects(create_jwt(key, claims(aud="other-printer"), "key-1"),
+                     octofarm_companion.Errors.token_audience_invalid)
+        self.rejects(create_jwt(key, claims(iss="https://evil.example"), "key-1"),
+                     octofarm_companion.Errors.token_issuer_invalid)
+        self.rejects(create_jwt(key, claims(exp=None), "key-1"), octofarm_companion.Errors.token_expired)
+        self.rejects(create_jwt(key, claims(nbf=now + 600), "key-1"), octofarm_companion.Errors.token_not_yet_valid)
+        self.rejects(create_jwt(key, claims(), "key-1", alg="none"),
+                     octofarm_companion.Errors.token_algorithm_unsupported)
+        self.rejects("a.b.c", octofarm_companion.Errors.token_malformed)
+
+    def test_audience_list(self):
+        assert self.verifier.verify(create_jwt(key, claims(aud=["octofarm", "octoprint"]), "key-1"))
+
+    def test_peer_grant_for_other_companions(self):
+        token = create_jwt(key, claims(aud=["seed"]), "key-1")
+
+        assert self.verifier.verify(token, check_audience=False)["aud"] == ["seed"]
+        # Not memoized for a check with the audience
+        self.rejects(token, octofarm_companion.Errors.token_audience_invalid)
+        with pytest.raises(TokenVerificationError):
+            self.verifier.verify(create_jwt(rotated_key, claims(aud=["seed"]), "key-1"), check_audience=False)
+
+    def test_rotated_key_is_fetched(self):
+        self.verifier.verify(create_jwt(key, claims(), "key-1"))
+        self.jwks = dict(keys=[create_jwk(key, "key-1"), create_jwk(rotated_key, "key-2")])
+        self.clock.now += self.verifier.min_refresh_interval
+
+        assert self.verifier.verify(create_jwt(rotated_key, claims(), "key-2"))
+        assert self.fetch.call_count == 2
+
+    def test_unknown_key_ids_are_rate_limited(self):
+        self.verifier.verify(create_jwt(key, claims(), "key-1"))
+        for i in range(5):
+            self.rejects(create_jwt(key, claims(jti=i), f"made-up-{i}"), octofarm_companion.Errors.token_key_unknown)
+
+        assert self.fetch.call_count == 1
+
+    def test_keys_survive_an_unreachable_octofarm(self):
+        self.verifier.verify(create_jwt(key, claims(), "key-1"))
+        self.fetch.side_effect = ConnectionError()
+        self.clock.now += self.verifier.ttl
+
+        assert self.verifier.verify(create_jwt(key, claims(exp=now + self.verifier.ttl + 60), "key-1"))
+        assert self.verifier.stats()["fetch_errors"] == 1
+
+    def test_withdrawn_key_clears_the_memo(self):
+        token = create_jwt(key, claims(), "key-1")
+        self.verifier.verify(token)
+        self.jwks = dict(keys=[create_jwk(rotated_key, "key-2")])
+        self.clock.now += self.verifier.min_refresh_interval
+        self.verifier.verify(create_jwt(rotated_key, claims(), "key-2"))
+
+        self.rejects(token, octofarm_companion.Errors.token_key_unknown)
+
+    def test_scopes(self):
+        assert has_scope(claims(), "companion:read")
+        assert not has_scope(claims(), "companion:files")
+        assert has_scope(claims(scope=None, scp=["companion:files"]), "companion:files")
+        assert not has_scope(claims(scope="companion:readonly"), "companion:read")
+
+    def test_memo_is_bounded(self):
+        self.verifier.memo_size = 3
+        for i in range(5):
+            self.verifier.verify(create_jwt(key, claims(jti=i), "key-1"))
+
+        assert self.verifier.stats()["memo"] == 3
+
+
+class TestPluginAuthorization(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.plugin = mock_plugin(self.folder, lambda path: "octoprint" if path == ["oidc_audience"] else
+                                  mock_settings_custom(path))
+        self.plugin._identifier = "octofarm_companion"
+        self.plugin._basefolder = os.path.dirname(octofarm_companion.__file__)
+        self.plugin.initialize()
+        self.plugin._token_verifier._clock = FakeClock(now)
+
+        app = flask.Flask(__name__)
+        blueprint = self.plugin.get_blueprint()
+        # Added by OctoPrint after the plugin's own hooks
+        blueprint.before_request(corsRequestHandler)
+        app.register_blueprint(blueprint, url_prefix="/plugin/octofarm_companion")
+        self.client = app.test_client()
+        self.jwks_response = mock.MagicMock(status_code=200)
+        self.jwks_response.json.return_value = dict(keys=[create_jwk(key, "key-1")])
+
+    def tearDown(self):
+        self.plugin.on_shutdown()
+        shutil.rmtree(self.folder)
+
+    def use_settings(self, **settings):
+        self.plugin._settings.get = lambda path: settings.get(path[0])
+        self.plugin._apply_token_settings()
+
+    def get(self, path, token=None, logged_in=False, settings=False, post=False):
+        headers = {"Authorization": f"Bearer {token}"} if token else {}
+        with mock.patch("requests.Session.get", return_value=self.jwks_response) as fetch, \
+                mock.patch("octoprint.server.util.requireLoginRequestHandler",
+                           return_value=None, side_effect=None if logged_in else lambda: flask.abort(403)), \
+                mock.patch("octoprint.access.permissions.Permissions") as permissions:
+            permissions.SETTINGS.can.return_value = settings
+            if post or path.startswith("/test_"):
+                response = self.client.post(f"/plugin/octofarm_companion{path}", data="{}", headers=headers)
+            else:
+                response = self.client.get(f"/plugin/octofarm_companion{path}", headers=headers)
+        self.fetches = fetch.call_count
+        return response
+
+    def test_octofarm_token_is_accepted(self):
+        response = self.get("/filament_usage", token=create_jwt(key, claims(), "key-1"))
+
+        assert response.status_code == 200
+        assert self.fetches == 1
+        assert self.get("/token_stats", token=create_jwt(key, claims(), "key-1")).json["memoized"] == 1
+        assert self.fetches == 0
+
+    def test_token_needs_the_scope_of_the_route(self):
+        assert self.get("/filament_usage", token=create_jwt(key, claims(scope=None), "key-1")).status_code == 403
+        # Writing files into OctoPrint's storage needs its own scope
+        assert self.get("/fetch_file", token=create_jwt(key, claims(), "key-1"), post=True).status_code == 403
+        assert self.get("/fetch_file", token=create_jwt(key, claims(scope="companion:files"), "key-1"),
+                        post=True).status_code == 400
+
+    def test_audience_defaults_to_the_client_id(self):
+        self.use_settings(oidc_client_id="printer-1")
+
+        assert self.get("/filament_usage", token=create_jwt(key, claims(aud="printer-1"), "key-1")).status_code == 200
+        assert self.get("/filament_usage", token=create_jwt(key, claims(aud="printer-2"), "key-1")).status_code == 401
+
+    def test_tokens_need_an_audience(self):
+        self.use_settings()
+
+        assert self.get("/filament_usage", token=create_jwt(key, claims(), "key-1")).status_code == 401
+        assert self.fetches == 0
+
+    def test_invalid_token_is_rejected(self):
+        response = self.get("/filament_usage", token=create_jwt(rotated_key, claims(), "key-1"))
+
+        assert response.status_code == 401
+
+    def test_cors_preflight_is_answered(self):
+        headers = {"Origin": "http://farm.example", "Access-Control-Request-Method": "GET"}
+        with mock.patch("octoprint.server.util.settings") as settings:
+            settings.return_value.getBoolean.return_value = True
+            response = self.client.options("/plugin/octofarm_companion/filament_usage", headers=headers)
+
+        assert response.status_code == 200
+        assert response.headers["Access-Control-Allow-Origin"] == "http://farm.example"
+
+    def test_octoprint_login_still_works(self):
+        assert self.get("/filament_usage", logged_in=True).status_code == 200
+        assert self.get("/filament_usage").status_code == 403
+
+    def test_settings_routes_need_the_settings_permission(self):
+        assert self.get("/test_octofarm_openid", token=create_jwt(key, claims(), "key-1")).status_code == 403
+        assert self.get("/test_octofarm_connection", logged_in=True).status_code == 403
+        # Passed on to the route, which rejects the missing url
+        assert self.get("/test_octofarm_connection", logged_in=True, settings=True).status_code == 400
@@ -0,0 +1,324 @@
+import queue
+import threading
+import unittest
+import unittest.mock as mock
+
+import pytest
+
+from octofarm_companion import OctoFarmCompanionPlugin
+from octofarm_companion.constants import Config, Keys
+from octofarm_companion.tunnel import TunnelClient, TunnelSession, TunnelStreamReset, TunnelTimeoutError, \
+    forwarded_headers
+from tests.stub_octoprint import StubOctoPrintServer
+from tests.stub_tunnel import StubTunnelServer
+from tests.utils import create_fake_at, mock_settings_get_int, mock_settings_global_get
+
+
+class Link:
+    """One direction of an in-memory connection, frames are delivered in order on a thread like a socket would"""
+
+    def __init__(self, receiver):
+        self.frames = queue.Queue()
+        self._receiver = receiver
+        threading.Thread(target=self._deliver, daemon=True).start()
+
+    def __call__(self, frame):
+        self.frames.put(frame)
+
+    def _deliver(self):
+        while True:
+            self._receiver(self.frames.get())
+            self.frames.task_done()
+
+
+class LinkedSessions:
+    def __init__(self, window=1024, max_frame=256, replay_limit=Config.tunnel_replay_buffer_bytes):
+        self.opened = []
+        self.farm = TunnelSession(window=window, max_frame=max_frame, replay_limit=replay_limit)
+        self.companion = TunnelSession(on_open=self.opened.append, window=window, max_frame=max_frame,
+                                       replay_limit=replay_limit)
+        self.farm.reset("session")
+        self.companion.reset("session")
+        self.to_companion = Link(self.companion.feed)
+        self.to_farm = Link(self.farm.feed)
+        self.farm.connect(self.to_companion, 0)
+        self.companion.connect(self.to_farm, 0)
+
+    def settle(self):
+        for i in range(3):
+            self.to_companion.frames.join()
+            self.to_farm.frames.join()
+
+    def open_stream(self, request):
+        stream = self.farm.open_stream(request)
+        self.settle()
+        return stream, self.opened[-1]
+
+
+class TestTunnelSession(unittest.TestCase):
+    def test_request_and_response(self):
+        link = LinkedSessions()
+        stream, local = link.open_stream(dict(method="GET", path="/api/version"))
+        stream.end()
+        assert local.request["path"] == "/api/version"
+        assert local.read(1) == b""
+
+        local.send_response(200, {"Content-Type": "application/json"})
+        local.write(b"{}")
+        local.end()
+        assert stream.wait_response(1)["status"] == 200
+        assert stream.read(1) == b"{}"
+        assert stream.read(1) == b""
+
+    def test_window_limits_data_in_flight(self):
+        link = LinkedSessions(window=1024, max_frame=256)
+        stream, local = link.open_stream(dict(method="POST", path="/api/echo", body=True))
+
+        stream.write(b"x" * 1024, timeout=0)
+        with pytest.raises(TunnelTimeoutError):
+            stream.write(b"x", timeout=0.05)
+        link.settle()
+        assert len(local._inbound) == 4
+
+        # Consuming half the window grants it back to the writer
+        local.read(0)
+        local.read(0)
+        link.settle()
+        stream.write(b"y" * 512, timeout=0)
+        with pytest.raises(TunnelTimeoutError):
+            stream.write(b"y", timeout=0.05)
+
+    def test_reset_fails_the_stream(self):
+        link = LinkedSessions()
+        stream, local = link.open_stream(dict(method="GET", path="/api/version"))
+        local.abort()
+
+        with pytest.raises(TunnelStreamReset):
+            stream.wait_response(1)
+        link.settle()
+        assert link.farm.stats()["open_streams"] == 0
+        assert link.companion.stats()["open_streams"] == 0
+
+    def test_unacknowledged_frames_are_retransmitted(self):
+        link = LinkedSessions()
+        stream, local = link.open_stream(dict(method="GET", path="/api/version"))
+
+        lost = []
+        link.companion.detach()
+        link.companion.connect(lost.append, 0)
+        local.send_response(200, {})
+        local.write(b"body")
+        local.end()
+        assert len(lost) == 3
+
+        # The reconnect replays what the farm side did not receive, duplicates are dropped
+        link.companion.connect(link.to_farm, link.farm.stats()["frames_received"], resumed=True)
+        link.companion.connect(link.to_farm, 0, resumed=True)
+        assert stream.wait_response(1)["status"] == 200
+        assert stream.read(1) == b"body"
+        assert stream.read(1) == b""
+        assert link.companion.stats()["resumed"] == 2
+
+    def test_acknowledged_frames_leave_the_replay_buffer(self):
+        link = LinkedSessions()
+        for i in range(Config.tunnel_ack_every * 2):
+            link.farm.open_stream(dict(method="GET", path="/api/version")).end()
+        link.settle()
+
+        assert link.farm.stats()["replay_bytes"] == 0
+
+    def test_overflowing_replay_buffer_is_not_resumable(self):
+        link = LinkedSessions(window=4096, replay_limit=1024)
+        stream, local = link.open_stream(dict(method="POST", path="/api/echo", body=True))
+        assert link.farm.resumable
+
+        stream.write(b"x" * 2048)
+        assert not link.farm.resumable
+        link.farm.reset("new-session")
+        assert link.farm.resumable
+
+    def test_forwarded_headers_drop_hop_by_hop_headers(self):
+        headers = forwarded_headers({"Connection": "keep-alive", "Transfer-Encoding": "chunked", "Host": "farm",
+                                     "Content-Length": "3", "X-Api-Key": "key", "Content-Type": "text/plain"})
+        assert headers == {"X-Api-Key": "key", "Content-Type": "text/plain"}
+
+
+class TestTunnelClient(unittest.TestCase):
+    def setUp(self):
+        self.octoprint = StubOctoPrintServer().start()
+        self.farm = StubTunnelServer(token="token").start()
+        self.connection = (self.farm.url, {"Authorization": "Bearer token"})
+        self.client = TunnelClient(lambda: self.connection, self.octoprint.base_url,
+                                   identity=dict(deviceUuid="device"), reconnect_secs=0.05, logger=mock.MagicMock())
+        self.client.start()
+        assert self.farm.wait_connected()
+
+    def tearDown(self):
+        self.client.stop()
+        self.farm.stop()
+        self.octoprint.stop()
+
+    def test_proxies_requests(self):
+        status, headers, body = self.farm.request("GET", "/api/version", headers={"X-Api-Key": "key"})
+
+        assert status == 200
+        assert headers["Content-Type"] == "application/json"
+        assert body == b'{"server": "1.9.0", "api": "0.1"}'
+        assert self.farm.hellos[0]["deviceUuid"] == "device"
+
+    def test_streams_large_bodies_both_ways(self):
+        status, headers, body = self.farm.request("GET", "/api/files/blob?size=3000000")
+        assert status == 200
+        assert body == self.octoprint.blob(3000000)
+
+        upload = self.octoprint.blob(1000000)
+        status, headers, body = self.farm.request("POST", "/api/echo", body=upload)
+        assert status == 200
+        assert body == upload
+
+    def test_concurrent_streams(self):
+        results = []
+
+        def download():
+            results.append(self.farm.request("GET", "/api/files/blob?size=500000")[2] == self.octoprint.blob(500000))
+
+        threads = [threading.Thread(target=download) for i in range(Config.default_tunnel_max_streams)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert results == [True] * Config.default_tunnel_max_streams
+        assert self.farm.connections == 1
+
+    def test_forbidden_path_is_not_forwarded(self):
+        status, headers, body = self.farm.request("GET", "/private")
+
+        assert status == 403
+        assert "/private" not in self.octoprint.requests
+
+    def test_resumes_after_a_dropped_connection(self):
+        result = dict()
+
+        def download():
+            result["response"] = self.farm.request("GET", "/api/files/blob?size=8000000", timeout=20)
+
+        thread = threading.Thread(target=download)
+        thread.start()
+        while self.farm.session.stats()["frames_received"] < 20:
+            threading.Event().wait(0.005)
+        self.farm.drop_connection()
+        thread.join()
+
+        status, headers, body = result["response"]
+        assert status == 200
+        assert body == self.octoprint.blob(8000000)
+        assert self.farm.connections == 2
+        assert self.farm.session.stats()["resumed"] == 1
+        assert self.octoprint.requests["/api/files/blob"] == 1
+
+    def test_new_session_when_the_farm_forgot_it(self):
+        session_id = self.farm.session.session_id
+        self.farm.session.reset("forgotten")
+        self.farm.drop_connection()
+        assert self.farm.wait_connected()
+        while self.farm.connections < 2 or not self.farm.session.connected:
+            threading.Event().wait(0.005)
+
+        assert self.farm.session.session_id not in (session_id, "forgotten")
+        assert self.farm.request("GET", "/api/version")[0] == 200
+        assert self.client.session.session_id == self.farm.session.session_id
+
+    def test_without_connection_backs_off(self):
+        self.connection = None
+
+        assert self.client.serve_once() is False
+
+    def test_rejected_handshake_backs_off(self):
+        self.connection = (self.farm.url, {"Authorization": "Bearer wrong"})
+
+        assert self.client.serve_once() is False
+
+
+class TestPluginTunnel(unittest.TestCase):
+    def setUp(self):
+        self.plugin = OctoFarmCompanionPlugin()
+        self.plugin._settings = mock.MagicMock()
+        self.plugin._settings.get = self.settings_get
+        self.plugin._settings.global_get = mock_settings_global_get
+        self.plugin._settings.get_int = mock_settings_get_int
+        self.plugin._logger = mock.MagicMock()
+        self.plugin._get_device_uuid = lambda: "device-uuid"
+        self.plugin._write_persisted_data = lambda *args: None
+        self.plugin._data_folder = "test_data/tunnel"
+        self.plugin._persisted_data[Keys.persistence_uuid_key] = "persistence-uuid"
+        self.tunnel_enabled = True
+        self.host = "https://farm.example"
+
+    def tearDown(self):
+        self.plugin.on_shutdown()
+
+    def settings_get(self, accessor):
+        if accessor[0] == "tunnel_enabled":
+            return self.tunnel_enabled
+        if accessor[0] == "octofarm_host":
+            return self.host
+        if accessor[0] == "octofarm_port":
+            return 443
+        if accessor[0] == "octofarm_targets":
+            return []
+        return None
+
+    def test_connection_needs_an_access_token(self):
+        assert self.plugin._get_tunnel_connection() is None
+
+        target = self.plugin._get_targets()[0]
+        target.token_manager.update(dict(access_token=create_fake_at(), expires_in=3600))
+        url, headers = self.plugin._get_tunnel_connection()
+
+        assert url == "wss://farm.example:443/octoprint/tunnel"
+        assert headers == {"Authorization": "Bearer " + target.token_manager.access_token}
+
+    def test_plain_http_uses_ws(self):
+        self.host = "http://farm.local"
+        self.plugin._get_targets()[0].token_manager.update(dict(access_token=create_fake_at(), expires_in=3600))
+
+        assert self.plugin._get_tunnel_connection()[0] == "ws://farm.local:443/octoprint/tunnel"
+
+    def test_tunnel_is_opt_in(self):
+        self.tunnel_enabled = False
+        self.plugin._start_tunnel()
+
+        assert self.plugin._tunnel is None
+        assert self.plugin.get_tunnel_stats() == dict(enabled=False)
+
+    def test_tunnel_targets_local_octoprint(self):
+        self.plugin._start_tunnel()
+
+        assert self.plugin._tunnel.local_base_url == "http://127.0.0.1:5000"
+        assert self.plugin._tunnel.identity == dict(deviceUuid="device-uuid", persistenceUuid="persistence-uuid")
+        assert self.plugin.get_tunnel_stats()["connected"] is False
+
+
+class TestPluginTunnelToStub(unittest.TestCase):
+    def test_octofarm_reaches_octoprint_through_the_plugin(self):
+        octoprint = StubOctoPrintServer().start()
+        farm = StubTunnelServer().start()
+        plugin = OctoFarmCompanionPlugin()
+        plugin._settings = mock.MagicMock()
+        plugin._settings.get = lambda accessor: {"tunnel_enabled": True, "octofarm_targets": []}.get(accessor[0])
+        plugin._settings.global_get = lambda accessor: octoprint.server_address[1] if accessor == ["server", "port"] \
+            else None
+        plugin._settings.get_int = mock_settings_get_int
+        plugin._logger = mock.MagicMock()
+        plugin._get_device_uuid = lambda: "device-uuid"
+        plugin._get_tunnel_connection = lambda: (farm.url, {})
+        try:
+            plugin._start_tunnel()
+            assert farm.wait_connected()
+            assert farm.request("GET", "/api/version")[0] == 200
+            assert farm.hellos[0]["deviceUuid"] == "device-uuid"
+        finally:
+            plugin.on_shutdown()
+            farm.stop()
+            octoprint.stop()
@@ -1,7 +1,12 @@
+import base64
+import hashlib
+import json
+import random
+import unittest.mock as mock
 from random import choice
 from string import ascii_uppercase
 
-from octofarm_companion import Config
+from octofarm_companion import Config, OctoFarmCompanionPlugin
 
 
 def mock_settings_get(accessor):
@@ -31,6 +36,8 @@ def mock_settings_custom(accessor):
 def mock_settings_global_get(accessor):
     if accessor[0] == "server" and accessor[1] == "host":
         return Config.default_octoprint_host
+    if accessor[0] == "server" and accessor[1] == "port":
+        return 5000
     return None
 
 
@@ -42,5 +49,100 @@ def mock_settings_get_int(accessor):
     return None
 
 
+def mock_settings_get_float(accessor):
+    return None
+
+
+def mock_plugin(data_folder=None, settings_get=mock_settings_custom):
+    """Plugin with the mocked settings above, a mock logger and no persisted data file, not initialized yet"""
+    plugin = OctoFarmCompanionPlugin()
+    plugin._settings = mock.MagicMock()
+    plugin._settings.get = settings_get
+    plugin._settings.global_get = mock_settings_global_get
+    plugin._settings.get_int = mock_settings_get_int
+    plugin._settings.get_float = mock_settings_get_float
+    plugin._logger = mock.MagicMock()
+    plugin._write_persisted_data = lambda *args: None
+    plugin._data_folder = data_folder
+    return plugin
+
+
 def create_fake_at():
     return ''.join(choice(ascii_uppercase) for i in range(Config.access_token_length))
+
+
+class FakeClock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def _is_probable_prime(n, rng, rounds=20):
+    for p in (2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37):
+        if n % p == 0:
+            return n == p
+    d, r = n - 1, 0
+    while d % 2 == 0:
+        d, r = d // 2, r + 1
+    for i in range(rounds):
+        x = pow(rng.randrange(2, n - 1), d, n)
+        if x in (1, n - 1):
+            continue
+        for j in range(r - 1):
+            x = pow(x, 2, n)
+            if x == n - 1:
+                break
+        else:
+            return False
+    return True
+
+
+def create_rsa_key(bits=1024, seed=1):
+    """Test-only RSA key (n, e, d), not for real use"""
+    rng = random.Random(seed)
+    e = 65537
+
+    def prime():
+        while True:
+            candidate = rng.getrandbits(bits // 2) | (1 << (bits // 2 - 1)) | 1
+            if (candidate - 1) % e and _is_probable_prime(candidate, rng):
+                return candidate
+
+    p, q = prime(), prime()
+    return p * q, e, _modular_inverse(e, (p - 1) * (q - 1))
+
+
+def _modular_inverse(a, m):
+    """Extended Euclidean algorithm, pow(a, -1, m) needs Python 3.8"""
+    old_r, r, old_s, s = a, m, 1, 0
+    while r:
+        quotient = old_r // r
+        old_r, r = r, old_r - quotient * r
+        old_s, s = s, old_s - quotient * s
+    if old_r != 1:
+        raise ValueError("not invertible")
+    return old_s % m
+
+
+def _b64(data):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def create_jwk(key, kid):
+    n, e, d = key
+    return dict(kty="RSA", use="sig", alg="RS256", kid=kid, n=_b64(n.to_bytes((n.bit_length() + 7) // 8, "big")),
+                e=_b64(e.to_bytes(3, "big")))
+
+
+def create_jwt(key, claims, kid, alg="RS256"):
+    n, e, d = key
+    signing_input = _b64(json.dumps(dict(alg=alg, typ="JWT", kid=kid)).encode()) + "." + \
+        _b64(json.dumps(claims).encode())
+    digest_info = bytes.fromhex("3031300d060960864801650304020105000420")
+    size = (n.bit_length() + 7) // 8
+    suffix = digest_info + hashlib.sha256(signing_input.encode()).digest()
+    padded = b"\x00\x01" + b"\xff" * (size - len(suffix) - 3) + b"\x00" + suffix
+    signature = pow(int.from_bytes(padded, "big"), d, n).to_bytes(size, "big")
+    return signing_input + "." + _b64(signature)